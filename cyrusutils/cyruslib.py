@@ -33,8 +33,17 @@ and defines new CYRUS class for cyrus imapd commands
 from sys import exit, stdout
 
 try:
+    import csv
     import imaplib
     import re
+    from array import array
+    from collections import deque
+    from itertools import izip
+    import socket
+    import ssl
+    import time
+    import multiprocessing
+    import zlib
     from binascii import b2a_base64
 except ImportError, e:
     print e
@@ -45,7 +54,9 @@ Commands = {
         'DUMP'         : ('AUTH',), # To check admin status
         'ID'           : ('AUTH',), # Only one ID allowed in non auth mode
         'GETANNOTATION': ('AUTH',),
-        'SETANNOTATION': ('AUTH',)
+        'SETANNOTATION': ('AUTH',),
+        'COMPRESS'     : ('AUTH',), # RFC 4978
+        'XFER'         : ('AUTH',)  # Murder backend transfer
         }
 
 imaplib.Commands.update(Commands)
@@ -53,12 +64,56 @@ imaplib.Commands.update(Commands)
 DEFAULT_SEP = '.'
 QUOTE       = '"'
 DQUOTE      = '""'
+BUFSIZE     = 16384
+PIPELINE    = 64     # Commands in flight before waiting for a response
+FETCHBATCH  = 64     # Messages per UID FETCH
+APPENDBATCH = 1048576 # Message bytes per MULTIAPPEND command
+APPENDWINDOW = 4194304 # Message bytes in flight before waiting for an APPEND
 
 re_ns  = re.compile(r'.*\(\(\".*(\.|/)\"\)\).*')
 re_q0  = re.compile(r'(.*)\s\(\)')
 re_q   = re.compile(r'(.*)\s\(STORAGE (\d+) (\d+)\)')
 re_mb  = re.compile(r'\((.*)\)\s\".\"\s(.*)')
 re_url = re.compile(r'^(imaps?)://(.+?):?(\d{0,5})$')
+re_fuid   = re.compile(r'[( ]UID (\d+)')
+re_fflags = re.compile(r'[( ]FLAGS \(([^)]*)\)')
+re_fdate  = re.compile(r'[( ]INTERNALDATE ("[^"]*")')
+
+### isadmin() and getsep() results per (host, port, user), so later
+### connections in the same process can skip the probes entirely
+PROBECACHE = {}
+
+class HandshakeStats:
+    """TLS handshakes and the seconds they took, over every IMAP4_SSL
+    connection of the process. Kept in shared memory, so the worker
+    processes forked after import add to the same totals"""
+    def __init__(self):
+        self.lock = multiprocessing.Lock()
+        self._count = multiprocessing.Value('i', 0, lock=False)
+        self._seconds = multiprocessing.Value('d', 0.0, lock=False)
+
+    def add(self, seconds):
+        with self.lock:
+            self._count.value += 1
+            self._seconds.value += seconds
+
+    @property
+    def count(self):
+        return self._count.value
+
+    @property
+    def seconds(self):
+        return self._seconds.value
+
+HANDSHAKES = HandshakeStats()
+
+def sslcontext():
+    """The SSLContext to share between connections. Like ssl.wrap_socket,
+    it does not verify the server certificate. The Python 2 ssl module
+    cannot resume sessions, sharing the context saves rebuilding it"""
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.verify_mode = ssl.CERT_NONE
+    return context
 
 def ok(res):
     return res.upper().startswith('OK')
@@ -104,9 +159,295 @@ def res2dict(data):
     return True, res
 
 
+### (uid, flags, internaldate, message) tuples from a UID FETCH response, in
+### uid order. imaplib returns each literal as a (text, literal) tuple and
+### the rest of that line, if any, as the next plain string
+def parsefetch(data):
+    items = []
+    for item in data:
+        if isinstance(item, tuple):
+            items.append([item[0], item[1]])
+        elif item and items:
+            items[-1][0] += item
+    res = []
+    for meta, message in items:
+        uid = int(re_fuid.search(meta).group(1))
+        flags = re_fflags.search(meta)
+        flags = [flag for flag in (flags and flags.group(1).split() or []) if flag.upper() != '\\RECENT']
+        date = re_fdate.search(meta)
+        res.append((uid, '(%s)' % ' '.join(flags), date and date.group(1), message))
+    res.sort()
+    return res
+
+
 class CYRUSError(Exception): pass
 
-class IMAP4(imaplib.IMAP4):
+class QuotaReport:
+    """Columnar quota usage, one row per quota root: parallel roots,
+    used and limit (KB) columns. Unlimited roots are 0/0, as in lq()"""
+    COLUMNS = ('root', 'used', 'limit')
+
+    def __init__(self):
+        self.root = []
+        self.used = array('L')
+        self.limit = array('L')
+
+    def __len__(self):
+        return len(self.root)
+
+    def __iter__(self):
+        return iter(zip(self.root, self.used, self.limit))
+
+    def append(self, root, used, limit):
+        self.root.append(root)
+        self.used.append(used)
+        self.limit.append(limit)
+
+    def sort(self, column='used', reverse=True):
+        """Reorder all columns by one of them, largest first by default"""
+        key = getattr(self, column)
+        order = sorted(range(len(self)), key=key.__getitem__, reverse=reverse)
+        self.root = [self.root[i] for i in order]
+        self.used = array('L', [self.used[i] for i in order])
+        self.limit = array('L', [self.limit[i] for i in order])
+
+    def write(self, fp):
+        """Export as CSV with a header line"""
+        writer = csv.writer(fp)
+        writer.writerow(self.COLUMNS)
+        writer.writerows(self)
+
+class DeflateStream:
+    """RFC 4978 COMPRESS=DEFLATE stream over a connected socket.
+    Replaces the makefile() object imaplib reads from, and compresses
+    everything handed to write()"""
+    def __init__(self, recv, sendall):
+        self.recv = recv
+        self.sendall = sendall
+        self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.deflater = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.buffer = ''
+        self.rawin = self.rawout = 0
+        self.bytesin = self.bytesout = 0
+
+    def __inflate(self):
+        data = self.recv(BUFSIZE)
+        if not data:
+            return ''
+        self.rawin += len(data)
+        data = self.inflater.decompress(data)
+        self.bytesin += len(data)
+        return data
+
+    def read(self, size):
+        chunks = [self.buffer]
+        have = len(self.buffer)
+        while have < size:
+            data = self.__inflate()
+            if not data:
+                break
+            chunks.append(data)
+            have += len(data)
+        data = ''.join(chunks)
+        self.buffer = data[size:]
+        return data[:size]
+
+    def readline(self, limit=-1):
+        start = 0
+        while 1:
+            pos = self.buffer.find('\n', start)
+            if pos != -1:
+                pos += 1
+                break
+            if limit >= 0 and len(self.buffer) >= limit:
+                pos = limit
+                break
+            start = len(self.buffer)
+            data = self.__inflate()
+            if not data:
+                pos = start
+                break
+            self.buffer += data
+        line, self.buffer = self.buffer[:pos], self.buffer[pos:]
+        return line
+
+    def write(self, data):
+        self.bytesout += len(data)
+        data = self.deflater.compress(data) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+        self.rawout += len(data)
+        self.sendall(data)
+
+    def close(self):
+        ### The socket itself is closed by IMAP4.shutdown()
+        self.buffer = ''
+
+class IMAP4Ext:
+    """Transport extensions shared by IMAP4 and IMAP4_SSL"""
+    deflate = None
+    handshakes = 0
+    handshake_time = 0.0
+    ### Token bucket (see ratelimit) every command but LOGIN/LOGOUT waits on
+    ratelimit = None
+
+    def _command(self, name, *args):
+        if self.ratelimit is not None and name not in ('LOGIN', 'LOGOUT', 'AUTHENTICATE'):
+            self.ratelimit.take()
+        return imaplib.IMAP4._command(self, name, *args)
+
+    def send(self, data):
+        if self.deflate is not None:
+            self.deflate.write(data)
+        else:
+            self._sendall(data)
+
+    def capable(self, capability):
+        """True if the server advertises capability"""
+        ### Cyrus sends the post-login capabilities as a LOGIN response code
+        if 'CAPABILITY' in self.untagged_responses:
+            self.capabilities = tuple(self.untagged_responses.pop('CAPABILITY')[-1].upper().split())
+        return capability in self.capabilities
+
+    def compress(self):
+        """Enable COMPRESS=DEFLATE if the server advertises it"""
+        if self.deflate is not None:
+            return 'NO', ['Compression already active']
+        if not self.capable('COMPRESS=DEFLATE'):
+            return 'NO', ['COMPRESS=DEFLATE not supported by server']
+        typ, dat = self._simple_command('COMPRESS', 'DEFLATE')
+        if ok(typ):
+            ### Everything after the tagged OK is compressed, and the server
+            ### sends nothing more until our next command, so the makefile()
+            ### buffer holds no read-ahead that would be lost here
+            self.deflate = DeflateStream(self._recv, self._sendall)
+            self.file = self.deflate
+        return typ, dat
+
+    def pipeline(self, commands, depth=PIPELINE):
+        """Send (name, args) commands without waiting for each response,
+        keeping at most depth of them in flight. Yields (typ, dat) in order;
+        a BAD response is yielded rather than raised"""
+        inflight = deque()
+        for name, args in commands:
+            if len(inflight) >= depth:
+                yield self.__pipeline_complete(*inflight.popleft())
+            inflight.append((name, self._command(name, *args)))
+        while inflight:
+            yield self.__pipeline_complete(*inflight.popleft())
+
+    def multiappend(self, mailbox, batches, window=APPENDWINDOW):
+        """APPEND each batch of (flags, date_time, message), one command per
+        batch (MULTIAPPEND, RFC 3502). With LITERAL+ (RFC 2088) the commands
+        are pipelined with at most window message bytes in flight, otherwise
+        batches must hold a single message and each APPEND waits for the
+        server. Yields (typ, dat) per batch, in order"""
+        if not self.capable('LITERAL+'):
+            for batch in batches:
+                flags, date_time, message = batch[0]
+                try:
+                    yield self.append(mailbox, flags, date_time, message)
+                except self.abort:
+                    raise
+                except self.error, val:
+                    yield 'BAD', [str(val)]
+            return
+        inflight = deque()
+        size = 0
+        for batch in batches:
+            length = sum([len(message) for _, _, message in batch])
+            while inflight and size + length > window:
+                tag, done = inflight.popleft()
+                size -= done
+                yield self.__pipeline_complete('APPEND', tag)
+            inflight.append((self.__append_nowait(mailbox, batch), length))
+            size += length
+        while inflight:
+            yield self.__pipeline_complete('APPEND', inflight.popleft()[0])
+
+    def __append_nowait(self, mailbox, batch):
+        ### Non-synchronizing literals: the whole command goes out in one
+        ### send and is completed later with _command_complete()
+        if self.state not in imaplib.Commands['APPEND']:
+            raise self.error('command APPEND illegal in state %s' % self.state)
+        ### Sent past _command, so it takes its token here
+        if self.ratelimit is not None:
+            self.ratelimit.take()
+        tag = self._new_tag()
+        line = '%s APPEND %s' % (tag, self._checkquote(mailbox))
+        data = []
+        for flags, date_time, message in batch:
+            if date_time:
+                line = '%s %s %s {%d+}' % (line, flags, date_time, len(message))
+            else:
+                line = '%s %s {%d+}' % (line, flags, len(message))
+            data.extend([line, imaplib.CRLF, message])
+            line = ''
+        data.append(imaplib.CRLF)
+        self.send(''.join(data))
+        self.tagged_commands[tag] = None
+        return tag
+
+    def untagged(self, name):
+        """Pop every untagged response of type name, e.g. those
+        collected while a pipeline() was running"""
+        return self.untagged_responses.pop(name, [])
+
+    def __pipeline_complete(self, name, tag):
+        try:
+            return self._command_complete(name, tag)
+        except self.abort:
+            raise
+        except self.error, val:
+            return 'BAD', [str(val)]
+
+    def __probe_complete(self, dump, lst):
+        ### Same interpretation as isadmin() and getsep()
+        try:
+            res, msg = self._command_complete('DUMP', dump)
+            admin = msg[0].lower().find('denied') == -1
+        except self.abort:
+            raise
+        except:
+            admin = False
+        try:
+            typ, dat = self._command_complete('LIST', lst)
+            sep = unquote(self._untagged_response(typ, dat, 'LIST')[1][0]).split()[1]
+        except self.abort:
+            raise
+        except:
+            sep = DEFAULT_SEP
+        return admin, sep
+
+    def probe(self):
+        """isadmin() and getsep() pipelined into a single round trip"""
+        dump = self._command('DUMP', 'NIL')
+        lst = self._command('LIST', DQUOTE, DQUOTE)
+        return self.__probe_complete(dump, lst)
+
+    def login_probe(self, user, password):
+        """LOGIN pipelined with the isadmin() and getsep() probes.
+        Returns (typ, dat, admin, sep) after a single round trip"""
+        login = self._command('LOGIN', user, self._quote(password))
+        ### The probes are sent before LOGIN completes; if it fails
+        ### the server just rejects them as unauthenticated
+        self.state = 'AUTH'
+        dump = self._command('DUMP', 'NIL')
+        lst = self._command('LIST', DQUOTE, DQUOTE)
+        try:
+            typ, dat = self._command_complete('LOGIN', login)
+        finally:
+            admin, sep = self.__probe_complete(dump, lst)
+        if typ != 'OK':
+            self.state = 'NONAUTH'
+            raise self.error(dat[-1])
+        return typ, dat, admin, sep
+
+class IMAP4(IMAP4Ext, imaplib.IMAP4):
+    def _recv(self, size):
+        return self.sock.recv(size)
+
+    def _sendall(self, data):
+        self.sock.sendall(data)
+
     def getsep(self):
         """Get mailbox separator"""
         ### yes, ugly but cyradm does it in the same way
@@ -177,7 +518,43 @@ class IMAP4(imaplib.IMAP4):
     def reconstruct(self, mailbox):
         return self._simple_command('RECONSTRUCT', mailbox)
 
-class IMAP4_SSL(imaplib.IMAP4_SSL):
+    def xfer(self, mailbox, server, partition=None):
+        """Transfer mailbox to another backend, partition is optional"""
+        if partition is not None:
+            return self._simple_command('XFER', mailbox, server, partition)
+        else:
+            return self._simple_command('XFER', mailbox, server)
+
+class IMAP4_SSL(IMAP4Ext, imaplib.IMAP4_SSL):
+    def __init__(self, host = '', port = imaplib.IMAP4_SSL_PORT, keyfile = None, certfile = None, ssl_context = None):
+        self.ssl_context = ssl_context
+        imaplib.IMAP4_SSL.__init__(self, host, port, keyfile, certfile)
+
+    ### Overridden to wrap the socket with a shared SSLContext
+    ### and to time the handshake
+    def open(self, host = '', port = imaplib.IMAP4_SSL_PORT):
+        self.host = host
+        self.port = port
+        self.sock = socket.create_connection((host, port))
+        if self.ssl_context is None:
+            self.sslobj = ssl.wrap_socket(self.sock, self.keyfile, self.certfile, do_handshake_on_connect=False)
+        else:
+            self.sslobj = self.ssl_context.wrap_socket(self.sock, server_hostname=host,
+                do_handshake_on_connect=False)
+        start = time.time()
+        self.sslobj.do_handshake()
+        seconds = time.time() - start
+        self.handshakes += 1
+        self.handshake_time += seconds
+        HANDSHAKES.add(seconds)
+        self.file = self.sslobj.makefile('rb')
+
+    def _recv(self, size):
+        return self.sslobj.recv(size)
+
+    def _sendall(self, data):
+        imaplib.IMAP4_SSL.send(self, data)
+
     def getsep(self):
         """Get mailbox separator"""
         ### yes, ugly but cyradm does it in the same way
@@ -248,6 +625,13 @@ class IMAP4_SSL(imaplib.IMAP4_SSL):
     def reconstruct(self, mailbox):
         return self._simple_command('RECONSTRUCT', mailbox)
 
+    def xfer(self, mailbox, server, partition=None):
+        """Transfer mailbox to another backend, partition is optional"""
+        if partition is not None:
+            return self._simple_command('XFER', mailbox, server, partition)
+        else:
+            return self._simple_command('XFER', mailbox, server)
+
     def login_plain(self, admin, password, asUser):
         if asUser:
             encoded = b2a_base64("%s\0%s\0%s" % (asUser, admin, password)).strip()
@@ -279,6 +663,9 @@ class CYRUS:
     ERROR["GETQUOTA"]    = [45, "Quota root does not exist"]
     ERROR["RENAME"]      = [50, "Unable rename mailbox"]
     ERROR["RECONSTRUCT"] = [60, "Unable reconstruct mailbox"]
+    ERROR["SELECT"]      = [65, "Unable select mailbox"]
+    ERROR["UID"]         = [66, "Unable fetch messages"]
+    ERROR["APPEND"]      = [67, "Unable append messages"]
     ERROR["SUBSCRIBE"]   = [70, "User is cyrus administrator, normal user required"]
     ERROR["UNSUBSCRIBE"] = [75, "User is cyrus administrator, normal user required"]
     ERROR["LSUB"]        = [77, "User is cyrus administrator, normal user required"]
@@ -287,8 +674,9 @@ class CYRUS:
 
     ENCODING_LIST = ['imap', 'utf-8', 'iso-8859-1']
     
-    def __init__(self, url = 'imap://localhost:143'):
+    def __init__(self, url = 'imap://localhost:143', compress = True, ssl_context = None, ratelimit = None):
         self.VERBOSE = False
+        self.COMPRESS = compress
         self.AUTH = False
         self.ADMIN = None
         self.AUSER = None
@@ -311,9 +699,10 @@ class CYRUS:
                 self.m = IMAP4(host, port)
             else:
                 self.ssl = True
-                self.m = IMAP4_SSL(host, port)
+                self.m = IMAP4_SSL(host, port, ssl_context=ssl_context)
         except:
             self.__doraise("CONNECT")
+        self.m.ratelimit = ratelimit
 
     def __del__(self):
         if self.AUTH:
@@ -369,6 +758,33 @@ class CYRUS:
             self.__doexception(function, error, *args)
         self.__doexception(function, msg[0], *args)
 
+    def __pipeline(self, function, commands):
+        """Pipelines (name, args) commands, returns their (res, msg) in order"""
+        try:
+            return list(self.m.pipeline(commands))
+        except Exception, info:
+            error = info.args[0].split(':').pop().strip()
+            self.__doexception(function, error)
+
+    def __report(self, function, mailboxes, results):
+        """Logs each mailbox result, raising once for all failures.
+        The (mailbox, res, msg) list is returned, or set as the report
+        attribute of the CYRUSError raised"""
+        report = []
+        failed = []
+        for mailbox, (res, msg) in zip(mailboxes, results):
+            self.__verbose( '[%s %s] %s: %s' % (function, mailbox, res, msg[0]) )
+            report.append((mailbox, res, msg[0]))
+            if not ok(res):
+                failed.append('%s: %s' % (mailbox, msg[0]))
+        if failed:
+            try:
+                self.__doexception(function, '; '.join(failed))
+            except CYRUSError, info:
+                info.report = report
+                raise
+        return report
+
     def id(self):
         self.__prepare('id')
         res, data = self.m.id()
@@ -383,9 +799,14 @@ class CYRUS:
     def login(self, username, password, forceNoAdmin = False):
         if self.AUTH:
             self.__doexception("LOGIN", self.ERROR.get("AUTH")[1])
+        key = (self.m.host, self.m.port, username)
         try:
-            res, msg = self.m.login(username, password)
-            admin = self.m.isadmin()
+            if key in PROBECACHE:
+                res, msg = self.m.login(username, password)
+                admin, sep = PROBECACHE[key]
+            else:
+                res, msg, admin, sep = self.m.login_probe(username, password)
+                PROBECACHE[key] = admin, sep
         except Exception, info:
             error = info.args[0].split(':').pop().strip()
             self.__doexception("LOGIN", error)
@@ -393,9 +814,10 @@ class CYRUS:
             self.ADMIN = username
         else:
             self.__doexception("LOGIN", self.ERROR.get("ADMIN")[1])
-        self.SEP = self.m.getsep()
+        self.SEP = sep
         self.AUTH = True
         self.__verbose( '[LOGIN %s] %s: %s' % (username, res, msg[0]) )
+        self.__compress()
 
     def login_plain(self, admin, password, asUser = None, forceNoAdmin = False):
         if self.AUTH:
@@ -406,16 +828,45 @@ class CYRUS:
         self.__verbose( '[AUTHENTICATE PLAIN %s] %s: %s' % (admin, res, msg[0]) )
 
         if ok(res):
+            key = (self.m.host, self.m.port, asUser or admin)
+            if key not in PROBECACHE:
+                PROBECACHE[key] = self.m.probe()
+            isadmin, sep = PROBECACHE[key]
             if asUser is None:
-                if self.m.isadmin() or forceNoAdmin:
+                if isadmin or forceNoAdmin:
                     self.ADMIN = admin
                 else:
                     self.__doexception("LOGIN", self.ERROR.get("ADMIN")[1])
             else:
                 self.ADMIN = asUser
                 self.AUSER = asUser
-            self.SEP = self.m.getsep()
+            self.SEP = sep
             self.AUTH = True
+            self.__compress()
+
+    def stats(self):
+        """Connection statistics: TLS handshakes and compression"""
+        stats = {
+            'handshakes': self.m.handshakes,
+            'handshake_time': self.m.handshake_time,
+        }
+        if self.m.deflate is not None:
+            stats['bytes_in'] = self.m.deflate.bytesin
+            stats['bytes_out'] = self.m.deflate.bytesout
+            stats['compressed_in'] = self.m.deflate.rawin
+            stats['compressed_out'] = self.m.deflate.rawout
+        return stats
+
+    def __compress(self):
+        """Negotiate COMPRESS=DEFLATE unless disabled with compress=False"""
+        if not self.COMPRESS:
+            return
+        try:
+            res, msg = self.m.compress()
+        except Exception, info:
+            self.__verbose( '[COMPRESS DEFLATE] BAD: %s' % info.args[0] )
+            return
+        self.__verbose( '[COMPRESS DEFLATE] %s: %s' % (res, msg[0]) )
 
     def logout(self):
         try:
@@ -512,24 +963,31 @@ class CYRUS:
         res, msg = self.__docommand('create', self.decode(mailbox), partition)
         self.__verbose( '[CREATE %s partition=%s] %s: %s' % (mailbox, partition, res, msg[0]) )
 
-    def __dm(self, mailbox):
-        if not mailbox:
-            return True
-        self.__docommand("setacl", self.decode(mailbox), self.ADMIN, self.ADMINACL)
-        res, msg = self.__docommand("delete", self.decode(mailbox))
-        self.__verbose( '[DELETE %s] %s: %s' % (mailbox, res, msg[0]) )
-
     def dm(self, mailbox, recursive=True):
-        """Delete mailbox"""
+        """Delete mailbox, children before parents.
+        Returns a list of (mailbox, res, msg), one per deleted mailbox.
+        A mailbox whose SETACL failed is not deleted, nor are its parents"""
         self.__prepare('DELETE', mailbox)
         mbxTmp = mailbox.split(self.SEP)
+        mbxList = []
         # Cyrus is not recursive for user subfolders and global folders
         if (recursive and mbxTmp[0] != "user") or (len(mbxTmp) > 2):
             mbxList = self.lm("%s%s*" % (mailbox, self.SEP))
             mbxList.reverse()
-            for mbox in mbxList:
-                self.__dm(mbox)
-        self.__dm(mailbox)
+        mbxList = [mbox for mbox in mbxList + [mailbox] if mbox]
+        # All SETACLs first, so only mailboxes we could take over are deleted
+        commands = [('SETACL', (self.decode(mbox), self.ADMIN, self.ADMINACL)) for mbox in mbxList]
+        results = dict(zip(mbxList, self.__pipeline('SETACL', commands)))
+        failed = [mbox for mbox in mbxList if not ok(results[mbox][0])]
+        for mbox in mbxList:
+            if ok(results[mbox][0]) and [f for f in failed if f.startswith(mbox + self.SEP)]:
+                results[mbox] = ('NO', ['Not deleted, a subfolder could not be'])
+        # One connection runs commands in order, so pipelining
+        # keeps every child DELETE ahead of its parent
+        deletes = [mbox for mbox in mbxList if ok(results[mbox][0])]
+        commands = [('DELETE', (self.decode(mbox),)) for mbox in deletes]
+        results.update(zip(deletes, self.__pipeline('DELETE', commands)))
+        return self.__report('DELETE', mbxList, [results[mbox] for mbox in mbxList])
  
     def rename(self, fromMbx, toMbx, partition=None):
         """Rename or change partition"""
@@ -538,6 +996,103 @@ class CYRUS:
         res, msg = self.__docommand("rename", self.decode(fromMbx), self.decode(toMbx), partition)
         self.__verbose( '[RENAME %s %s] %s: %s' % (fromMbx, toMbx, res, msg[0]) )
 
+    def xfer(self, mailbox, dest_server, partition=None):
+        """Transfer mailbox to another backend, the server moves the data"""
+        self.__prepare('XFER', mailbox)
+        # Xfer of user.name is recursive, as rename
+        res, msg = self.__docommand("xfer", self.decode(mailbox), dest_server, partition)
+        self.__verbose( '[XFER %s %s partition=%s] %s: %s' % (mailbox, dest_server, partition, res, msg[0]) )
+
+    def xferall(self, mailboxes, dest_server, partition=None, progress=None):
+        """Pipelined XFER of many mailboxes (usually user.name) to dest_server.
+        progress(done, total, mailbox, res, msg) is called as each one completes.
+        Returns a list of (mailbox, res, msg)"""
+        mailboxes = list(mailboxes)
+        for mbox in mailboxes:
+            self.__prepare('XFER', mbox)
+        commands = []
+        for mbox in mailboxes:
+            if partition is not None:
+                commands.append(('XFER', (self.decode(mbox), dest_server, partition)))
+            else:
+                commands.append(('XFER', (self.decode(mbox), dest_server)))
+        results = []
+        try:
+            for res, msg in self.m.pipeline(commands):
+                results.append((res, msg))
+                if progress is not None:
+                    progress(len(results), len(mailboxes), mailboxes[len(results) - 1], res, msg[0])
+        except Exception, info:
+            error = info.args[0].split(':').pop().strip()
+            self.__doexception('XFER', error)
+        return self.__report('XFER', mailboxes, results)
+
+    def examine(self, mailbox):
+        """Select mailbox read-only, returns its UIDVALIDITY"""
+        self.__prepare('SELECT', mailbox)
+        res, msg = self.__docommand('select', self.decode(mailbox), True)
+        self.__verbose( '[EXAMINE %s] %s: %s messages' % (mailbox, res, msg[0]) )
+        typ, dat = self.m.response('UIDVALIDITY')
+        return int(dat[0])
+
+    def fetchmessages(self, lastuid=0, batch=FETCHBATCH):
+        """Yields (uid, flags, internaldate, message) for every message above
+        lastuid in the examine()d mailbox, in uid order, batch at a time"""
+        res, msg = self.__docommand('uid', 'SEARCH', 'UID', '%d:*' % (lastuid + 1))
+        ### n:* always matches the highest uid, even when it is below n
+        uids = [int(uid) for uid in ' '.join(filter(None, msg)).split() if int(uid) > lastuid]
+        for i in range(0, len(uids), batch):
+            uidset = ','.join([str(uid) for uid in uids[i:i + batch]])
+            res, msg = self.__docommand('uid', 'FETCH', uidset, '(UID FLAGS INTERNALDATE BODY.PEEK[])')
+            for message in parsefetch(msg):
+                yield message
+
+    def appendmessages(self, mailbox, messages, window=APPENDWINDOW, done=None):
+        """Append (uid, flags, internaldate, message) tuples, e.g. from
+        fetchmessages() on another server. With LITERAL+ the APPENDs are
+        pipelined within window bytes, with MULTIAPPEND as well several
+        messages go in each command. done(uid) is called with the last uid
+        of each command that completed, in order, up to the first failure.
+        Returns the number of messages appended"""
+        self.__prepare('APPEND', mailbox)
+        multi = self.m.capable('LITERAL+') and self.m.capable('MULTIAPPEND')
+        pending = deque()
+        failed = []
+
+        def batches():
+            batch, uids, size = [], [], 0
+            for uid, flags, date_time, message in messages:
+                if batch and (not multi or size + len(message) > APPENDBATCH):
+                    pending.append((uids[-1], len(uids)))
+                    yield batch
+                    batch, uids, size = [], [], 0
+                if failed:
+                    return
+                batch.append((flags, date_time, message))
+                uids.append(uid)
+                size += len(message)
+            if batch:
+                pending.append((uids[-1], len(uids)))
+                yield batch
+
+        count = 0
+        try:
+            for res, msg in self.m.multiappend(self.decode(mailbox), batches(), window):
+                lastuid, appended = pending.popleft()
+                if not ok(res):
+                    failed.append(msg[0])
+                elif not failed:
+                    count += appended
+                    if done is not None:
+                        done(lastuid)
+        except Exception, info:
+            error = info.args[0].split(':').pop().strip()
+            self.__doexception('APPEND', error, mailbox)
+        self.__verbose( '[APPEND %s] %d messages' % (mailbox, count) )
+        if failed:
+            self.__doexception('APPEND', failed[0], mailbox)
+        return count
+
     def lam(self, mailbox):
         """List ACLs"""
         self.__prepare('GETACL', mailbox)
@@ -556,6 +1111,48 @@ class CYRUS:
             acls[userid] = rights
         return acls
 
+    def aclsnapshot(self, pattern="*", mailboxes=None):
+        """Snapshot the ACLs of every mailbox matching pattern, or of the
+        given mailboxes, with pipelined GETACL.
+        Returns {mailbox: {userid: rights}}, which serializes as is to JSON"""
+        self.__prepare('GETACL')
+        if mailboxes is None:
+            mailboxes = self.lm(pattern)
+        results = self.__pipeline('GETACL', [('GETACL', (self.decode(mbox),)) for mbox in mailboxes])
+        self.__report('GETACL', mailboxes, results)
+        snapshot = {}
+        for acl in self.m.untagged('ACL'):
+            if type(acl) is tuple:
+                self.__verbose( '[GETACL] BAD: Literal mailbox names not supported' )
+                continue
+            aclList = splitquote(acl.strip())
+            mailbox = self.encode(aclList.pop(0))
+            if len(aclList) % 2:
+                self.__verbose( '[GETACL %s] BAD: Unmatched pairs in result' % mailbox )
+                raise self.__doraise("GETACL")
+            acls = snapshot.setdefault(mailbox, {})
+            for i in range(0, len(aclList), 2):
+                acls[self.encode(aclList[i])] = aclList[i + 1]
+        return snapshot
+
+    def aclrestore(self, snapshot, rewrite=None):
+        """Apply an aclsnapshot() with pipelined SETACL.
+        rewrite(userid) returns the userid to use on this server,
+        or None to skip the entry (eg bob -> bob@example.com)"""
+        self.__prepare('SETACL')
+        entries = []
+        commands = []
+        for mailbox in sorted(snapshot):
+            for userid, rights in sorted(snapshot[mailbox].items()):
+                if rewrite is not None:
+                    userid = rewrite(userid)
+                    if userid is None:
+                        continue
+                entries.append('%s %s %s' % (mailbox, userid, rights))
+                commands.append(('SETACL', (self.decode(mailbox), userid, rights)))
+        results = self.__pipeline('SETACL', commands)
+        return self.__report('SETACL', entries, results)
+
     def sam(self, mailbox, userid, rights):
         """Set ACL"""
         self.__prepare('SETACL', mailbox)
@@ -583,6 +1180,41 @@ class CYRUS:
             self.__verbose( '[GETQUOTA %s] BAD: Error while parsing results' % mailbox )
             return 0, 0
 
+    def quotareport(self, pattern=None):
+        """Quota usage of every mailbox matching pattern (default all user
+        mailboxes), using pipelined GETQUOTAROOT. Returns a QuotaReport"""
+        self.__prepare('GETQUOTAROOT')
+        if pattern is None:
+            pattern = 'user%s%%' % self.SEP
+        mailboxes = self.lm(pattern)
+        commands = [('GETQUOTAROOT', (self.decode(mbox),)) for mbox in mailboxes]
+        report = QuotaReport()
+        seen = set()
+        try:
+            ### izip, zip would run the whole pipeline before the first pass
+            for mailbox, (res, msg) in izip(mailboxes, self.m.pipeline(commands)):
+                if not ok(res):
+                    self.__verbose( '[GETQUOTAROOT %s] %s: %s' % (mailbox, res, msg[0]) )
+                self.m.untagged('QUOTAROOT')
+                ### Parse as we go so only one window of responses is held
+                for quota in self.m.untagged('QUOTA'):
+                    match = re_q.match(quota)
+                    if match:
+                        root, used, limit = unquote(match.group(1)), int(match.group(2)), int(match.group(3))
+                    elif re_q0.match(quota):
+                        root, used, limit = unquote(re_q0.match(quota).group(1)), 0, 0
+                    else:
+                        self.__verbose( '[GETQUOTAROOT %s] BAD: RegExp not matched, please report' % mailbox )
+                        continue
+                    if root not in seen:
+                        seen.add(root)
+                        report.append(self.encode(root), used, limit)
+        except Exception, info:
+            error = info.args[0].split(':').pop().strip()
+            self.__doexception('GETQUOTAROOT', error)
+        self.__verbose( '[GETQUOTAROOT %s] %d quota roots' % (pattern, len(report)) )
+        return report
+
     def sq(self, mailbox, limit):
         """Set Quota"""
         self.__prepare('SETQUOTA', mailbox)
@@ -623,22 +1255,44 @@ class CYRUS:
         res, msg = self.__docommand("setannotation", self.decode(mailbox), annotation, value)
         self.__verbose( '[SETANNOTATION %s] %s: %s' % (mailbox, res, msg[0]) )
 
-    def __reconstruct(self, mailbox):
-        if not mailbox:
-            return True
-        res, msg = self.__docommand("reconstruct", self.decode(mailbox))
-        self.__verbose( '[RECONSTRUCT %s] %s: %s' % (mailbox, res, msg[0]) )
+    def setannotations(self, annotations):
+        """Set many annotations with pipelined SETANNOTATION.
+        annotations is {mailbox: {entry: value}}, as returned by getannotation()"""
+        self.__prepare('SETANNOTATION')
+        entries = []
+        commands = []
+        for mailbox in sorted(annotations):
+            for desc, value in sorted(annotations[mailbox].items()):
+                entries.append('%s %s' % (mailbox, desc))
+                value = value and quote(value) or "NIL"
+                commands.append(('SETANNOTATION',
+                    (self.decode(mailbox), quote(desc), "(%s %s)" % (quote('value.shared'), value))))
+        results = self.__pipeline('SETANNOTATION', commands)
+        return self.__report('SETANNOTATION', entries, results)
 
     def reconstruct(self, mailbox, recursive=True):
-        """Reconstruct"""
+        """Reconstruct.
+        Returns a list of (mailbox, res, msg), one per reconstructed mailbox"""
         self.__prepare('RECONSTRUCT', mailbox)
+        mbxList = []
         # Cyrus is not recursive for remote reconstruct
         if recursive:
             mbxList = self.lm("%s%s*" % (mailbox, self.SEP))
             mbxList.reverse()
-            for mbox in mbxList:
-                self.__reconstruct(mbox)
-        self.__reconstruct(mailbox)
+        mbxList = [mbox for mbox in mbxList + [mailbox] if mbox]
+        commands = [('RECONSTRUCT', (self.decode(mbox),)) for mbox in mbxList]
+        results = self.__pipeline('RECONSTRUCT', commands)
+        return self.__report('RECONSTRUCT', mbxList, results)
+
+    def reconstructall(self, mailboxes):
+        """Pipelined, non-recursive reconstruct of exactly the mailboxes given.
+        Returns a list of (mailbox, res, msg)"""
+        mailboxes = list(mailboxes)
+        for mbox in mailboxes:
+            self.__prepare('RECONSTRUCT', mbox)
+        commands = [('RECONSTRUCT', (self.decode(mbox),)) for mbox in mailboxes]
+        results = self.__pipeline('RECONSTRUCT', commands)
+        return self.__report('RECONSTRUCT', mailboxes, results)
 
     def lsub(self, pattern="*"):
         if self.AUSER is None:
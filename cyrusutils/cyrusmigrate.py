@@ -1,29 +1,121 @@
 import re
 import os
+import csv
+import time
 import pwd
 import grp
 import sys
+import shutil
+import struct
 import subprocess
 import argparse
 import pdb
-import tempfile
+import Queue
 import logging
+import itertools
+import threading
+import contextlib
+import multiprocessing
+from collections import Counter
 
 import skiplist
+import imapcopy
+import syncengine
+import syncstate
+import spool
+import logcontext
+import migrationplan
+
+
+class _LargestFirstQueue(Queue.PriorityQueue):
+	""" Bounded queue handing out the item of largest size(item) first,
+		and the None end marker only once it is empty
+	"""
+	def __init__(self, maxsize, size):
+		Queue.PriorityQueue.__init__(self, maxsize)
+		self.size = size
+		self.order = itertools.count()
+
+	def _put(self, item):
+		key = float('inf') if item is None else -self.size(item)
+		Queue.PriorityQueue._put(self, (key, next(self.order), item))
+
+	def _get(self):
+		return Queue.PriorityQueue._get(self)[2]
 
 
 class CyrusMigrate(object):
 	_cyrusBin = "/usr/lib/cyrus-imapd/"
+	# Computed by the server, cannot be set with SETANNOTATION
+	_readOnlyAnnotations = (
+		'/vendor/cmu/cyrus-imapd/lastpop',
+		'/vendor/cmu/cyrus-imapd/lastupdate',
+		'/vendor/cmu/cyrus-imapd/partition',
+		'/vendor/cmu/cyrus-imapd/server',
+		'/vendor/cmu/cyrus-imapd/size',
+	)
+	# syncMethod -> syncengine.SyncEngine mode, None for rsync
+	_syncMethods = {
+		'native': 'copy',
+		'hardlink': 'hardlink',
+		'reflink': 'reflink',
+		'rsync': None,
+	}
+	# Mailboxes queued between pipeline stages, see migratePipelined
+	pipelineDepth = 64
+	# Mailboxes per run of the local reconstruct binary
+	reconstructBatch = 100
+	# cyrus.header path -> (mtime, inode, mailbox id), shared by all instances
+	# so a long running process reads each header only once. Emptied when
+	# it reaches headerCacheSize entries, so a daemon does not grow forever
+	_headerCache = {}
+	headerCacheSize = 100000
 	_headerMagic = """\241\002\213\015Cyrus mailbox header
 "The best thing about this system was that it had lots of goals."
 \t--Jim Morris on Andrew
 """
-	def __init__(self, imap, oldMailbox, newMailbox, rootPath=None, verbose=False):
+	def __init__(self, imap, oldMailbox, newMailbox, rootPath=None, verbose=False, source=None, stateFile=None,
+			syncMethod='native', syncThreads=4, syncDb=None, shardSize=10000, mailboxThreads=4,
+			deviceJobs=None, deviceLimits=None, readOrder='extent', rateLimits=None,
+			localReconstruct=False, reconstructSessions=(), restart=False):
 		self.imap = imap
+		# Fingerprints of the last successful run per mailbox and phase, see syncstate
+		self.syncState = syncstate.SyncState(syncDb) if syncDb else None
+		self.__fingerprints = {}
+		# 'native' (syncengine copies), 'hardlink', 'reflink' or 'rsync', one process per mailbox
+		assert syncMethod in self._syncMethods, 'Unknown sync method %r' % syncMethod
+		self.syncMethod = syncMethod
+		self.syncThreads = syncThreads
+		# A mailbox with more than shardSize files to copy is split over mailboxThreads threads
+		self.shardSize = shardSize
+		self.mailboxThreads = mailboxThreads
+		# Syncs per disk at a time, {path: n} for the disks of those paths, see syncengine
+		self.deviceJobs = deviceJobs
+		self.deviceLimits = deviceLimits or {}
+		# Order files are read in within a mailbox: 'extent', 'inode' or 'uid'
+		self.readOrder = readOrder
+		# Shared bytes/s and files/s limits of the sync, see ratelimit
+		self.rateLimits = rateLimits
+		# Reconstruct with the local cyrus binary, or spread over these extra sessions
+		self.localReconstruct = localReconstruct
+		self.reconstructSessions = list(reconstructSessions)
+		# New mailboxes the sync of this run went through and those whose
+		# files it changed, None before a sync
+		self.__synced = None
+		self.__modified = None
+		# Old mailboxes live on another server, reached over IMAP only
+		self.source = source
+		self.stateFile = stateFile
+		# Copy over IMAP from the first message, ignoring stateFile
+		self.restart = restart
 		self.oldmbox = oldMailbox
 		self.newmbox = newMailbox
 		self.__newMailboxes = None
 		self.__oldMailboxes = None
+		self.__spoolInventory = None
+		# Old subscription file and old to new mailbox ids, read once per run
+		self.__oldSubscriptions = None
+		self.__mailboxIdMap = None
 		self.rootPath = rootPath or ''
 
 		if self.rootPath:
@@ -34,6 +126,13 @@ class CyrusMigrate(object):
 		else:
 			logging.basicConfig(level=logging.INFO)
 
+	def close(self):
+		""" Closes the sync state database, if any
+		"""
+		if self.syncState is not None:
+			self.syncState.close()
+			self.syncState = None
+
 	@property
 	def newMailboxes(self):
 		if self.__newMailboxes is None:
@@ -46,24 +145,64 @@ class CyrusMigrate(object):
 			self.__oldMailboxes = list(self._listOldMailboxes())
 		return self.__oldMailboxes
 
-	def __call__(self, reconstruct=False):
+	@property
+	def spoolInventory(self):
+		""" The old mailbox tree on disk (see spool), read once per run.
+			None when the old spool is only reachable over IMAP
+		"""
+		if self.__spoolInventory is None and self.source is None:
+			self.__spoolInventory = spool.SpoolInventory(self.oldmbox, self.oldImapPartitionPath(self.oldmbox))
+		return self.__spoolInventory
+
+	def __call__(self, reconstruct=False, acls=False, annotations=False, rename=False, pipeline=False, plan=None):
 		logging.info('--- Converting %r to %r ---', self.oldmbox, self.newmbox)
 
-		# Create new mailboxes
-		self.createNewMailboxes()
+		# Move the whole tree on the server, no data copied
+		if rename and self.canRename:
+			self.renameMailboxes()
+			self._convertRenamedConfig()
+			return
 
-		# Synchronize files from old to new
-		self.syncFiles()
+		if pipeline and self.source is None:
+			# Create, sync and reconstruct each mailbox as it comes
+			self.migratePipelined(reconstruct)
+		else:
+			# Create new mailboxes
+			self.createNewMailboxes()
 
-		# Reconstruct new mailboxes
-		if reconstruct:
-			self.reconstruct()
+		# Copy access control lists
+		if acls:
+			self.convertAcls()
+
+		# Copy mailbox annotations
+		if annotations:
+			self.convertAnnotations()
+
+		if not pipeline or self.source is not None:
+			# Synchronize files from old to new
+			self.syncFiles(plan)
+
+			# Reconstruct new mailboxes
+			if reconstruct:
+				self.reconstruct()
+
+		if self.source is not None:
+			logging.info('no spool access to %r, subscriptions and seen state not converted', self.oldmbox)
+			return
 
 		# Convert folder subscription file
-		self.convertSubscription()
+		with self._timed('subscriptions'):
+			self.convertSubscription()
 
 		# Convert seen file
-		self.convertSeen()
+		with self._timed('seen state'):
+			self.convertSeen()
+
+	@contextlib.contextmanager
+	def _timed(self, phase):
+		start = time.time()
+		yield
+		logging.info('%s of %r converted in %.2fs', phase, self.oldmbox, time.time() - start)
 
 	@property
 	def _newPartitionRoot(self):
@@ -94,53 +233,153 @@ class CyrusMigrate(object):
 		parts = mailbox.split('@')
 		return tuple(parts) if len(parts) > 1 else (parts[0], None,)
 
+	@staticmethod
+	def _mailboxOwner(mailbox):
+		""" Returns the user id that owns a user mailbox, None for shared mailboxes
+			Eg:
+				user.bob.folder 1 -> bob
+				user.bob@example.com -> bob@example.com
+				shared.folder -> None
+		"""
+		name, domain = CyrusMigrate._mailboxParts(mailbox)
+		if not name.startswith('user.'):
+			return None
+		return name.split('.')[1] + ('@' + domain if domain else '')
+
 	def __listOldMailboxesByDirectory(self):
-		rootPath = self.oldImapPartitionPath(self.oldmbox)
-
-		for dirpath, _, _ in os.walk(rootPath):
-			# Ensure target directory exists
-			if os.path.exists(os.path.join(dirpath, 'cyrus.header')):
-				match = re.match('^%s/domain/(.*?)/(.*)$' % self._oldPartitionRoot, dirpath)
-				if match: # domain match
-					yield '%s@%s' % (match.group(2).replace('/', '.'), match.group(1))
-				else: # user or shared
-					match = re.match('^%s/(.*)$' % self._oldPartitionRoot, dirpath)
-					assert match
-					yield match.group(1).replace('/', '.')
+		return [mailbox.mailbox for mailbox in self.spoolInventory]
+
+	@property
+	def _oldImap(self):
+		""" The server holding the old mailboxes
+		"""
+		return self.source or self.imap
 
 	def _listOldMailboxes(self):
 		if self.rootPath:
 			return self.__listOldMailboxesByDirectory()
 		else:
-			return self.__listImapMailboxes(self.oldmbox)
+			return self.__listImapMailboxes(self._oldImap, self.oldmbox)
 
 	def _listNewMailboxes(self):
-		return self.__listImapMailboxes(self.newmbox)
+		return self.__listImapMailboxes(self.imap, self.newmbox)
 
-	def __listImapMailboxes(self, topLevelMailbox):
+	def __listImapMailboxes(self, imap, topLevelMailbox):
 		""" From the top level mailbox, list all imap folders.
 			imap.lm('user.bob.*') will only return subfolders for
 			bob, so we have to add the topLevelMailbox into the
 			result set. The alternative would be to use imap.lm('user.bob*')
 			but this would also return all mailboxes for user.bobby
 		"""
-		if self.imap.lm(topLevelMailbox):
+		if imap.lm(topLevelMailbox):
 			yield topLevelMailbox
 
 			mailbox, domain = self._mailboxParts(topLevelMailbox)
 
-			for mbox in self.imap.lm('%s.*%s' % (mailbox, ('@' + domain if domain else ''))):
+			for mbox in imap.lm('%s.*%s' % (mailbox, ('@' + domain if domain else ''))):
 				# Exclude domain mailboxes
 				if domain is None and '@' in mbox:
 					continue
 				yield mbox
 
+	def fingerprint(self, oldmbox):
+		""" The old mailbox directory fingerprint (see syncstate), taken once per run
+			so that later phases compare against the same state the sync saw
+		"""
+		if oldmbox not in self.__fingerprints:
+			mailbox = self.spoolInventory.get(oldmbox)
+			self.__fingerprints[oldmbox] = syncstate.fingerprint(
+				self.oldImapPartitionPath(oldmbox), mailbox and mailbox.stat
+			)
+		return self.__fingerprints[oldmbox]
+
+	def _pendingMailboxes(self, phase):
+		""" Returns (oldmbox, newmbox, fingerprint) for each old mailbox that changed
+			since phase last succeeded. That is all of them without a sync state
+			database, or when the old spool is only reachable over IMAP
+		"""
+		pending = []
+		for oldmbox in self.oldMailboxes:
+			newmbox = self.oldMailboxNameToNew(oldmbox)
+			isPending, fingerprint = self._pending(phase, oldmbox, newmbox)
+			if isPending:
+				pending.append((oldmbox, newmbox, fingerprint))
+		return pending
+
+	def _pending(self, phase, oldmbox, newmbox):
+		""" Returns whether one old mailbox is pending for phase (see
+			_pendingMailboxes) and its fingerprint
+		"""
+		if self.syncState is None or self.source is not None:
+			return True, None
+		fingerprint = self.fingerprint(oldmbox)
+		if self.syncState.unchanged(phase, oldmbox, newmbox, fingerprint):
+			logging.debug('%s: %r unchanged since last run', phase, oldmbox)
+			return False, fingerprint
+		return True, fingerprint
+
+	def _mailboxesDone(self, phase, pending):
+		if self.syncState is not None and self.source is None:
+			self.syncState.done(phase, pending)
+
 	def reconstruct(self):
-		""" Reconstructs each new mailbox
+		""" Reconstructs, once each and non-recursively, the new mailboxes
+			whose files the sync of this run changed. Without a sync in this
+			run, those whose old mailbox changed since they were last
+			reconstructed, and new mailboxes without an old one
 		"""
-		for mbox in self.newMailboxes:
-			logging.debug('reconstructing %r', mbox)
-			self.imap.reconstruct(mbox)
+		pending = self._pendingMailboxes('reconstruct')
+		if self.__modified is None:
+			migrated = set(self.oldMailboxNameToNew(oldmbox) for oldmbox in self.oldMailboxes)
+			wanted = set(newmbox for _, newmbox, _ in pending)
+			wanted.update(mbox for mbox in self.newMailboxes if mbox not in migrated)
+		else:
+			wanted = set(self.__modified)
+			if self.syncState is not None and self.source is None:
+				# Synced by an earlier run that stopped before reconstructing
+				wanted.update(newmbox for _, newmbox, _ in pending if newmbox not in self.__synced)
+
+		mailboxes = [mbox for mbox in self.newMailboxes if mbox in wanted]
+		logging.info('reconstructing %d of %d mailboxes', len(mailboxes), len(self.newMailboxes))
+		self.reconstructMailboxes(mailboxes)
+		self._mailboxesDone('reconstruct', pending)
+
+	def reconstructMailboxes(self, mailboxes):
+		""" Reconstructs exactly these mailboxes: in batches with the local
+			reconstruct binary, or pipelined and split over the imap session
+			and reconstructSessions
+		"""
+		if not mailboxes:
+			return
+		if self.localReconstruct:
+			stdout = None if logging.getLogger().getEffectiveLevel() == logging.DEBUG else subprocess.PIPE
+			for i in range(0, len(mailboxes), self.reconstructBatch):
+				subprocess.check_call(
+					[os.path.join(self._cyrusBin, 'reconstruct')] + mailboxes[i:i + self.reconstructBatch],
+					stdout=stdout
+				)
+			return
+
+		sessions = [self.imap] + self.reconstructSessions
+		if len(sessions) == 1:
+			self.imap.reconstructall(mailboxes)
+			return
+		errors = []
+		def run(session, batch):
+			try:
+				session.reconstructall(batch)
+			except Exception:
+				errors.append(sys.exc_info())
+		threads = [
+			threading.Thread(target=logcontext.inherit(run), args=(session, mailboxes[i::len(sessions)]))
+			for i, session in enumerate(sessions) if mailboxes[i::len(sessions)]
+		]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		if errors:
+			raise errors[0][0], errors[0][1], errors[0][2]
 
 	def oldMailboxNameToNew(self, oldmbox):
 		""" Converts old mailbox name to new mailbox.
@@ -162,6 +401,151 @@ class CyrusMigrate(object):
 
 		return newmbox_name + subfolders + ('@' + newmbox_domain if newmbox_domain else '')
 
+	def aclUserIdToNew(self, userid):
+		""" Converts a user id from an old mailbox ACL for the new mailbox.
+			The old owner becomes the new owner. When moving from a local
+			to a virtual domain mailbox, other local user ids are assumed
+			to have moved into the new domain as well.
+			Eg (user.bob -> user.brian@example.com):
+				bob -> brian@example.com
+				-alice -> -alice@example.com
+				anyone -> anyone
+		"""
+		prefix = '-' if userid.startswith('-') else ''
+		userid = userid[len(prefix):]
+		_, oldDomain = self._mailboxParts(self.oldmbox)
+		_, newDomain = self._mailboxParts(self.newmbox)
+
+		if userid == self._mailboxOwner(self.oldmbox):
+			userid = self._mailboxOwner(self.newmbox) or userid
+		elif newDomain and not oldDomain and '@' not in userid \
+				and userid not in ('anyone', 'anonymous') and not userid.startswith('group:'):
+			userid = '%s@%s' % (userid, newDomain)
+		return prefix + userid
+
+	def convertAcls(self):
+		""" Copies the ACLs of every old mailbox onto its new mailbox,
+			using one pipelined snapshot and one pipelined restore.
+			ACLs are kept in mailboxes.db, so the old mailboxes must be
+			known to the imap server (ie no rootPath)
+		"""
+		if self.rootPath:
+			logging.warning('Cannot convert ACLs of offline mailboxes in %r', self.rootPath)
+			return
+
+		snapshot = self._oldImap.aclsnapshot(mailboxes=self.oldMailboxes)
+		newSnapshot = {}
+		for oldmbox, acl in snapshot.items():
+			newSnapshot[self.oldMailboxNameToNew(oldmbox)] = acl
+		logging.info('converting ACLs of %d mailboxes', len(newSnapshot))
+		self.imap.aclrestore(newSnapshot, rewrite=self.aclUserIdToNew)
+
+	@staticmethod
+	def _annotationFromRecord(key, data):
+		""" Decodes an annotations.db record into (mailbox, entry, userid, value).
+			The key is 'mailbox\0entry\0userid\0' (userid empty for shared entries).
+			The data is the value size as a network order unsigned long, which
+			is 4 or 8 bytes depending on the platform that wrote it, then the
+			nul terminated value, content type and modification time.
+		"""
+		mailbox, entry, userid = key.split('\0')[:3]
+		size = struct.unpack('>I', data[:4])[0]
+		offset = 4
+		if data[4:8] == '\0\0\0\0' and data[8 + size:9 + size] == '\0':
+			offset = 8
+		value = data[offset:offset + size]
+		return CyrusMigrate._mboxFromSubFormat(mailbox), entry, userid, value
+
+	def oldAnnotations(self):
+		""" Returns shared annotations of the old mailboxes as {mailbox: {entry: value}}.
+			With rootPath the old annotations.db is read offline, otherwise
+			they come from a single wildcard GETANNOTATION
+		"""
+		oldMailboxes = set(self.oldMailboxes)
+		annotations = {}
+
+		if self.rootPath:
+			dbFile = os.path.join(self._oldConfigRoot, 'annotations.db')
+			if not os.path.exists(dbFile):
+				logging.warning('Cannot find annotations file %r', dbFile)
+				return annotations
+			with open(dbFile, 'rb') as fp:
+				skiplist.get_header(fp)
+				for key, data in skiplist.iterkeys(fp):
+					mbox, entry, userid, value = self._annotationFromRecord(key, data)
+					if mbox in oldMailboxes and not userid:
+						annotations.setdefault(mbox, {})[entry] = value
+		else:
+			mailbox, domain = self._mailboxParts(self.oldmbox)
+			pattern = mailbox + '*' + ('@' + domain if domain else '')
+			for mbox, entries in self._oldImap.getannotation(pattern).items():
+				if mbox in oldMailboxes:
+					annotations[mbox] = entries
+
+		for mbox, entries in annotations.items():
+			for entry in self._readOnlyAnnotations:
+				entries.pop(entry, None)
+			if not entries:
+				del annotations[mbox]
+		return annotations
+
+	def convertAnnotations(self):
+		""" Replays the old mailbox annotations onto the new mailboxes
+			with pipelined SETANNOTATION
+		"""
+		newAnnotations = {}
+		for oldmbox, entries in self.oldAnnotations().items():
+			newAnnotations[self.oldMailboxNameToNew(oldmbox)] = entries
+		logging.info('converting annotations of %d mailboxes', len(newAnnotations))
+		if newAnnotations:
+			self.imap.setannotations(newAnnotations)
+
+	@property
+	def canRename(self):
+		""" True if the old tree can be moved with a server-side RENAME: the old
+			mailboxes are live on this server and none of the new ones exist yet
+		"""
+		return not self.rootPath and self.source is None \
+			and bool(self.oldMailboxes) and not self.newMailboxes
+
+	def renameMailboxes(self):
+		""" Moves the old mailboxes to their new names on the server.
+			A user tree moves with one (recursive) RENAME; shared trees
+			are renamed one folder at a time, deepest first
+		"""
+		if self._isUserMigration:
+			renames = [self.oldmbox]
+		else:
+			renames = sorted(self.oldMailboxes, key=lambda mbox: mbox.count('.'), reverse=True)
+
+		for oldmbox in renames:
+			newmbox = self.oldMailboxNameToNew(oldmbox)
+			logging.info('renaming mailbox %r to %r', oldmbox, newmbox)
+			self.imap.rename(oldmbox, newmbox)
+
+		self.__newMailboxes = None
+
+	def _convertRenamedConfig(self):
+		""" A renamed mailbox keeps its unique id, so the old seen file is still
+			valid as is, and subscriptions only need the names converted.
+			Cyrus may have moved both already (allowusermoves), in which
+			case there is nothing left to do
+		"""
+		if not self._isUserMigration:
+			return
+
+		if os.path.exists(self.oldImapConfigPath('.sub')):
+			with self._timed('subscriptions'):
+				self.convertSubscription()
+
+		oldSeenFile = self.oldImapConfigPath('.seen')
+		newSeenFile = self.newImapConfigPath('.seen')
+		if os.path.exists(oldSeenFile) and not os.path.exists(newSeenFile):
+			with self._timed('seen state'):
+				self._createDirectories(os.path.dirname(newSeenFile))
+				shutil.copy2(oldSeenFile, newSeenFile)
+				self._chown(newSeenFile, 'cyrus', 'mail')
+
 	def createNewMailboxes(self):
 		""" Creates new mailboxes based on old mailbox tree.
 			This is safe to call multiple times as we check
@@ -169,14 +553,16 @@ class CyrusMigrate(object):
 		"""
 
 		for mbox in self.oldMailboxes:
-			newmbox = self.oldMailboxNameToNew(mbox)
-			if newmbox not in self.newMailboxes:
-				logging.info('creating mailbox %r', newmbox)
-				self.imap.cm(newmbox)
-				# Put new mailbox in out list
-				self.__newMailboxes.append(newmbox)
-			else:
-				logging.debug('mailbox %r exists', newmbox)
+			self.createNewMailbox(self.oldMailboxNameToNew(mbox))
+
+	def createNewMailbox(self, newmbox):
+		if newmbox not in self.newMailboxes:
+			logging.info('creating mailbox %r', newmbox)
+			self.imap.cm(newmbox)
+			# Put new mailbox in out list
+			self.__newMailboxes.append(newmbox)
+		else:
+			logging.debug('mailbox %r exists', newmbox)
 
 	def oldImapPartitionPath(self, mbox):
 		return self.__imapPartitionPath(self._oldPartitionRoot, mbox)
@@ -234,53 +620,377 @@ class CyrusMigrate(object):
 			)
 		return os.path.join(path, username + suffix)
 
-	def syncFiles(self):
-		""" Sync files across from old to new, one directory at a time (non-recursive).
-			We use the --delete option to prune deleted files from the destination path
+	def copyMessages(self):
+		""" Copies messages from the source server over IMAP, for when the old
+			spool cannot be reached. Resumes from stateFile after an interruption,
+			unless restart was given
 		"""
+		copier = imapcopy.ImapCopy(self.source, self.imap, stateFile=self.stateFile, restart=self.restart)
+		return copier([(oldmbox, self.oldMailboxNameToNew(oldmbox)) for oldmbox in self.oldMailboxes])
+
+	def syncFiles(self, plan=None):
+		""" Sync files across from old to new, one directory at a time (non-recursive),
+			pruning deleted files from the destination path. The largest mailboxes
+			go first, as measured by plan if given (see plan()), so that the last
+			thread to finish is not left with the biggest folder
+		"""
+		if self.source is not None:
+			self.copyMessages()
+			# APPEND keeps the indexes up to date, nothing to reconstruct
+			self.__synced = self.__modified = set()
+			return
+
+		if plan is not None:
+			pending = [(mailbox.oldmbox, mailbox.newmbox, mailbox.fingerprint) for mailbox in plan.syncs]
+		else:
+			pending = sorted(self._pendingMailboxes('sync'), key=self._mailboxBytes, reverse=True)
+		self.__synced = set(newmbox for _, newmbox, _ in pending)
+		if len(pending) < len(self.oldMailboxes):
+			logging.info('%d of %d mailboxes unchanged since the last sync', len(self.oldMailboxes) - len(pending), len(self.oldMailboxes))
+
+		if self.syncMethod == 'rsync':
+			self._rsyncFiles(pending)
+			self._mailboxesDone('sync', pending)
+			# rsync does not tell what it changed
+			self.__modified = set(newmbox for _, newmbox, _ in pending)
+			return
 
+		pairs = [self._syncPair(oldmbox, newmbox) for oldmbox, newmbox, _ in pending]
+		engine = self._syncEngine()
+		stats = engine(pairs)
+		self._mailboxesDone('sync', pending)
+		self._logSyncStats(len(pairs), stats)
+		self.__modified = set(
+			newmbox for (_, newmbox, _), pair in zip(pending, pairs) if pair[1] in engine.modified
+		)
+
+	def _mailboxBytes(self, item):
+		mailbox = self.spoolInventory.get(item[0])
+		return mailbox.bytes if mailbox else 0
+
+	def plan(self, reconstruct=False):
+		""" Returns a migrationplan.MigrationPlan of what calling this migration
+			would do: the mailboxes to create, the files and bytes to sync and
+			delete per mailbox, the mailboxes to reconstruct and the
+			subscription and seen entries to convert. Nothing is changed
+		"""
+		newMailboxes = set(self.newMailboxes)
+		syncPending = dict((oldmbox, fp) for oldmbox, _, fp in self._pendingMailboxes('sync'))
+		reconstructPending = set()
+		if reconstruct:
+			reconstructPending = set(oldmbox for oldmbox, _, _ in self._pendingMailboxes('reconstruct'))
+		engine = self._syncEngine()
+
+		mailboxes = []
 		for oldmbox in self.oldMailboxes:
-			source = self.oldImapPartitionPath(oldmbox) + os.path.sep # need trailing slash for rsync
-			newbmox = self.oldMailboxNameToNew(oldmbox)
-			target = self.newImapPartitionPath(newbmox)
-			logging.debug('Syncing files from %r to %r', source, target)
+			newmbox = self.oldMailboxNameToNew(oldmbox)
+			mailbox = migrationplan.MailboxPlan(
+				oldmbox, newmbox, create=newmbox not in newMailboxes, sync=oldmbox in syncPending,
+				fingerprint=syncPending.get(oldmbox)
+			)
+			if self.source is None:
+				if mailbox.sync:
+					mailbox.files, mailbox.bytes, mailbox.deletes = self._syncCost(engine, oldmbox, newmbox)
+				else:
+					mailbox.files = mailbox.bytes = mailbox.deletes = 0
+			# As reconstruct() after a sync: the mailboxes whose files change,
+			# and those an earlier run synced without reconstructing
+			if self.source is None:
+				mailbox.reconstruct = bool(mailbox.files or mailbox.deletes) or \
+					(self.syncState is not None and oldmbox in reconstructPending and not mailbox.sync)
+			mailboxes.append(mailbox)
+
+		reconstructs = []
+		if reconstruct:
+			reconstructs = [mailbox.newmbox for mailbox in mailboxes if mailbox.reconstruct]
+
+		subscriptions = seen = None
+		if self._isUserMigration and self.source is None:
+			if os.path.exists(self.oldImapConfigPath('.sub')):
+				# As convertSubscription() would write them, once the creates are done
+				planned = self.newMailboxes + [mailbox.newmbox for mailbox in mailboxes]
+				subscriptions = len([newmbox for _, newmbox in self._subscribedMailboxes(planned) if newmbox])
+			if os.path.exists(self.oldImapConfigPath('.seen')):
+				upToDate, _ = self._seenUpToDate()
+				seen = 0 if upToDate else self._seenEntries()
+
+		return migrationplan.MigrationPlan(
+			self.oldmbox, self.newmbox, mailboxes, reconstructs, subscriptions=subscriptions, seen=seen,
+			overImap=self.source is not None
+		)
+
+	def _syncCost(self, engine, oldmbox, newmbox):
+		""" Returns the (files, bytes) the sync would transfer and the files it would delete
+		"""
+		mailbox = self.spoolInventory.get(oldmbox)
+		if mailbox:
+			sourceFiles = mailbox.files
+		else:
+			sourceFiles, _ = engine.manifest(self.oldImapPartitionPath(oldmbox))
+		target = self.newImapPartitionPath(newmbox)
+		targetFiles = engine.manifest(target)[0] if os.path.isdir(target) else {}
+
+		changed = [st for name, st in sourceFiles.items() if engine.changed(st, targetFiles.get(name))]
+		deletes = len([name for name in targetFiles if name not in sourceFiles])
+		return len(changed), sum(st.st_size for st in changed), deletes
+
+	def _syncEngine(self):
+		return syncengine.SyncEngine(
+			threads=self.syncThreads, mode=self._syncMethods[self.syncMethod],
+			shardSize=self.shardSize, shardThreads=self.mailboxThreads, deviceJobs=self.deviceJobs,
+			deviceLimits=dict((syncengine.device(path), jobs) for path, jobs in self.deviceLimits.items()),
+			readOrder=self.readOrder, rateLimits=self.rateLimits
+		)
+
+	def _syncPair(self, oldmbox, newmbox):
+		""" (source, target, manifest) to hand to the sync engine
+		"""
+		# The files were listed by the inventory already
+		mailbox = self.spoolInventory.get(oldmbox)
+		manifest = (mailbox.files, mailbox.subdirs) if mailbox else None
+		return self.oldImapPartitionPath(oldmbox), self.newImapPartitionPath(newmbox), manifest
 
-			# Write the new skiplist file to new location
-			stdout = None if logging.getLogger().getEffectiveLevel() == logging.DEBUG else subprocess.PIPE
-			subprocess.check_call([
-				'rsync',
-				'--verbose',
-				'--perms',
-				'--times',
-				'--group',
-				'--owner',
-				'--dirs',
-				'--exclude=cyrus.*',
-				'--delete',
-				source,
-				target
-			], stdout=stdout)
+	@staticmethod
+	def _logSyncStats(count, stats):
+		logging.info(
+			'synced %d mailboxes: %d files copied (%d bytes), %d linked, %d cloned, %d relinked, %d deleted, %d unchanged',
+			count, stats['copied'], stats['bytes'], stats['linked'], stats['cloned'],
+			stats['relinked'], stats['deleted'], stats['unchanged']
+		)
+
+	def _rsyncFiles(self, pending):
+		""" As syncFiles, with one rsync per mailbox.
+			We use the --delete option to prune deleted files from the destination path
+		"""
+		for oldmbox, newbmox, _ in pending:
+			self._rsyncMailbox(oldmbox, newbmox)
+
+	def _rsyncMailbox(self, oldmbox, newbmox):
+		source = self.oldImapPartitionPath(oldmbox) + os.path.sep # need trailing slash for rsync
+		target = self.newImapPartitionPath(newbmox)
+		logging.debug('Syncing files from %r to %r', source, target)
+
+		# Write the new skiplist file to new location
+		stdout = None if logging.getLogger().getEffectiveLevel() == logging.DEBUG else subprocess.PIPE
+		subprocess.check_call([
+			'rsync',
+			'--verbose',
+			'--perms',
+			'--times',
+			'--group',
+			'--owner',
+			'--dirs',
+			'--exclude=cyrus.*',
+			'--delete',
+			source,
+			target
+		], stdout=stdout)
+
+	def migratePipelined(self, reconstruct=False):
+		""" Creates, syncs and (optionally) reconstructs the mailboxes as a
+			pipeline instead of phase after phase: a mailbox goes on to be
+			synced as soon as it is created, and to be reconstructed as soon
+			as it is synced, so the imap round trips overlap the disk copies.
+			With localReconstruct the reconstructs are run reconstructBatch
+			mailboxes at a time, the rest once the pipeline has drained.
+			Stages are joined by bounded queues. Creates go out parents first
+			in one thread; creates and reconstructs share the imap session, so
+			they take turns with a lock. Sync runs syncThreads workers, each
+			taking the largest created mailbox waiting, so the order is
+			largest first within pipelineDepth mailboxes. As with
+			reconstruct(), only mailboxes whose files changed are
+			reconstructed.
+
+			The old spool is read as the pipeline runs (see
+			_discoverOldMailboxes), so the first mailboxes are created and
+			synced while the rest of the tree is still being listed
+		"""
+		# Filled in as mailboxes are found, before they are queued. The
+		# sync state is only used from this thread, as sqlite requires
+		syncPending = {}
+		reconstructPending = {}
+		imapLock = threading.Lock()
+		engine = self._syncEngine()
+		stats = Counter()
+		statsLock = threading.Lock()
+		synced = []
+		reconstructed = []
+		# (newmbox, reconstructed entry or None) for the local reconstruct
+		localBatch = []
+		errors = []
+
+		def create(oldmbox):
+			newmbox = self.oldMailboxNameToNew(oldmbox)
+			with imapLock:
+				self.createNewMailbox(newmbox)
+			return oldmbox, newmbox
+
+		def sync(item):
+			oldmbox, newmbox = item
+			modified = False
+			if oldmbox in syncPending:
+				if self.syncMethod == 'rsync':
+					self._rsyncMailbox(oldmbox, newmbox)
+					modified = True
+				else:
+					result = engine.syncLimited(*self._syncPair(oldmbox, newmbox))
+					modified = any(result[name] for name in engine.changes)
+					with statsLock:
+						stats.update(result)
+				synced.append((oldmbox, newmbox, syncPending[oldmbox]))
+			return oldmbox, newmbox, modified
+
+		def reconstructLocal():
+			self.reconstructMailboxes([newmbox for newmbox, _ in localBatch])
+			reconstructed.extend([entry for _, entry in localBatch if entry])
+			del localBatch[:]
+
+		def reconstructMailbox(item):
+			oldmbox, newmbox, modified = item
+			entry = (oldmbox, newmbox, reconstructPending[oldmbox]) if oldmbox in reconstructPending else None
+			# Or synced by an earlier run that stopped before reconstructing
+			if modified or (entry and self.syncState is not None and oldmbox not in syncPending):
+				logging.debug('reconstructing %r', newmbox)
+				if self.localReconstruct:
+					localBatch.append((newmbox, entry))
+					if len(localBatch) >= self.reconstructBatch:
+						reconstructLocal()
+					return
+				with imapLock:
+					self.imap.reconstruct(newmbox, recursive=False)
+			if entry:
+				reconstructed.append(entry)
+
+		createQueue = Queue.Queue(self.pipelineDepth)
+		syncQueue = _LargestFirstQueue(self.pipelineDepth, self._mailboxBytes)
+		reconstructQueue = Queue.Queue(self.pipelineDepth) if reconstruct else None
+		syncWorkers = {'left': max(self.syncThreads, 1), 'lock': threading.Lock()}
+		# Stages log as the caller's job, see logcontext
+		stage = logcontext.inherit(self._pipelineStage)
+		threads = [
+			threading.Thread(target=stage, args=(create, createQueue, syncQueue, errors))
+		] + [
+			threading.Thread(target=stage, args=(sync, syncQueue, reconstructQueue, errors, syncWorkers))
+			for _ in range(syncWorkers['left'])
+		]
+		if reconstruct:
+			threads.append(threading.Thread(
+				target=stage, args=(reconstructMailbox, reconstructQueue, None, errors)
+			))
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+
+		try:
+			for oldmbox in self._discoverOldMailboxes():
+				newmbox = self.oldMailboxNameToNew(oldmbox)
+				pending, fingerprint = self._pending('sync', oldmbox, newmbox)
+				if pending:
+					syncPending[oldmbox] = fingerprint
+				if reconstruct:
+					pending, fingerprint = self._pending('reconstruct', oldmbox, newmbox)
+					if pending:
+						reconstructPending[oldmbox] = fingerprint
+				createQueue.put(oldmbox)
+		except Exception:
+			errors.append(sys.exc_info())
+		createQueue.put(None)
+		for thread in threads:
+			thread.join()
+		engine.close()
+
+		self._mailboxesDone('sync', synced)
+		if self.syncMethod != 'rsync':
+			self._logSyncStats(len(synced), stats)
+		if errors:
+			raise errors[0][0], errors[0][1], errors[0][2]
+
+		if reconstruct:
+			if localBatch:
+				reconstructLocal()
+			self._mailboxesDone('reconstruct', reconstructed)
+
+	def _discoverOldMailboxes(self):
+		""" Yields the old mailboxes, parents before their subfolders. From
+			the old spool each one comes as soon as its directory was read,
+			oldMailboxes and spoolInventory filling in as the tree is. Over
+			IMAP the one LIST gives them all at once
+		"""
+		if not self.rootPath or self.__oldMailboxes is not None or self.__spoolInventory is not None:
+			for oldmbox in sorted(self.oldMailboxes, key=lambda mbox: self._mailboxParts(mbox)[0].split('.')):
+				yield oldmbox
+			return
+
+		inventory = spool.SpoolInventory(self.oldmbox, self.oldImapPartitionPath(self.oldmbox), scan=False)
+		self.__spoolInventory = inventory
+		found = []
+		try:
+			for mailbox in inventory.scan():
+				found.append(mailbox.mailbox)
+				yield mailbox.mailbox
+		except:
+			self.__spoolInventory = None
+			raise
+		self.__oldMailboxes = found
+
+	@staticmethod
+	def _pipelineStage(work, inbox, outbox, errors, workers=None):
+		""" Runs work on each item of inbox until the None end marker, putting
+			the results into outbox. After a failure anywhere the rest is only
+			drained, so no stage blocks on a full queue. A stage of several
+			workers (workers holds how many are left and a lock) hands the
+			end marker on to its siblings, the last one out passes it down
+		"""
+		for item in iter(inbox.get, None):
+			if errors:
+				continue
+			try:
+				result = work(item)
+			except Exception:
+				errors.append(sys.exc_info())
+				continue
+			if outbox is not None:
+				outbox.put(result)
+
+		if workers is not None:
+			inbox.put(None)
+			with workers['lock']:
+				workers['left'] -= 1
+				last = workers['left'] == 0
+			if not last:
+				return
+		if outbox is not None:
+			outbox.put(None)
+
+	@property
+	def oldSubscriptions(self):
+		""" The old mailboxes in the old subscription file, read once per run
+		"""
+		if self.__oldSubscriptions is None:
+			with open(self.oldImapConfigPath('.sub'), 'r') as f:
+				self.__oldSubscriptions = [
+					self._mboxFromSubFormat(line.strip('\t\n')) for line in f if line.strip('\t\n')
+				]
+		return self.__oldSubscriptions
 
 	def mailboxIdMap(self):
 		""" Returns a dict containing map of old to new mailbox ids.
 			This uses the old subscription file to get all mailboxes 
 			for the user. Using self.oldMailboxes alone will not 
-			give us shared folders
+			give us shared folders. Built once per run
 		"""
-		# Get top level mailbox - this is not included in the subscription file
-		mailboxMap = {}
-		allOldMailboxes = []
-		oldSubFile = self.oldImapConfigPath('.sub')
+		if self.__mailboxIdMap is None:
+			self.__mailboxIdMap = self._buildMailboxIdMap()
+		return self.__mailboxIdMap
 
-		with open(oldSubFile, 'r') as f:
-			for line in f:
-				oldmbox = self._mboxFromSubFormat(line.strip('\t\n'))
-				allOldMailboxes.append(oldmbox)
+	def _buildMailboxIdMap(self):
+		mailboxMap = {}
 
-		# Get all unique mailboxes from sub file and usual oldMailbox list
-		for oldmbox in set(allOldMailboxes + self.oldMailboxes):
+		# Get all unique mailboxes from sub file and usual oldMailbox list,
+		# the top level mailbox is not included in the subscription file
+		for oldmbox in set(self.oldSubscriptions + self.oldMailboxes):
 			path = self.oldImapPartitionPath(oldmbox)
-			if not os.path.exists(path):
+			if oldmbox not in self.spoolInventory and not os.path.exists(path):
 				logging.warning('Cannot find old mailbox path %r', path)
 				continue
 			oldmboxId = self._extractMailboxId(path)
@@ -297,10 +1007,19 @@ class CyrusMigrate(object):
 		""" Gets the magic mailbox identifier from the cyrus.header file
 		"""
 		headerFile = os.path.join(path, 'cyrus.header')
+		st = os.stat(headerFile)
+		cached = self._headerCache.get(headerFile)
+		if cached and cached[:2] == (st.st_mtime, st.st_ino):
+			return cached[2]
+
 		with open(headerFile, 'r') as f:
 			assert f.read(len(self._headerMagic)) == self._headerMagic
 			line = f.readline()
-		return line.split('\t')[1].strip()
+		mboxId = line.split('\t')[1].strip()
+		if len(self._headerCache) >= self.headerCacheSize:
+			self._headerCache.clear()
+		self._headerCache[headerFile] = (st.st_mtime, st.st_ino, mboxId)
+		return mboxId
 
 	def _chown(self, path, user, group):
 		""" Convenience function to change file ownership on a
@@ -322,42 +1041,65 @@ class CyrusMigrate(object):
 				os.mkdir(path, 0750)
 				self._chown(path, 'cyrus', 'mail')
 
+	def _seenFingerprint(self):
+		""" The seen conversion depends on the old seen file and,
+			through the mailbox ids, on every old mailbox
+		"""
+		st = os.stat(self.oldImapConfigPath('.seen'))
+		return [st.st_size, st.st_mtime, sorted([mbox, self.fingerprint(mbox)] for mbox in self.oldMailboxes)]
+
+	def _seenUpToDate(self):
+		""" Returns whether the new seen file was converted from the current
+			old one already, and the fingerprint to record once it is
+		"""
+		if self.syncState is None:
+			return False, None
+		fingerprint = self._seenFingerprint()
+		return os.path.exists(self.newImapConfigPath('.seen')) and \
+			self.syncState.unchanged('seen', self.oldmbox, self.newmbox, fingerprint), fingerprint
+
+	def _seenEntries(self):
+		with open(self.oldImapConfigPath('.seen'), 'rb') as fp:
+			skiplist.get_header(fp)
+			return len(set(key for key, _ in skiplist.iterkeys(fp)))
+
 	def convertSeen(self):
 		if not self._isUserMigration:
 			return
 
-		mailboxIdMap = self.mailboxIdMap()
-
 		oldSeenFile = self.oldImapConfigPath('.seen')
 		newSeenFile = self.newImapConfigPath('.seen')
 		assert os.path.exists(oldSeenFile)
 
+		upToDate, fingerprint = self._seenUpToDate()
+		if upToDate:
+			logging.debug('seen state of %r unchanged since last run', self.oldmbox)
+			return
+
+		mailboxIdMap = self.mailboxIdMap()
+
+		# Records are remapped as they are read, later ones for the same
+		# mailbox (the log part of the old db) replacing earlier ones
+		seen = {}
+		oldIds = set()
 		with open(oldSeenFile, 'rb') as fp:
 			skiplist.get_header(fp)
-			values, keys = skiplist.getkeys(fp)
-
-		try:
-			numConverted = 0
-			with tempfile.NamedTemporaryFile(delete=False) as tmpFile:
-				for v in values:
-					if v in mailboxIdMap:
-						numConverted += 1
-						tmpFile.file.write('%s\t%s\n' % (mailboxIdMap.get(v, v), keys[v]))
-
-			# Write the new skiplist file to new location
-			stdout = None if logging.getLogger().getEffectiveLevel() == logging.DEBUG else subprocess.PIPE
-			subprocess.check_call([
-				os.path.join(self._cyrusBin, 'cvt_cyrusdb'),
-				tmpFile.name,
-				'flat',
-				newSeenFile,
-				'skiplist'
-			], stdout=stdout)
-			self._chown(newSeenFile, 'cyrus', 'mail')
-		finally:
-			if numConverted != len(values):
-				logging.warning('Only converted %d/%d mailbox ids for %r', numConverted, len(values), newSeenFile)
-			os.unlink(tmpFile.name)
+			for oldId, data in skiplist.iterkeys(fp):
+				oldIds.add(oldId)
+				if oldId in mailboxIdMap:
+					seen[mailboxIdMap[oldId]] = data
+
+		if len(seen) != len(oldIds):
+			logging.warning('Only converted %d/%d mailbox ids for %r', len(seen), len(oldIds), newSeenFile)
+
+		# Written straight into place as a skiplist db, no cvt_cyrusdb round trip
+		self._createDirectories(os.path.dirname(newSeenFile))
+		skiplist.writefile(
+			newSeenFile, sorted(seen.items()),
+			uid=pwd.getpwnam('cyrus').pw_uid, gid=grp.getgrnam('mail').gr_gid
+		)
+		if self.syncState is not None:
+			self.syncState.done('seen', [(self.oldmbox, self.newmbox, fingerprint)])
 
 	@property
 	def _isUserMigration(self):
@@ -391,41 +1133,359 @@ class CyrusMigrate(object):
 
 		oldSubFile = self.oldImapConfigPath('.sub')
 		newSubFile = self.newImapConfigPath('.sub')
-		allMailboxes = self.imap.lm()
 		self._createDirectories(os.path.dirname(newSubFile))
 
-		with open(oldSubFile, 'r') as inFile:
-			with open(newSubFile, 'w') as outFile:
-				for line in inFile:
-					oldmbox = self._mboxFromSubFormat(line.strip('\t\n'))
-					newmbox = self.oldMailboxNameToNew(oldmbox)
-
-					# Ensure the old mailbox exists - ignore if not
-					if newmbox in allMailboxes:
-						# Write new seen file
-						outFile.write('%s\t\n' % self._mboxToSubFormat(newmbox))
-					else:
-						logging.warning('Cannot find mailbox %r in seen file %r', oldmbox, inFile.name)
+		with open(newSubFile, 'w') as outFile:
+			for oldmbox, newmbox in self._subscribedMailboxes(self.newMailboxes):
+				if newmbox is not None:
+					# Write new seen file
+					outFile.write('%s\t\n' % self._mboxToSubFormat(newmbox))
+				else:
+					logging.warning('Cannot find mailbox %r in seen file %r', oldmbox, oldSubFile)
 
 		self._chown(newSubFile, 'cyrus', 'mail')
 
+	def _subscribedMailboxes(self, newMailboxes):
+		""" Yields (oldmbox, newmbox) for each old subscription, newmbox being
+			None if the new mailbox is neither in newMailboxes nor on the
+			server. Folders outside the migrated tree (eg shared) are looked
+			up one at a time
+		"""
+		newMailboxes = set(newMailboxes)
+		for oldmbox in self.oldSubscriptions:
+			newmbox = self.oldMailboxNameToNew(oldmbox)
+			if newmbox in newMailboxes or self.imap.lm(newmbox):
+				yield oldmbox, newmbox
+			else:
+				yield oldmbox, None
+
+
+# Per process state of a migrateAccounts() worker
+_worker = {}
+
+def _initWorker(url, user, password, sourceUrl, rateLimits=None, reconstructSessions=1):
+	""" Pool initializer. rateLimits is inherited, so all workers share
+		its buckets. The login waits for the first account: a failure
+		raised here would make the pool respawn workers forever
+	"""
+	_worker['login'] = (url, user, password, sourceUrl, reconstructSessions)
+	_worker['rateLimits'] = rateLimits
+
+def _workerSession():
+	""" Returns the worker's (imap, source, reconstruct) sessions, logging
+		in again if a failed account dropped them. reconstruct are the
+		extra sessions the reconstructs are spread over
+	"""
+	import cyruslib
+	if 'imap' not in _worker:
+		url, user, password, sourceUrl, reconstructSessions = _worker['login']
+		commands = _worker['rateLimits'] and _worker['rateLimits'].commands
+		# One SSLContext per worker process, shared by all its sessions
+		context = _worker.setdefault('context', cyruslib.sslcontext())
+		imap = cyruslib.CYRUS(url, ssl_context=context, ratelimit=commands)
+		imap.login(user, password)
+		source = None
+		if sourceUrl:
+			source = cyruslib.CYRUS(sourceUrl, ssl_context=context, ratelimit=commands)
+			source.login(user, password)
+		_worker['imap'], _worker['source'] = imap, source
+		_worker['reconstruct'] = []
+		for _ in range(reconstructSessions - 1):
+			session = cyruslib.CYRUS(url, ssl_context=context, ratelimit=commands)
+			session.login(user, password)
+			_worker['reconstruct'].append(session)
+	return _worker['imap'], _worker['source'], _worker['reconstruct']
+
+def _dropWorkerSession():
+	sessions = [_worker.pop('imap', None), _worker.pop('source', None)] + _worker.pop('reconstruct', [])
+	for session in sessions:
+		try:
+			if session is not None:
+				session.logout()
+		except Exception:
+			pass
+
+def _migrateAccount(task):
+	""" Pool task: migrates one account. Never raises, so one bad account
+		cannot stop the batch. Returns (oldmbox, newmbox, error, seconds),
+		error being None on success
+	"""
+	oldmbox, newmbox, settings, options = task
+	start = time.time()
+	error = None
+	migration = None
+	try:
+		imap, source, reconstructSessions = _workerSession()
+		migration = CyrusMigrate(
+			imap, oldmbox, newmbox, source=source, rateLimits=_worker['rateLimits'],
+			reconstructSessions=reconstructSessions, **settings
+		)
+		migration(**options)
+	except Exception as e:
+		logging.exception('Migrating %r to %r failed', oldmbox, newmbox)
+		error = str(e) or e.__class__.__name__
+		# The session may be in any state now, start the next account afresh
+		_dropWorkerSession()
+	finally:
+		if migration is not None:
+			migration.close()
+	return oldmbox, newmbox, error, time.time() - start
+
+def readAccounts(fp):
+	""" Reads 'oldmbox,newmbox' lines, skipping blank lines and # comments
+		Eg:
+			user.bob,user.bob@example.com
+	"""
+	accounts = []
+	for row in csv.reader(fp):
+		row = [field.strip() for field in row]
+		if not row or not row[0] or row[0].startswith('#'):
+			continue
+		assert len(row) == 2, 'Expected oldmbox,newmbox, got %r' % ','.join(row)
+		accounts.append(tuple(row))
+	return accounts
+
+def migrateAccounts(accounts, url, user, password, jobs=4, sourceUrl=None,
+		rootPath=None, stateDir=None, verbose=False, syncMethod='native', syncThreads=4, syncDb=None,
+		shardSize=10000, mailboxThreads=4, deviceJobs=None, deviceLimits=None, readOrder='extent',
+		rateLimits=None, localReconstruct=False, reconstructSessions=1, restart=False, **options):
+	""" Migrates (oldmbox, newmbox) pairs with a pool of jobs processes,
+		each with its own imap session(s), reconstructSessions of them to
+		the target. options are passed on to CyrusMigrate.__call__. With
+		stateDir each account gets its own resume file there. All workers
+		draw from the buckets of rateLimits (see ratelimit). Returns
+		(oldmbox, newmbox, error, seconds) for each account, in the order given
+	"""
+	# Imported before the workers fork, so they add to its handshake totals
+	import cyruslib
+	tasks = []
+	for oldmbox, newmbox in accounts:
+		settings = {
+			'rootPath': rootPath,
+			'verbose': verbose,
+			'syncMethod': syncMethod,
+			'syncThreads': syncThreads,
+			'syncDb': syncDb,
+			'shardSize': shardSize,
+			'mailboxThreads': mailboxThreads,
+			'deviceJobs': deviceJobs,
+			'deviceLimits': deviceLimits,
+			'readOrder': readOrder,
+			'localReconstruct': localReconstruct,
+			'restart': restart,
+		}
+		if stateDir:
+			settings['stateFile'] = os.path.join(stateDir, oldmbox + '.json')
+		tasks.append((oldmbox, newmbox, settings, options))
+
+	pool = multiprocessing.Pool(jobs, _initWorker, (url, user, password, sourceUrl, rateLimits, reconstructSessions))
+	results = {}
+	try:
+		for result in pool.imap_unordered(_migrateAccount, tasks):
+			oldmbox, newmbox, error, seconds = result
+			if error:
+				logging.error('%r -> %r failed after %.1fs: %s', oldmbox, newmbox, seconds, error)
+			else:
+				logging.info('%r -> %r migrated in %.1fs', oldmbox, newmbox, seconds)
+			results[oldmbox, newmbox] = result
+	finally:
+		pool.close()
+		pool.join()
+		logHandshakes()
+	return [results[account] for account in accounts]
+
+def logHandshakes():
+	""" Logs the TLS handshakes of all sessions of this process and its workers
+	"""
+	import cyruslib
+	if cyruslib.HANDSHAKES.count:
+		logging.info('%d TLS handshakes, %.2fs in total', cyruslib.HANDSHAKES.count, cyruslib.HANDSHAKES.seconds)
+
+def writeSummary(results, out=sys.stdout):
+	""" One line per account then the totals, returns the number of failures
+	"""
+	failed = 0
+	for oldmbox, newmbox, error, seconds in results:
+		if error:
+			failed += 1
+		out.write('%-6s %8.1fs  %s -> %s%s\n' % (
+			'FAILED' if error else 'OK', seconds, oldmbox, newmbox, ': ' + error if error else ''))
+	out.write('%d accounts, %d migrated, %d failed, %.1fs account time\n' % (
+		len(results), len(results) - failed, failed, sum([result[3] for result in results])))
+	return failed
 
 def main():
 	import cyruslib
 	parser = argparse.ArgumentParser(description='Converts local user imap accounts to domain user accounts')
 
-	parser.add_argument('oldmbox', help='old mailbox name (eg user.bob)')
-	parser.add_argument('newmbox', help='new mailbox name (eg user.bob@example.com)')
+	parser.add_argument('oldmbox', nargs='?', help='old mailbox name (eg user.bob)')
+	parser.add_argument('newmbox', nargs='?', help='new mailbox name (eg user.bob@example.com)')
+	parser.add_argument('-b', '--batch', help="migrate oldmbox,newmbox pairs from this CSV file (- for stdin)")
+	parser.add_argument('-j', '--jobs', type=int, default=4, help="parallel migrations in batch mode")
+	parser.add_argument('--url', default='imaps://localhost:993', help="imap server url")
+	parser.add_argument('--user', default='cyrus', help="imap admin user")
+	parser.add_argument('--password', default='password', help="imap admin password")
 	parser.add_argument('-p', '--prefix', help="Root directory prefix")
 	parser.add_argument('-r', '--reconstruct', action='store_true', help="reconstruct")
+	parser.add_argument('-a', '--acls', action='store_true', help="convert mailbox ACLs")
+	parser.add_argument('-n', '--annotations', action='store_true', help="convert mailbox annotations")
+	parser.add_argument('-m', '--rename', action='store_true', help="move with a server-side rename when possible")
+	parser.add_argument('--pipeline', action='store_true', help="create, sync and reconstruct mailboxes concurrently")
+	parser.add_argument('--dry-run', action='store_true', help="only print what would be created, synced and converted")
+	parser.add_argument('-s', '--source', help="copy messages over IMAP from this server (eg imaps://oldhost:993)")
+	parser.add_argument('--state', help="resume file for --source copies (a directory with --batch)")
+	parser.add_argument(
+		'--restart', action='store_true',
+		help="copy all messages again with --source, ignoring --state (eg after a UIDVALIDITY change, into emptied mailboxes)"
+	)
+	parser.add_argument(
+		'--sync', choices=('native', 'hardlink', 'reflink', 'rsync'), default='native',
+		help="how message files are synced (default native, rsync was the default before), "
+			"hardlink and reflink need both spools on one filesystem"
+	)
+	parser.add_argument('--sync-threads', type=int, default=4, help="mailboxes synced in parallel")
+	parser.add_argument('--shard-size', type=int, default=10000, help="files per shard of a large mailbox")
+	parser.add_argument('--mailbox-threads', type=int, default=4, help="shards of one large mailbox copied in parallel")
+	parser.add_argument('--device-jobs', type=int, help="mailboxes synced at a time per disk (default: no limit)")
+	parser.add_argument(
+		'--device-limit', metavar='PATH=N', action='append', default=[],
+		help="mailboxes synced at a time on the disk holding PATH, may be repeated"
+	)
+	parser.add_argument(
+		'--read-order', choices=('extent', 'inode', 'uid'), default='extent',
+		help="order message files are read in, extent falls back to inode without FIEMAP"
+	)
+	parser.add_argument('--max-bytes', metavar='RATE', help="copy at most RATE bytes/s (eg 20M)")
+	parser.add_argument('--max-files', metavar='RATE', help="copy at most RATE files/s")
+	parser.add_argument('--max-commands', metavar='RATE', help="send at most RATE imap commands/s")
+	parser.add_argument(
+		'--limits-file', metavar='FILE',
+		help="read rate limits (bytes=, files=, commands= lines) from FILE, again when it changes or on SIGHUP"
+	)
+	parser.add_argument(
+		'--reconstruct-local', action='store_true',
+		help="reconstruct with the local cyrus reconstruct binary, in batches, instead of over imap"
+	)
+	parser.add_argument(
+		'--reconstruct-sessions', type=int, default=1, metavar='N',
+		help="imap sessions the reconstructs are spread over, per job with --batch (not with --daemon or --connect)"
+	)
+	parser.add_argument('--sync-db', help="sqlite file of per mailbox sync state, unchanged mailboxes are skipped on re-runs")
+	parser.add_argument('-d', '--daemon', metavar='SOCKET', help="serve migration jobs on this unix socket")
+	parser.add_argument('-c', '--connect', metavar='SOCKET', help="hand the migration to a daemon on this unix socket")
+	parser.add_argument('--sessions', type=int, default=4, help="imap sessions kept open by the daemon")
 	parser.add_argument('-v', '--verbose', action='store_true', help="verbose")
 	args = parser.parse_args()
-
-	imap = cyruslib.CYRUS("imaps://localhost:993")
-	imap.login('cyrus', 'password')
-
-	migration = CyrusMigrate(imap, args.oldmbox, args.newmbox, rootPath=args.prefix, verbose=args.verbose)
-	migration(reconstruct=args.reconstruct)
+	deviceLimits = {}
+	for limit in args.device_limit:
+		path, _, jobs = limit.rpartition('=')
+		if not path or not jobs.isdigit():
+			parser.error('--device-limit expects PATH=N, got %r' % limit)
+		deviceLimits[path] = int(jobs)
+	rateLimits = None
+	if args.limits_file or args.max_bytes or args.max_files or args.max_commands:
+		import ratelimit
+		try:
+			rateLimits = ratelimit.RateLimits(*[
+				ratelimit.parseRate(rate or '0') for rate in (args.max_bytes, args.max_files, args.max_commands)
+			])
+		except ValueError as e:
+			parser.error('Invalid rate: %s' % e)
+		if args.limits_file:
+			rateLimits.watch(args.limits_file)
+	options = dict(
+		reconstruct=args.reconstruct, acls=args.acls, annotations=args.annotations,
+		rename=args.rename, pipeline=args.pipeline
+	)
+	if args.reconstruct_sessions < 1:
+		parser.error('--reconstruct-sessions must be at least 1')
+	if args.reconstruct_sessions > 1 and (args.daemon or args.connect):
+		parser.error('--reconstruct-sessions is not supported with --daemon or --connect')
+	# Extra sessions only for reconstructs over imap
+	reconstructSessions = 1
+	if args.reconstruct and not args.reconstruct_local:
+		reconstructSessions = args.reconstruct_sessions
+
+	if args.daemon:
+		import migrationd
+		logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+		migrationd.serve(
+			args.daemon, args.url, args.user, args.password,
+			sourceUrl=args.source, sessions=args.sessions, rateLimits=rateLimits
+		)
+		return 0
+
+	if args.connect:
+		import migrationd
+		if args.dry_run:
+			parser.error('--dry-run runs locally, not with --connect')
+		if not (args.oldmbox and args.newmbox):
+			parser.error('oldmbox and newmbox are required with --connect')
+		for event in migrationd.submit(
+				args.connect, args.oldmbox, args.newmbox,
+				rootPath=args.prefix, stateFile=args.state, syncMethod=args.sync, syncDb=args.sync_db,
+				syncThreads=args.sync_threads, shardSize=args.shard_size, mailboxThreads=args.mailbox_threads,
+				deviceJobs=args.device_jobs, deviceLimits=deviceLimits or None, readOrder=args.read_order,
+				localReconstruct=args.reconstruct_local, restart=args.restart, **options):
+			if event['event'] == 'log':
+				sys.stdout.write('%s %s\n' % (event['level'], event['message']))
+		sys.stdout.write('OK\n' if event['ok'] else 'FAILED: %s\n' % event['error'])
+		return 0 if event['ok'] else 1
+
+	if args.batch:
+		if args.batch == '-':
+			accounts = readAccounts(sys.stdin)
+		else:
+			with open(args.batch, 'r') as f:
+				accounts = readAccounts(f)
+		if not args.dry_run:
+			results = migrateAccounts(
+				accounts, args.url, args.user, args.password, jobs=args.jobs, sourceUrl=args.source,
+				rootPath=args.prefix, stateDir=args.state, verbose=args.verbose,
+				syncMethod=args.sync, syncThreads=args.sync_threads, syncDb=args.sync_db,
+				shardSize=args.shard_size, mailboxThreads=args.mailbox_threads,
+				deviceJobs=args.device_jobs, deviceLimits=deviceLimits, readOrder=args.read_order,
+				rateLimits=rateLimits, localReconstruct=args.reconstruct_local,
+				reconstructSessions=reconstructSessions, restart=args.restart, **options
+			)
+			return 1 if writeSummary(results) else 0
+	elif not (args.oldmbox and args.newmbox):
+		parser.error('oldmbox and newmbox are required without --batch')
+	else:
+		accounts = [(args.oldmbox, args.newmbox)]
+
+	commands = rateLimits and rateLimits.commands
+	context = cyruslib.sslcontext()
+	imap = cyruslib.CYRUS(args.url, ssl_context=context, ratelimit=commands)
+	imap.login(args.user, args.password)
+
+	source = None
+	if args.source:
+		source = cyruslib.CYRUS(args.source, ssl_context=context, ratelimit=commands)
+		source.login(args.user, args.password)
+
+	sessions = []
+	if not args.dry_run:
+		for _ in range(reconstructSessions - 1):
+			session = cyruslib.CYRUS(args.url, ssl_context=context, ratelimit=commands)
+			session.login(args.user, args.password)
+			sessions.append(session)
+
+	for oldmbox, newmbox in accounts:
+		migration = CyrusMigrate(
+			imap, oldmbox, newmbox, rootPath=args.prefix, verbose=args.verbose,
+			source=source, stateFile=None if args.batch else args.state, syncMethod=args.sync,
+			syncThreads=args.sync_threads, syncDb=args.sync_db,
+			shardSize=args.shard_size, mailboxThreads=args.mailbox_threads,
+			deviceJobs=args.device_jobs, deviceLimits=deviceLimits, readOrder=args.read_order,
+			rateLimits=rateLimits, localReconstruct=args.reconstruct_local,
+			reconstructSessions=sessions, restart=args.restart
+		)
+		if args.dry_run:
+			migration.plan(reconstruct=args.reconstruct).write(sys.stdout)
+		else:
+			migration(**options)
+	logHandshakes()
 
 if __name__ == '__main__':
 	sys.exit(main())
@@ -0,0 +1,88 @@
+""" Network only mailbox copy: messages are fetched from a source server
+	and appended to a target server, so neither spool has to be reachable.
+"""
+import os
+import json
+import logging
+
+import cyruslib
+
+
+class UidValidityChanged(Exception):
+	""" The UIDs of a partly copied source mailbox were reset, so the
+		target may already hold copies of messages that now have other UIDs
+	"""
+
+
+class ImapCopy(object):
+	""" Copies mailboxes between two logged in CYRUS connections.
+		The admin needs read rights on the source mailboxes and insert
+		rights on the target ones. Progress is kept per source mailbox as
+		its UIDVALIDITY and last copied UID, in stateFile if one is given,
+		so an interrupted copy carries on where it stopped. With restart
+		that progress is ignored and every message is copied again
+	"""
+	def __init__(self, source, target, stateFile=None, window=cyruslib.APPENDWINDOW, restart=False):
+		self.source = source
+		self.target = target
+		self.stateFile = stateFile
+		self.window = window
+		self.state = {} if restart else self._loadState()
+
+	def _loadState(self):
+		if self.stateFile and os.path.exists(self.stateFile):
+			with open(self.stateFile, 'r') as f:
+				return json.load(f)
+		return {}
+
+	def _saveState(self):
+		""" Writes the state file atomically, a crash leaves the old one in place
+		"""
+		if not self.stateFile:
+			return
+		tmpFile = self.stateFile + '.tmp'
+		with open(tmpFile, 'w') as f:
+			json.dump(self.state, f)
+		os.rename(tmpFile, self.stateFile)
+
+	def lastUid(self, mailbox, uidvalidity):
+		""" Returns the last UID already copied from mailbox, 0 if none were.
+			Raises UidValidityChanged if its UIDVALIDITY changed since: the
+			old UIDs mean nothing then, and copying all messages again would
+			duplicate those in the target
+		"""
+		state = self.state.get(mailbox)
+		if not state:
+			return 0
+		if state['uidvalidity'] != uidvalidity:
+			raise UidValidityChanged(
+				'UIDVALIDITY of %r changed after %d messages were copied, '
+				'empty the target mailbox and copy again with restart' % (mailbox, state['lastuid'])
+			)
+		return state['lastuid']
+
+	def copyMailbox(self, oldmbox, newmbox):
+		""" Appends the messages of oldmbox on the source server that were not
+			copied yet to newmbox on the target server, keeping their flags
+			and internal dates. Returns the number of messages copied
+		"""
+		uidvalidity = self.source.examine(oldmbox)
+		lastuid = self.lastUid(oldmbox, uidvalidity)
+
+		def done(uid):
+			self.state[oldmbox] = {'uidvalidity': uidvalidity, 'lastuid': uid}
+			self._saveState()
+
+		logging.debug('copying messages of %r above uid %d to %r', oldmbox, lastuid, newmbox)
+		messages = self.source.fetchmessages(lastuid)
+		return self.target.appendmessages(newmbox, messages, window=self.window, done=done)
+
+	def __call__(self, mailboxes):
+		""" Copies each (oldmbox, newmbox) pair, returns the total number of messages
+		"""
+		total = 0
+		for oldmbox, newmbox in mailboxes:
+			count = self.copyMailbox(oldmbox, newmbox)
+			logging.info('copied %d messages from %r to %r', count, oldmbox, newmbox)
+			total += count
+		return total
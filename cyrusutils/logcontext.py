@@ -0,0 +1,52 @@
+""" Which job the running thread works for, so log records can be told
+	apart by job rather than by thread. A thread started for a job runs
+	its target through inherit(), taking the job of the thread that
+	started it:
+
+		with logcontext.job(handler):
+			threading.Thread(target=logcontext.inherit(work)).start()
+"""
+import logging
+import threading
+import contextlib
+
+_local = threading.local()
+
+
+def current():
+	""" The job of this thread, None outside of any
+	"""
+	return getattr(_local, 'job', None)
+
+@contextlib.contextmanager
+def job(key):
+	""" Runs the block, and the threads it starts through inherit(), as job key
+	"""
+	previous = current()
+	_local.job = key
+	try:
+		yield
+	finally:
+		_local.job = previous
+
+def inherit(function):
+	""" Wraps function to run as the caller's job, in whichever thread
+		(or pool thread) calls it later
+	"""
+	key = current()
+
+	def run(*args, **kwargs):
+		with job(key):
+			return function(*args, **kwargs)
+	return run
+
+
+class JobFilter(logging.Filter):
+	""" Passes the records logged while working for job key
+	"""
+	def __init__(self, key):
+		logging.Filter.__init__(self)
+		self.key = key
+
+	def filter(self, record):
+		return current() is self.key
@@ -0,0 +1,222 @@
+""" Long running migration daemon. Jobs arrive over a local unix socket as
+	JSON lines and run on a pool of imap sessions that stay logged in, so a
+	job only pays for its own work. Progress is streamed back as JSON lines:
+
+		-> {"oldmbox": "user.bob", "newmbox": "user.bob@example.com", "syncMethod": "native", "options": {"acls": true}}
+		<- {"event": "log", "level": "INFO", "message": "creating mailbox 'user.bob@example.com'"}
+		<- {"event": "done", "ok": true, "error": null, "seconds": 1.5}
+
+	A connection may send any number of jobs, one after the other.
+"""
+import os
+import json
+import time
+import Queue
+import socket
+import logging
+import contextlib
+import SocketServer
+
+import logcontext
+from cyrusmigrate import CyrusMigrate, logHandshakes
+
+
+def _str(value):
+	""" json gives unicode, mailbox names (modified UTF-7) and paths are byte strings
+	"""
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	return value
+
+
+class SessionPool(object):
+	""" Up to size (imap, source) session pairs, logged in on first use.
+		A session that saw a failed job is logged out and replaced,
+		since it may be in any state. All sessions and jobs share the
+		buckets of rateLimits (see ratelimit)
+	"""
+	def __init__(self, url, user, password, sourceUrl=None, size=4, rateLimits=None):
+		import cyruslib
+		# Shared by every session the pool logs in
+		self.context = cyruslib.sslcontext()
+		self.url = url
+		self.user = user
+		self.password = password
+		self.sourceUrl = sourceUrl
+		self.rateLimits = rateLimits
+		self.queue = Queue.Queue()
+		for _ in range(size):
+			self.queue.put(None)
+
+	def _login(self):
+		import cyruslib
+		commands = self.rateLimits and self.rateLimits.commands
+		imap = cyruslib.CYRUS(self.url, ssl_context=self.context, ratelimit=commands)
+		imap.login(self.user, self.password)
+		source = None
+		if self.sourceUrl:
+			source = cyruslib.CYRUS(self.sourceUrl, ssl_context=self.context, ratelimit=commands)
+			source.login(self.user, self.password)
+		return imap, source
+
+	@staticmethod
+	def _logout(sessions):
+		for session in sessions or ():
+			try:
+				if session is not None:
+					session.logout()
+			except Exception:
+				pass
+
+	@contextlib.contextmanager
+	def session(self):
+		""" Blocks until a session is free, yields (imap, source)
+		"""
+		sessions = self.queue.get()
+		try:
+			if sessions is None:
+				sessions = self._login()
+			yield sessions
+		except Exception:
+			self._logout(sessions)
+			sessions = None
+			raise
+		finally:
+			self.queue.put(sessions)
+
+
+class _ProgressHandler(logging.Handler):
+	""" Forwards the log records of one job to its client, from whichever
+		of the job's threads they come (see logcontext)
+	"""
+	def __init__(self, request):
+		logging.Handler.__init__(self)
+		self.request = request
+		self.addFilter(logcontext.JobFilter(self))
+
+	def emit(self, record):
+		try:
+			self.request.send(event='log', level=record.levelname, message=record.getMessage())
+		except socket.error:
+			pass
+
+
+class MigrationHandler(SocketServer.StreamRequestHandler):
+	# Job keys passed on to CyrusMigrate when set, its defaults apply otherwise
+	settings = (
+		'syncThreads', 'shardSize', 'mailboxThreads', 'deviceJobs', 'deviceLimits', 'readOrder',
+		'localReconstruct', 'restart',
+	)
+
+	def handle(self):
+		for line in iter(self.rfile.readline, ''):
+			if not line.strip():
+				continue
+			try:
+				job = dict((_str(key), _str(value)) for key, value in json.loads(line).items())
+			except (ValueError, AttributeError) as e:
+				self.send(event='done', ok=False, error='Invalid job: %s' % e, seconds=0.0)
+				continue
+			self.runJob(job)
+
+	def send(self, **event):
+		self.wfile.write(json.dumps(event) + '\n')
+		self.wfile.flush()
+
+	def runJob(self, job):
+		handler = _ProgressHandler(self)
+		logging.getLogger().addHandler(handler)
+		start = time.time()
+		error = None
+		migration = None
+		with logcontext.job(handler):
+			try:
+				if not (job.get('oldmbox') and job.get('newmbox')):
+					raise ValueError('Job needs oldmbox and newmbox')
+				settings = dict((name, job[name]) for name in self.settings if job.get(name) is not None)
+				if 'deviceLimits' in settings:
+					settings['deviceLimits'] = dict((_str(path), jobs) for path, jobs in settings['deviceLimits'].items())
+				with self.server.pool.session() as (imap, source):
+					migration = CyrusMigrate(
+						imap, job['oldmbox'], job['newmbox'], rootPath=job.get('rootPath'),
+						source=source, stateFile=job.get('stateFile'), syncMethod=job.get('syncMethod') or 'native',
+						syncDb=job.get('syncDb'), rateLimits=self.server.pool.rateLimits, **settings
+					)
+					migration(**dict((_str(key), value) for key, value in job.get('options', {}).items()))
+			except Exception as e:
+				logging.exception('Migrating %r to %r failed', job.get('oldmbox'), job.get('newmbox'))
+				error = str(e) or e.__class__.__name__
+			finally:
+				if migration is not None:
+					migration.close()
+				logging.getLogger().removeHandler(handler)
+		self.send(event='done', ok=error is None, error=error, seconds=time.time() - start)
+
+
+class MigrationServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+
+	def __init__(self, path, pool):
+		if os.path.exists(path):
+			os.unlink(path)
+		# Jobs run with admin rights, so only our own user may connect,
+		# from the moment the socket exists
+		umask = os.umask(0177)
+		try:
+			SocketServer.UnixStreamServer.__init__(self, path, MigrationHandler)
+		finally:
+			os.umask(umask)
+		os.chmod(path, 0600)
+		self.pool = pool
+
+
+def serve(path, url, user, password, sourceUrl=None, sessions=4, rateLimits=None):
+	""" Serves migration jobs on the unix socket path until interrupted
+	"""
+	server = MigrationServer(path, SessionPool(url, user, password, sourceUrl, sessions, rateLimits))
+	logging.info('listening on %r', path)
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+		os.unlink(path)
+		logHandshakes()
+
+
+def submit(path, oldmbox, newmbox, rootPath=None, stateFile=None, syncMethod='native', syncDb=None,
+		syncThreads=None, shardSize=None, mailboxThreads=None, deviceJobs=None, deviceLimits=None,
+		readOrder=None, localReconstruct=None, restart=None, **options):
+	""" Sends one job to the daemon on path, yields its events up to
+		and including the final 'done' one. Settings left None get
+		CyrusMigrate's defaults
+	"""
+	job = {
+		'oldmbox': oldmbox,
+		'newmbox': newmbox,
+		'rootPath': rootPath,
+		'stateFile': stateFile,
+		'syncMethod': syncMethod,
+		'syncDb': syncDb,
+		'syncThreads': syncThreads,
+		'shardSize': shardSize,
+		'mailboxThreads': mailboxThreads,
+		'deviceJobs': deviceJobs,
+		'deviceLimits': deviceLimits,
+		'readOrder': readOrder,
+		'localReconstruct': localReconstruct,
+		'restart': restart,
+		'options': options,
+	}
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	sock.connect(path)
+	try:
+		sock.sendall(json.dumps(job) + '\n')
+		f = sock.makefile('r')
+		for line in iter(f.readline, ''):
+			event = json.loads(line)
+			yield event
+			if event['event'] == 'done':
+				return
+		raise socket.error('Connection closed before the job finished')
+	finally:
+		sock.close()
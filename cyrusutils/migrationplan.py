@@ -0,0 +1,79 @@
+""" What a migration would do, worked out without changing anything.
+	See CyrusMigrate.plan()
+"""
+import sys
+
+
+class MailboxPlan(object):
+	""" One old mailbox: its new name, whether it gets created, synced and
+		reconstructed, and the files and bytes the sync would transfer and
+		delete: 0 when the mailbox is not synced, None when the old spool
+		is only reachable over IMAP. fingerprint is the one the sync state
+		database gets once the sync is done (see syncstate)
+	"""
+	def __init__(self, oldmbox, newmbox, create=False, sync=False, reconstruct=False,
+			files=None, bytes=None, deletes=None, fingerprint=None):
+		self.oldmbox = oldmbox
+		self.newmbox = newmbox
+		self.fingerprint = fingerprint
+		self.create = create
+		self.sync = sync
+		self.reconstruct = reconstruct
+		self.files = files
+		self.bytes = bytes
+		self.deletes = deletes
+
+	def __repr__(self):
+		return '<MailboxPlan %r -> %r: %s files, %s bytes>' % (self.oldmbox, self.newmbox, self.files, self.bytes)
+
+
+class MigrationPlan(object):
+	""" The plan of one account. mailboxes are ordered largest transfer
+		first, which is the order the sync takes them in. reconstructs are
+		the new mailboxes whose files the sync changes. subscriptions and seen are
+		the entries to convert, None when they would not be converted.
+		overImap is set when messages are copied from a source server
+	"""
+	def __init__(self, oldmbox, newmbox, mailboxes, reconstructs=(), subscriptions=None, seen=None, overImap=False):
+		self.oldmbox = oldmbox
+		self.newmbox = newmbox
+		self.overImap = overImap
+		self.mailboxes = sorted(mailboxes, key=lambda mailbox: mailbox.bytes or 0, reverse=True)
+		self.reconstructs = list(reconstructs)
+		self.subscriptions = subscriptions
+		self.seen = seen
+
+	@property
+	def creates(self):
+		return [mailbox.newmbox for mailbox in self.mailboxes if mailbox.create]
+
+	@property
+	def syncs(self):
+		return [mailbox for mailbox in self.mailboxes if mailbox.sync]
+
+	@property
+	def files(self):
+		return sum(mailbox.files or 0 for mailbox in self.syncs)
+
+	@property
+	def bytes(self):
+		return sum(mailbox.bytes or 0 for mailbox in self.syncs)
+
+	def write(self, out=sys.stdout):
+		""" One line per mailbox then the totals, as for --dry-run
+		"""
+		out.write('%s -> %s\n' % (self.oldmbox, self.newmbox))
+		for mailbox in self.mailboxes:
+			actions = [name for name in ('create', 'sync', 'reconstruct') if getattr(mailbox, name)]
+			if self.overImap:
+				size = 'over imap'
+			else:
+				size = '%d files, %d bytes, %d deletes' % (mailbox.files, mailbox.bytes, mailbox.deletes)
+			out.write('  %-24s %s -> %s (%s)\n' % (','.join(actions) or 'unchanged', mailbox.oldmbox, mailbox.newmbox, size))
+		out.write('  %d mailboxes, %d to create, %d to sync (%d files, %d bytes), %d to reconstruct' % (
+			len(self.mailboxes), len(self.creates), len(self.syncs), self.files, self.bytes, len(self.reconstructs)))
+		if self.subscriptions is not None:
+			out.write(', %d subscriptions' % self.subscriptions)
+		if self.seen is not None:
+			out.write(', %d seen entries' % self.seen)
+		out.write('\n')
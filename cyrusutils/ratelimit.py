@@ -0,0 +1,149 @@
+""" Token buckets that keep a migration from swamping the live server.
+	The bucket state lives in shared memory, so the threads of a process
+	and the worker processes forked after it all draw from the same one.
+
+	Limits can be changed while running, from a control file of
+	name = rate lines, eg
+
+		# copy at most 20MB/s, 500 files/s and 50 imap commands/s
+		bytes = 20M
+		files = 500
+		commands = 50
+
+	which is read again when it changes or on SIGHUP. A rate of 0 or a
+	missing line means no limit.
+"""
+import os
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+
+_units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parseRate(text):
+	""" '100', '1.5k', '20M' -> float per second
+	"""
+	text = text.strip().lower()
+	factor = 1
+	if text and text[-1] in _units:
+		factor = _units[text[-1]]
+		text = text[:-1]
+	rate = float(text) * factor
+	if rate < 0:
+		raise ValueError('Negative rate %r' % text)
+	return rate
+
+
+class TokenBucket(object):
+	""" Allows rate tokens per second on average, in bursts of up to burst
+		tokens (one second's worth by default). A take larger than what is
+		available goes into debt, which later takes wait off, so large
+		items are still throttled fairly
+	"""
+	# Longest single sleep, so a new rate takes effect quickly
+	maxWait = 1.0
+
+	def __init__(self, rate=0, burst=0):
+		self.lock = multiprocessing.Lock()
+		self._rate = multiprocessing.Value('d', rate, lock=False)
+		self._burst = multiprocessing.Value('d', burst, lock=False)
+		self._tokens = multiprocessing.Value('d', burst or rate, lock=False)
+		self._stamp = multiprocessing.Value('d', time.time(), lock=False)
+
+	@property
+	def rate(self):
+		return self._rate.value
+
+	def setRate(self, rate, burst=0):
+		with self.lock:
+			self._rate.value = rate
+			self._burst.value = burst
+
+	def take(self, count=1):
+		""" Waits until count tokens may be used, returns the seconds waited
+		"""
+		waited = 0.0
+		while True:
+			with self.lock:
+				rate = self._rate.value
+				if rate <= 0:
+					return waited
+				now = time.time()
+				capacity = self._burst.value or rate
+				tokens = min(capacity, self._tokens.value + (now - self._stamp.value) * rate)
+				self._stamp.value = now
+				if tokens > 0:
+					self._tokens.value = tokens - count
+					return waited
+				self._tokens.value = tokens
+				wait = min(-tokens / rate + 0.001, self.maxWait)
+			time.sleep(wait)
+			waited += wait
+
+
+class RateLimits(object):
+	""" The bytes/s and files/s buckets of the copy engine and the
+		commands/s bucket of the imap sessions
+	"""
+	names = ('bytes', 'files', 'commands')
+
+	def __init__(self, bytes=0, files=0, commands=0):
+		self.bytes = TokenBucket(bytes)
+		self.files = TokenBucket(files)
+		self.commands = TokenBucket(commands)
+		self.path = None
+		self.mtime = None
+
+	def set(self, **rates):
+		for name, rate in rates.items():
+			assert name in self.names, 'Unknown rate limit %r' % name
+			getattr(self, name).setRate(rate)
+		logging.info('rate limits: %s', ', '.join(
+			'%s %s/s' % (name, getattr(self, name).rate or 'unlimited') for name in self.names))
+
+	def load(self, path=None):
+		""" Sets the rates from a control file. The file's previous rates
+			stay in place if it cannot be read or parsed
+		"""
+		path = path or self.path
+		rates = dict((name, 0) for name in self.names)
+		try:
+			self.mtime = os.stat(path).st_mtime
+			with open(path, 'r') as f:
+				for line in f:
+					line = line.split('#', 1)[0].strip()
+					if not line:
+						continue
+					name, _, rate = line.partition('=')
+					name = name.strip().lower()
+					if name not in self.names:
+						raise ValueError('Unknown rate limit %r' % name)
+					rates[name] = parseRate(rate)
+		except (IOError, OSError, ValueError) as e:
+			logging.error('Cannot load rate limits from %r: %s', path, e)
+			return
+		self.set(**rates)
+
+	def watch(self, path, interval=1.0):
+		""" Loads path now, again whenever it changes and on SIGHUP
+		"""
+		self.path = path
+		self.load()
+
+		def poll():
+			while True:
+				time.sleep(interval)
+				try:
+					mtime = os.stat(path).st_mtime
+				except OSError:
+					continue
+				if mtime != self.mtime:
+					self.load()
+
+		thread = threading.Thread(target=poll, name='ratelimit')
+		thread.daemon = True
+		thread.start()
+		signal.signal(signal.SIGHUP, lambda signum, frame: self.load())
@@ -21,8 +21,10 @@ __version__= '0.2'
 __doc__="""Cyrus skiplist db recover"""
 
 from sys import argv, stdout, stderr, exit as sys_exit
-from struct import unpack
-from time import localtime, strftime
+from struct import pack, unpack
+from time import localtime, strftime, time
+import os
+import random
 
 ### TODO: Correct handle COMMIT/DEL stuff
 ###       right now this tools rougly dumps entries in the skiplist file
@@ -33,6 +35,9 @@ debug = 0
 
 TIMEFMT ='%a, %d %b %Y %H:%M:%S %z'
 MAGIC   = '\xa1\x02\x8b\x0d'
+SIGN    = 'skiplist file\0\0\0'
+VERSION = (1, 2)
+MAXLEVEL = 20
 PADDING = '\xff\xff\xff\xff'
 INORDER = 1
 ADD     = 2
@@ -100,12 +105,9 @@ def get_header(fp):
              'lastrecover': lastrecovery
              }
 
-def getkeys(fp):
-    values = []
-    keys = {}
-    keystring = ''
-    datastring = ''
-
+def iterkeys(fp):
+    """Yields (key, data) for every record in file order,
+    later records for the same key override earlier ones"""
     while 1:
         log(MAIN, '-' * 78)
 
@@ -133,15 +135,16 @@ def getkeys(fp):
         ksize = unpack('>I', fp.read(4))[0]
         log(rtype, 'Key size %d (%d)' % (ksize, roundto4(ksize)))
 
+        ### An empty key or data is empty, not the previous record's
+        keystring = fp.read(roundto4(ksize))[:ksize]
         if ksize:
-            keystring = fp.read(roundto4(ksize))[:ksize]
             log(rtype, 'Key String %s' % keystring)
 
         datasize = unpack('>I', fp.read(4))[0]
         log(rtype, 'Data size %d (%d)' % (datasize, roundto4(datasize)))
 
+        datastring = fp.read(roundto4(datasize))[:datasize]
         if datasize:
-            datastring = fp.read(roundto4(datasize))[:datasize]
             log(rtype, 'Data String %s' % datastring)
 
         n = 0
@@ -156,9 +159,85 @@ def getkeys(fp):
         log(rtype, 'Total Skip pointers: %d' % n)
 
         if rtype != DUMMY:
-            if keystring not in values:
-                values.append(keystring)
-            keys[keystring] = datastring
+            yield keystring, datastring
+
+def randlevel(rnd=random):
+    """Level of a new record, as cyrus picks it (p = 1/2)"""
+    level = 1
+    while level < MAXLEVEL and rnd.random() < 0.5:
+        level += 1
+    return level
+
+def write(fp, records, rnd=random):
+    """Writes a new skiplist db of (key, data) records, which must be
+    sorted by key and unique. The whole list is written INORDER,
+    so the db starts with an empty log"""
+    def pad(text):
+        return text + '\0' * (-len(text) % 4)
+
+    records = [(key, data, randlevel(rnd)) for key, data in records]
+
+    ### Offsets of the records, the DUMMY one follows the 48 byte header
+    dummy = 48
+    offsets = []
+    offset = dummy + 16 + 4 * MAXLEVEL
+    for key, data, level in records:
+        offsets.append(offset)
+        offset += 16 + len(pad(key)) + len(pad(data)) + 4 * level
+    logstart = offset
+
+    ### Forward pointers: per level the next record that is as high
+    pointers = [None] * len(records)
+    following = [0] * MAXLEVEL
+    for i in range(len(records) - 1, -1, -1):
+        level = records[i][2]
+        pointers[i] = following[:level]
+        following[:level] = [offsets[i]] * level
+
+    curlevel = max([level for _, _, level in records] or [1])
+    fp.write(MAGIC + SIGN)
+    fp.write(pack('>7I', VERSION[0], VERSION[1], MAXLEVEL, curlevel, len(records), logstart, int(time())))
+    fp.write(pack('>3I', DUMMY, 0, 0) + pack('>%dI' % MAXLEVEL, *following) + PADDING)
+    for (key, data, level), forward in zip(records, pointers):
+        fp.write(pack('>2I', INORDER, len(key)) + pad(key))
+        fp.write(pack('>I', len(data)) + pad(data))
+        fp.write(pack('>%dI' % level, *forward) + PADDING)
+
+def writefile(path, records, uid=None, gid=None):
+    """Writes records (see write) to a temporary file next to path,
+    owned by uid/gid if given, and renames it over path once synced
+    to disk, so readers only ever see a complete db. The directory is
+    synced as well, so the rename survives a crash"""
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        fp = open(tmppath, 'wb')
+        try:
+            write(fp, records)
+            fp.flush()
+            os.fsync(fp.fileno())
+        finally:
+            fp.close()
+        if uid is not None:
+            os.chown(tmppath, uid, gid)
+        os.rename(tmppath, path)
+        dirfd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+    except:
+        if os.path.exists(tmppath):
+            os.unlink(tmppath)
+        raise
+
+def getkeys(fp):
+    values = []
+    keys = {}
+
+    for keystring, datastring in iterkeys(fp):
+        if not keys.has_key(keystring):
+            values.append(keystring)
+        keys[keystring] = datastring
 
     return values, keys
 
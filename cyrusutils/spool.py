@@ -0,0 +1,153 @@
+""" One pass inventory of a mailbox tree in a cyrus spool. The directories
+	are read once with scandir and every migration phase works from the
+	result instead of walking and stat'ing the spool again.
+"""
+import os
+import stat
+import errno
+import fnmatch
+import logging
+from collections import OrderedDict
+
+try:
+	_scandir = os.scandir
+except AttributeError:
+	try:
+		from scandir import scandir as _scandir
+	except ImportError:
+		_scandir = None
+
+
+class _Entry(object):
+	""" The part of scandir's DirEntry we use, from listdir and lstat
+	"""
+	def __init__(self, directory, name):
+		self.name = name
+		self.path = os.path.join(directory, name)
+		self._stat = None
+
+	def stat(self, follow_symlinks=True):
+		if self._stat is None:
+			self._stat = os.lstat(self.path)
+		return self._stat
+
+	def is_dir(self, follow_symlinks=True):
+		return stat.S_ISDIR(self.stat().st_mode)
+
+
+def scandir(path):
+	""" os.scandir, the scandir package on python 2 or a listdir fallback
+	"""
+	if _scandir is not None:
+		return _scandir(path)
+	return [_Entry(path, name) for name in os.listdir(path)]
+
+
+class Mailbox(object):
+	""" A mailbox directory: its name and domain, whether it has a
+		cyrus.header, the {name: lstat} of its message files (cyrus.*
+		excluded) and the names of its subdirectories
+	"""
+	__slots__ = ('name', 'domain', 'path', 'stat', 'header', 'files', 'subdirs')
+
+	def __init__(self, name, domain, path, stat, header, files, subdirs):
+		self.name = name
+		self.domain = domain
+		self.path = path
+		self.stat = stat
+		self.header = header
+		self.files = files
+		self.subdirs = subdirs
+
+	@property
+	def mailbox(self):
+		return self.name + ('@' + self.domain if self.domain else '')
+
+	@property
+	def count(self):
+		return len(self.files)
+
+	@property
+	def bytes(self):
+		return sum(st.st_size for st in self.files.values())
+
+	def __repr__(self):
+		return '<Mailbox %r: %d files, %d bytes>' % (self.mailbox, self.count, self.bytes)
+
+
+class SpoolInventory(object):
+	""" The mailbox directories below (and including) the one of the
+		top level mailbox, parents first, keyed by full mailbox name.
+		Only directories with a cyrus.header are mailboxes, but the
+		others are still descended into. With scan=False the tree is
+		only read by iterating over scan()
+	"""
+	exclude = 'cyrus.*'
+
+	def __init__(self, topMailbox, path, scan=True):
+		self.mailboxes = OrderedDict()
+		self.topMailbox = topMailbox
+		self.path = path
+		if scan:
+			for _ in self.scan():
+				pass
+
+	def scan(self):
+		""" Reads the tree, yielding each mailbox as soon as its directory
+			has been read. Parents come before their subfolders
+		"""
+		name, _, domain = self.topMailbox.partition('@')
+		domain = domain or None
+		stack = [(name, self.path, None)]
+		while stack:
+			name, path, st = stack.pop()
+			try:
+				entries = list(scandir(path))
+			except OSError as e:
+				if e.errno != errno.ENOENT:
+					raise
+				continue
+
+			files = {}
+			subdirs = OrderedDict()
+			header = False
+			for entry in entries:
+				if entry.is_dir(follow_symlinks=False):
+					subdirs[entry.name] = entry
+				elif entry.name == 'cyrus.header':
+					header = True
+				elif not fnmatch.fnmatch(entry.name, self.exclude):
+					entryStat = entry.stat(follow_symlinks=False)
+					if stat.S_ISREG(entryStat.st_mode):
+						files[entry.name] = entryStat
+
+			if header:
+				mailbox = Mailbox(name, domain, path, st or os.stat(path), header, files, list(subdirs))
+				self.mailboxes[mailbox.mailbox] = mailbox
+				yield mailbox
+
+			# Reversed, so that subfolders come out in directory order
+			for subdir, entry in reversed(subdirs.items()):
+				stack.append(('%s.%s' % (name, subdir), entry.path, entry.stat(follow_symlinks=False)))
+
+		logging.debug('%d mailboxes, %d files, %d bytes in spool inventory', len(self), self.files, self.bytes)
+
+	def __len__(self):
+		return len(self.mailboxes)
+
+	def __iter__(self):
+		return iter(self.mailboxes.values())
+
+	def __contains__(self, mailbox):
+		return mailbox in self.mailboxes
+
+	def get(self, mailbox):
+		return self.mailboxes.get(mailbox)
+
+	@property
+	def files(self):
+		return sum(mailbox.count for mailbox in self)
+
+	@property
+	def bytes(self):
+		return sum(mailbox.bytes for mailbox in self)
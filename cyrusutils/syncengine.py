@@ -0,0 +1,650 @@
+""" In-process replacement for the per mailbox
+		rsync --perms --times --group --owner --dirs --exclude=cyrus.* --delete
+	that CyrusMigrate.syncFiles used to fork. Each mailbox directory is
+	synced on its own (subdirectories are other mailboxes) and mailboxes
+	are spread over a thread pool.
+
+	Cyrus never rewrites a message file, so when both spools share a
+	filesystem the files can be hardlinked or reflinked instead of copied.
+	Messages hardlinked into several mailboxes by singleinstancestore are
+	transferred once per run and linked again on the target.
+"""
+import os
+import sys
+import stat
+import errno
+import array
+import fcntl
+import struct
+import thread
+import fnmatch
+import logging
+import tempfile
+import threading
+import contextlib
+from collections import Counter
+from multiprocessing.pool import ThreadPool
+
+import logcontext
+
+BUFSIZE = 65536
+
+
+def _sendfile(fsrc, fdst, offset, count):
+	return os.sendfile(fdst, fsrc, offset, count)
+
+def _copyFileRange(fsrc, fdst, offset, count):
+	return os.copy_file_range(fsrc, fdst, count, offset, offset)
+
+# In-kernel copies, best first. Python 2 has neither, the buffered
+# copy is used then
+_kernelCopies = [copy for name, copy in (
+	('copy_file_range', _copyFileRange),
+	('sendfile', _sendfile),
+) if hasattr(os, name)]
+
+# Errors meaning the kernel cannot copy between these two files
+_unsupported = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP)
+
+# linux/fs.h _IOW(0x94, 9, int): share the source extents (btrfs, xfs)
+FICLONE = 0x40049409
+
+# Errors meaning these two files cannot be linked or cloned, copy instead.
+# Of the link errors only _noLinkDevices hold for every file of the devices,
+# EPERM (fs.protected_hardlinks, by owner) and EMLINK are about one file
+_noLink = (errno.EXDEV, errno.EMLINK, errno.EPERM, errno.EOPNOTSUPP)
+_noLinkDevices = (errno.EXDEV, errno.EOPNOTSUPP)
+_noClone = (errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.ENOSYS, errno.EOPNOTSUPP)
+
+
+# linux/fs.h _IOWR('f', 11, struct fiemap): the file's physical extents.
+# fcntl.ioctl takes a C int, so the request is passed as its signed value
+FS_IOC_FIEMAP = 0xC020660B
+_fiemapRequest = struct.unpack('=i', struct.pack('=I', FS_IOC_FIEMAP))[0]
+# struct fiemap with room for one struct fiemap_extent
+_fiemap = struct.Struct('=QQIIII')
+_fiemapExtentSize = 56
+
+# Errors meaning the filesystem cannot report extents
+_noFiemap = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS)
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+
+
+def _libcFadvise():
+	""" posix_fadvise through ctypes, python 2 has no os.posix_fadvise
+	"""
+	try:
+		import ctypes
+		import ctypes.util
+		libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+		function = libc.posix_fadvise
+	except (ImportError, OSError, AttributeError):
+		return None
+	function.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+
+	def posix_fadvise(fd, offset, length, advice):
+		error = function(fd, offset, length, advice)
+		if error:
+			raise OSError(error, os.strerror(error))
+	return posix_fadvise
+
+_posixFadvise = getattr(os, 'posix_fadvise', None) or _libcFadvise()
+
+
+def fadvise(fd, *advices):
+	""" Passes page cache hints for all of fd, where the system takes them.
+		They are only hints, so failures are ignored
+	"""
+	if _posixFadvise is None:
+		return
+	for advice in advices:
+		try:
+			_posixFadvise(fd, 0, 0, advice)
+		except OSError:
+			pass
+
+
+def physicalOffset(path):
+	""" Physical byte offset of the first extent of path, 0 for a file without
+		extents (eg empty), None if the filesystem cannot tell (no FIEMAP)
+	"""
+	request = array.array('B', _fiemap.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + '\0' * _fiemapExtentSize)
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		fcntl.ioctl(fd, _fiemapRequest, request, True)
+	except IOError as e:
+		if e.errno not in _noFiemap:
+			raise
+		return None
+	finally:
+		os.close(fd)
+	reply = request.tostring()
+	mappedExtents = _fiemap.unpack_from(reply)[3]
+	if not mappedExtents:
+		return 0
+	# fe_logical, then fe_physical
+	return struct.unpack_from('=Q', reply, _fiemap.size + 8)[0]
+
+
+def cloneData(fsrc, fdst):
+	""" Reflinks all of fsrc into fdst, False if the filesystem cannot
+	"""
+	try:
+		fcntl.ioctl(fdst, FICLONE, fsrc)
+	except (IOError, OSError) as e:
+		if e.errno not in _noClone:
+			raise
+		return False
+	return True
+
+
+def copyData(fsrc, fdst, size):
+	""" Copies the first size bytes between two file descriptors, in the
+		kernel where possible. Returns the number of bytes copied
+	"""
+	offset = 0
+	for copy in _kernelCopies:
+		try:
+			while offset < size:
+				count = copy(fsrc, fdst, offset, size - offset)
+				if not count:
+					break
+				offset += count
+			return offset
+		except OSError as e:
+			if e.errno not in _unsupported:
+				raise
+			logging.debug('%s unsupported (%s), trying next copy method', copy.__name__, e)
+
+	os.lseek(fsrc, offset, os.SEEK_SET)
+	os.lseek(fdst, offset, os.SEEK_SET)
+	while offset < size:
+		data = os.read(fsrc, min(BUFSIZE, size - offset))
+		if not data:
+			break
+		written = 0
+		while written < len(data):
+			written += os.write(fdst, data[written:])
+		offset += len(data)
+	return offset
+
+
+def device(path):
+	""" st_dev of path, or of its nearest existing parent (a target may not exist yet)
+	"""
+	while True:
+		try:
+			return os.stat(path).st_dev
+		except OSError as e:
+			parent = os.path.dirname(path)
+			if e.errno != errno.ENOENT or parent == path:
+				raise
+			path = parent
+
+
+class DeviceLimiter(object):
+	""" Counts the syncs running per device (st_dev), allowing at most
+		limits.get(device, limit) at a time. No limit when that is None
+	"""
+	def __init__(self, limit=None, limits=None):
+		self.limit = limit
+		self.limits = limits or {}
+		self.busy = Counter()
+		self.cond = threading.Condition()
+
+	def _free(self, devices):
+		for dev in devices:
+			limit = self.limits.get(dev, self.limit)
+			if limit is not None and self.busy[dev] >= max(limit, 1):
+				return False
+		return True
+
+	def _take(self, devices):
+		for dev in devices:
+			self.busy[dev] += 1
+
+	def next(self, queue):
+		""" Removes and returns the first (item, devices) of queue whose devices
+			all have a free slot, taking those slots. Waits while none has,
+			returns None once queue is empty
+		"""
+		with self.cond:
+			while queue:
+				for i, (item, devices) in enumerate(queue):
+					if self._free(devices):
+						del queue[i]
+						self._take(devices)
+						return item, devices
+				self.cond.wait()
+			return None
+
+	def release(self, devices):
+		with self.cond:
+			for dev in devices:
+				self.busy[dev] -= 1
+			self.cond.notify_all()
+
+	def cancel(self, queue):
+		""" Empties queue, waking up the threads waiting for it
+		"""
+		with self.cond:
+			del queue[:]
+			self.cond.notify_all()
+
+	@contextlib.contextmanager
+	def slot(self, devices, lent=None):
+		""" Waits for and holds a slot on each of devices. lent is a one item
+			list counting slots on devices the caller holds already and lends
+			out, eg a directory's slot to its shards. Those are used first
+		"""
+		with self.cond:
+			while not (lent and lent[0]) and not self._free(devices):
+				self.cond.wait()
+			borrowed = bool(lent and lent[0])
+			if borrowed:
+				lent[0] -= 1
+			else:
+				self._take(devices)
+		try:
+			yield
+		finally:
+			if borrowed:
+				with self.cond:
+					lent[0] += 1
+					self.cond.notify_all()
+			else:
+				self.release(devices)
+
+
+class SyncEngine(object):
+	""" Syncs (source, target) directory pairs. A file is copied when its
+		size or mtime differ, like rsync's quick check, through a temporary
+		file renamed into place. Files missing from the source are deleted.
+		Owner, group, mode and times follow the source.
+
+		mode is 'copy', 'hardlink' or 'reflink'. The last two fall back to
+		copying where the filesystem refuses, eg across devices
+
+		A directory with more than shardSize files to transfer is split
+		into shards of files consecutive in read order (see below),
+		transferred by up to shardThreads threads (shared by all
+		directories), so one huge folder does not leave a single thread
+		doing all the copying
+
+		Directories are scheduled by the devices their source and target
+		are on: at most deviceJobs syncs use one device at a time (or
+		deviceLimits[st_dev] for that device), so the threads spread over
+		all disks instead of piling random I/O onto one of them
+
+		Within a directory files are read in readOrder: 'extent' (by
+		physical position on disk where the filesystem reports it with
+		FIEMAP, else by inode), 'inode' or 'uid'. On a spinning disk this
+		keeps the head moving one way instead of seeking between UIDs.
+		Copied sources are dropped from the page cache afterwards, so the
+		migration does not evict the live server's working set
+
+		With rateLimits (see ratelimit) each transfer waits on its files
+		bucket and each copy is charged to its bytes bucket
+	"""
+	exclude = 'cyrus.*'
+	modes = ('copy', 'hardlink', 'reflink')
+	# Counters of syncDirectory that mean the target's files changed
+	changes = ('copied', 'linked', 'cloned', 'relinked', 'deleted')
+	readOrders = ('extent', 'inode', 'uid')
+
+	def __init__(self, threads=4, mode='copy', shardSize=10000, shardThreads=4, deviceJobs=None, deviceLimits=None,
+			readOrder='extent', rateLimits=None):
+		assert mode in self.modes, 'Unknown sync mode %r' % mode
+		self.rateLimits = rateLimits
+		assert readOrder in self.readOrders, 'Unknown read order %r' % readOrder
+		self.readOrder = readOrder
+		# Source st_dev of filesystems without FIEMAP
+		self.noExtents = set()
+		self.threads = threads
+		self.mode = mode
+		self.shardSize = shardSize
+		self.shardThreads = shardThreads
+		self.shardPool = None
+		self.limiter = DeviceLimiter(deviceJobs, deviceLimits)
+		# (source, target) st_dev pairs known to refuse links or clones
+		self.unlinkable = set()
+		# Source (st_dev, st_ino) of multiply linked files -> [Event, target path],
+		# the path is set once the first link has been transferred
+		self.inodes = {}
+		# Targets whose files changed, their cyrus.index is stale
+		self.modified = set()
+		self.lock = threading.Lock()
+
+	def __call__(self, pairs):
+		""" Syncs all (source, target[, sourceManifest]) pairs, returns the summed counters.
+			Pairs are started in the order given, unless their devices are busy
+		"""
+		queue = [(pair, self.devices(pair[0], pair[1])) for pair in pairs]
+		total = Counter()
+		errors = []
+
+		def worker():
+			while True:
+				item = self.limiter.next(queue)
+				if item is None:
+					return
+				pair, devices = item
+				try:
+					result = self.syncDirectory(*pair, held=devices)
+					with self.lock:
+						total.update(result)
+				except Exception:
+					errors.append(sys.exc_info())
+					self.limiter.cancel(queue)
+				finally:
+					self.limiter.release(devices)
+
+		workers = [threading.Thread(target=logcontext.inherit(worker)) for _ in range(max(self.threads, 1))]
+		try:
+			for workerThread in workers:
+				workerThread.daemon = True
+				workerThread.start()
+			for workerThread in workers:
+				workerThread.join()
+		finally:
+			self.close()
+		if errors:
+			raise errors[0][0], errors[0][1], errors[0][2]
+		return total
+
+	@staticmethod
+	def devices(source, target):
+		return frozenset((device(source), device(target)))
+
+	def syncLimited(self, source, target, sourceManifest=None):
+		""" syncDirectory, once source's and target's devices have a free slot
+		"""
+		devices = self.devices(source, target)
+		with self.limiter.slot(devices):
+			return self.syncDirectory(source, target, sourceManifest, held=devices)
+
+	def close(self):
+		""" Stops the shard threads, they are started again when needed
+		"""
+		with self.lock:
+			pool, self.shardPool = self.shardPool, None
+		if pool is not None:
+			pool.close()
+			pool.join()
+
+	def _shardMap(self, function, shards):
+		with self.lock:
+			if self.shardPool is None:
+				self.shardPool = ThreadPool(self.shardThreads)
+			pool = self.shardPool
+		# The pool's threads outlive the caller's job, each shard takes it along
+		return pool.map(logcontext.inherit(function), shards, chunksize=1)
+
+	@staticmethod
+	def uidOrder(name):
+		""" Sort key of message files (UID.) by UID, others last
+		"""
+		uid = name.split('.', 1)[0]
+		return (0, int(uid), name) if uid.isdigit() else (1, 0, name)
+
+	def sortTransfers(self, source, names, sourceFiles, devices):
+		""" Sorts the names of the files to transfer out of source in readOrder.
+			Extents are only looked up when the data is going to be read
+		"""
+		if self.readOrder == 'uid':
+			names.sort(key=self.uidOrder)
+			return
+		names.sort(key=lambda name: sourceFiles[name].st_ino)
+		if self.readOrder != 'extent' or not names or (self.mode != 'copy' and devices not in self.unlinkable):
+			return
+		dev = sourceFiles[names[0]].st_dev
+		if dev in self.noExtents:
+			return
+
+		offsets = {}
+		for name in names:
+			offset = physicalOffset(os.path.join(source, name))
+			if offset is None:
+				self.noExtents.add(dev)
+				return
+			offsets[name] = offset
+		names.sort(key=lambda name: (offsets[name], sourceFiles[name].st_ino))
+
+	def excluded(self, name):
+		return fnmatch.fnmatch(name, self.exclude)
+
+	def manifest(self, path):
+		""" Returns ({name: stat} of regular files, [subdirectory names]),
+			leaving out excluded names
+		"""
+		files = {}
+		dirs = []
+		for name in os.listdir(path):
+			if self.excluded(name):
+				continue
+			st = os.lstat(os.path.join(path, name))
+			if stat.S_ISREG(st.st_mode):
+				files[name] = st
+			elif stat.S_ISDIR(st.st_mode):
+				dirs.append(name)
+		return files, dirs
+
+	@staticmethod
+	def changed(sourceStat, targetStat):
+		return targetStat is None \
+			or sourceStat.st_size != targetStat.st_size \
+			or int(sourceStat.st_mtime) != int(targetStat.st_mtime)
+
+	def syncDirectory(self, source, target, sourceManifest=None, held=None):
+		""" Syncs the files of one directory, not its subdirectories.
+			sourceManifest is the source's manifest if the caller has read it already.
+			held are the devices the caller holds a limiter slot on, the first
+			shard runs in that slot and each further one waits for its own
+			Returns a Counter of copied (and bytes), linked, cloned, relinked, deleted and unchanged files
+		"""
+		stats = Counter()
+		sourceStat = os.stat(source)
+		if not os.path.isdir(target):
+			self.makeDirectory(target, sourceStat, parents=True)
+		devices = (sourceStat.st_dev, os.stat(target).st_dev)
+
+		sourceFiles, sourceDirs = sourceManifest or self.manifest(source)
+		targetFiles, targetDirs = self.manifest(target)
+
+		# Subfolders are created empty, they are synced as mailboxes of their own
+		for name in sourceDirs:
+			if name not in targetDirs:
+				self.makeDirectory(os.path.join(target, name), os.stat(os.path.join(source, name)))
+
+		transfers = []
+		for name, st in sourceFiles.items():
+			if self.changed(st, targetFiles.get(name)):
+				transfers.append(name)
+			else:
+				if st.st_nlink > 1:
+					self.shared((st.st_dev, st.st_ino), os.path.join(target, name))
+				targetSt = targetFiles[name]
+				# As rsync --perms --owner, an unchanged file still gets its mode and owner
+				if (stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid) != \
+						(stat.S_IMODE(targetSt.st_mode), targetSt.st_uid, targetSt.st_gid):
+					self.copyPermissions(os.path.join(target, name), st)
+				stats['unchanged'] += 1
+
+		def transfer(names):
+			shardStats = Counter()
+			for name in names:
+				st = sourceFiles[name]
+				if self.rateLimits is not None:
+					self.rateLimits.files.take()
+				how = self.transferShared(os.path.join(source, name), os.path.join(target, name), st, devices)
+				shardStats[how] += 1
+				if how == 'copied':
+					shardStats['bytes'] += st.st_size
+					if self.rateLimits is not None:
+						self.rateLimits.bytes.take(st.st_size)
+			return shardStats
+
+		self.sortTransfers(source, transfers, sourceFiles, devices)
+		if self.shardThreads > 1 and len(transfers) > self.shardSize:
+			shards = [transfers[i:i + self.shardSize] for i in range(0, len(transfers), self.shardSize)]
+			logging.debug('transferring %d files of %r in %d shards', len(transfers), source, len(shards))
+			lent = [1 if held else 0]
+			limited = held or self.devices(source, target)
+
+			def transferLimited(names):
+				with self.limiter.slot(limited, lent):
+					return transfer(names)
+
+			for shardStats in self._shardMap(transferLimited, shards):
+				stats.update(shardStats)
+		else:
+			stats.update(transfer(transfers))
+
+		# Deletions are worked out once for the whole directory.
+		# Only files are pruned, a subdirectory is another mailbox
+		for name in targetFiles:
+			if name not in sourceFiles:
+				os.unlink(os.path.join(target, name))
+				stats['deleted'] += 1
+
+		self.copyAttributes(target, sourceStat)
+		if any(stats[name] for name in self.changes):
+			with self.lock:
+				self.modified.add(target)
+		logging.debug('synced %r to %r: %s', source, target, dict(stats))
+		return stats
+
+	def makeDirectory(self, path, st, parents=False):
+		""" Creates a directory with the attributes of st. The parent's sync
+			and a subfolder's own may race to create it, either one wins
+		"""
+		try:
+			if parents:
+				os.makedirs(path)
+			else:
+				os.mkdir(path)
+		except OSError as e:
+			if e.errno != errno.EEXIST:
+				raise
+			return
+		self.copyAttributes(path, st)
+
+	def shared(self, key, target):
+		""" Records target as a transferred copy of the source inode key,
+			unless one is known already
+		"""
+		with self.lock:
+			if key not in self.inodes:
+				event = threading.Event()
+				event.set()
+				self.inodes[key] = [event, target]
+
+	def transferShared(self, source, target, st, devices):
+		""" As transferFile, but a source file with other links is only
+			transferred the first time, later ones are linked to that copy.
+			Returns 'relinked' for those
+		"""
+		if st.st_nlink < 2:
+			return self.transferFile(source, target, st, devices)
+
+		key = (st.st_dev, st.st_ino)
+		with self.lock:
+			entry = self.inodes.get(key)
+			first = entry is None
+			if first:
+				entry = self.inodes[key] = [threading.Event(), None]
+
+		if first:
+			try:
+				how = self.transferFile(source, target, st, devices)
+				entry[1] = target
+				return how
+			finally:
+				entry[0].set()
+
+		# Another mailbox (maybe on another thread) has it, or is getting it
+		entry[0].wait()
+		if entry[1] and self.linkFile(entry[1], target) is None:
+			return 'relinked'
+		return self.transferFile(source, target, st, devices)
+
+	def transferFile(self, source, target, st, devices):
+		""" Puts source at target as self.mode says, where the devices allow.
+			Returns 'linked', 'cloned' or 'copied'
+		"""
+		if self.mode == 'hardlink' and devices not in self.unlinkable:
+			error = self.linkFile(source, target)
+			if error is None:
+				return 'linked'
+			if error in _noLinkDevices:
+				self.unlinkable.add(devices)
+		clone = self.mode == 'reflink' and devices not in self.unlinkable
+		if self.copyFile(source, target, st, clone):
+			return 'cloned'
+		if clone:
+			self.unlinkable.add(devices)
+		return 'copied'
+
+	@staticmethod
+	def linkFile(source, target):
+		""" Hardlinks source into place. Returns None, or the errno (one of
+			_noLink) if the filesystem refuses. Source and target share the
+			inode, so owner, mode and times match
+		"""
+		tmpPath = os.path.join(
+			os.path.dirname(target),
+			'.%s.%d.%d' % (os.path.basename(target), os.getpid(), thread.get_ident())
+		)
+		try:
+			os.link(source, tmpPath)
+		except OSError as e:
+			if e.errno not in _noLink:
+				raise
+			return e.errno
+		os.rename(tmpPath, target)
+
+	def copyFile(self, source, target, st, clone=False):
+		""" Copies through a temporary file in the target directory,
+			so a reader never sees a partial message. With clone the data
+			is reflinked if possible. Returns True if it was
+		"""
+		fd, tmpPath = tempfile.mkstemp(prefix='.%s.' % os.path.basename(target), dir=os.path.dirname(target))
+		try:
+			with open(source, 'rb') as fsrc:
+				cloned = clone and cloneData(fsrc.fileno(), fd)
+				if not cloned:
+					fadvise(fsrc.fileno(), POSIX_FADV_SEQUENTIAL, POSIX_FADV_WILLNEED)
+					copyData(fsrc.fileno(), fd, st.st_size)
+					fadvise(fsrc.fileno(), POSIX_FADV_DONTNEED)
+			os.close(fd)
+			fd = None
+			self.copyAttributes(tmpPath, st)
+			os.rename(tmpPath, target)
+		except:
+			if fd is not None:
+				os.close(fd)
+			os.unlink(tmpPath)
+			raise
+		return cloned
+
+	@staticmethod
+	def copyPermissions(path, st):
+		""" Owner and group (where permitted) and mode from st
+		"""
+		try:
+			os.chown(path, st.st_uid, st.st_gid)
+		except OSError as e:
+			# Only root may give files away, as with rsync --owner
+			if e.errno != errno.EPERM:
+				raise
+		os.chmod(path, stat.S_IMODE(st.st_mode))
+
+	@staticmethod
+	def copyAttributes(path, st):
+		""" Owner and group (where permitted), mode and times from st
+		"""
+		SyncEngine.copyPermissions(path, st)
+		os.utime(path, (st.st_atime, st.st_mtime))
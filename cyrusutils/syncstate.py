@@ -0,0 +1,107 @@
+""" Remembers, per old mailbox and migration phase, the fingerprint of the
+	old spool directory at the last successful run, so re-runs can skip
+	mailboxes that did not change since.
+"""
+import os
+import json
+import time
+import errno
+import struct
+import sqlite3
+
+# cyrus.index header fields (network order): exists, last_uid,
+# uidvalidity and the 64 bit highestmodseq
+_indexFields = ((20, '>I'), (28, '>I'), (44, '>I'), (72, '>Q'))
+_indexHeaderSize = 80
+
+
+def fingerprint(path, st=None):
+	""" Returns [exists, last_uid, uidvalidity, highestmodseq, mtime] of a
+		mailbox directory. The index fields are None without a cyrus.index
+		(eg an offline copy with headers only), the directory mtime still
+		moves whenever a message file is added or removed. st is the
+		directory's stat if the caller has it already
+	"""
+	if st is None:
+		st = os.stat(path)
+	try:
+		with open(os.path.join(path, 'cyrus.index'), 'rb') as f:
+			header = f.read(_indexHeaderSize)
+	except IOError as e:
+		if e.errno != errno.ENOENT:
+			raise
+		header = ''
+	if len(header) < _indexHeaderSize:
+		fields = [None] * len(_indexFields)
+	else:
+		fields = [struct.unpack_from(fmt, header, offset)[0] for offset, fmt in _indexFields]
+	return fields + [st.st_mtime]
+
+
+class SyncState(object):
+	""" SQLite store of (mailbox, target, phase) -> fingerprint, time of success.
+		The database file is only opened once used, and only created by the
+		first done(), so lookups (eg for a dry run) leave the disk alone
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.db = None
+		self.created = False
+
+	def _connect(self, create=False):
+		""" The connection, None while the database file does not exist
+			and create is False
+		"""
+		if self.db is None:
+			if not create and not os.path.exists(self.path):
+				return None
+			self.db = sqlite3.connect(self.path, timeout=60)
+		if create and not self.created:
+			self.db.execute(
+				'CREATE TABLE IF NOT EXISTS mailboxes ('
+				' mailbox TEXT NOT NULL,'
+				' target TEXT NOT NULL,'
+				' phase TEXT NOT NULL,'
+				' fingerprint TEXT NOT NULL,'
+				' synced REAL NOT NULL,'
+				' PRIMARY KEY (mailbox, target, phase))'
+			)
+			self.db.commit()
+			self.created = True
+		return self.db
+
+	def close(self):
+		if self.db is not None:
+			self.db.close()
+			self.db = None
+
+	def _lookup(self, column, phase, mailbox, target):
+		db = self._connect()
+		if db is None:
+			return None
+		row = db.execute(
+			'SELECT %s FROM mailboxes WHERE mailbox = ? AND target = ? AND phase = ?' % column,
+			(mailbox, target, phase)
+		).fetchone()
+		return row and row[0]
+
+	def unchanged(self, phase, mailbox, target, fingerprint):
+		""" True if phase last succeeded for mailbox -> target with this fingerprint
+		"""
+		return self._lookup('fingerprint', phase, mailbox, target) == json.dumps(fingerprint)
+
+	def done(self, phase, items):
+		""" Records a successful phase for each (mailbox, target, fingerprint)
+		"""
+		now = time.time()
+		db = self._connect(create=True)
+		db.executemany(
+			'INSERT OR REPLACE INTO mailboxes (mailbox, target, phase, fingerprint, synced) VALUES (?, ?, ?, ?, ?)',
+			[(mailbox, target, phase, json.dumps(fingerprint), now) for mailbox, target, fingerprint in items]
+		)
+		db.commit()
+
+	def synced(self, phase, mailbox, target):
+		""" Time phase last succeeded for mailbox -> target, None if never
+		"""
+		return self._lookup('synced', phase, mailbox, target)
@@ -0,0 +1,516 @@
+""" Unit tests for cyruslib, run against a local stand-in IMAP server
+"""
+import socket
+import ssl
+import unittest
+from StringIO import StringIO
+from cyrusutils import cyruslib
+from tests.imapserver import ImapServer, ImapsServer
+
+MAILBOXES = [
+	'user.bob',
+	'user.bob.Sent',
+	'user.bob.Trash',
+	'user.joe',
+]
+
+class Test_Cyruslib_Compress(unittest.TestCase):
+	""" Test COMPRESS=DEFLATE negotiation
+	"""
+	def setUp(self):
+		self.server = ImapServer(
+			capabilities=('IMAP4rev1', 'COMPRESS=DEFLATE'),
+			mailboxes=MAILBOXES
+		)
+
+	def tearDown(self):
+		self.server.stop()
+
+	def test_compressNegotiated(self):
+		imap = cyruslib.CYRUS(self.server.url)
+		imap.login('cyrus', 'secret')
+		self.assertTrue(imap.m.deflate is not None)
+		self.assertEqual(imap.lm('user.bob*'), ['user.bob', 'user.bob.Sent', 'user.bob.Trash'])
+
+		# The LIST was sent compressed
+		self.assertEqual(self.server.commands[-1][:2], ('LIST', ['*', 'user.bob*']))
+		self.assertTrue(self.server.commands[-1][2])
+		self.assertTrue(imap.m.deflate.rawin > 0)
+		self.assertTrue(imap.m.deflate.bytesin > 0)
+		imap.logout()
+
+	def test_compressDisabled(self):
+		imap = cyruslib.CYRUS(self.server.url, compress=False)
+		imap.login('cyrus', 'secret')
+		self.assertTrue(imap.m.deflate is None)
+		self.assertFalse('COMPRESS' in self.server.commandNames())
+		self.assertEqual(imap.lm('user.joe'), ['user.joe'])
+		imap.logout()
+
+	def test_compressNotAdvertised(self):
+		self.server.capabilities.remove('COMPRESS=DEFLATE')
+		imap = cyruslib.CYRUS(self.server.url)
+		imap.login('cyrus', 'secret')
+		self.assertTrue(imap.m.deflate is None)
+		self.assertFalse('COMPRESS' in self.server.commandNames())
+		self.assertEqual(imap.lm('user.joe'), ['user.joe'])
+		imap.logout()
+
+	def test_deflateStreamLargeLiteral(self):
+		""" Reads spanning many compressed chunks come back intact
+		"""
+		payload = ''.join(chr(i % 251) for i in range(200000))
+		deflater = cyruslib.DeflateStream(None, None)
+		sent = []
+		deflater.sendall = sent.append
+		deflater.write('* 1 FETCH (BODY[] {%d}\r\n' % len(payload))
+		deflater.write(payload + ')\r\n')
+
+		data = ''.join(sent)
+		chunks = [data[i:i + 1000] for i in range(0, len(data), 1000)]
+		chunks.reverse()
+		inflater = cyruslib.DeflateStream(lambda size: chunks and chunks.pop() or '', None)
+		self.assertEqual(inflater.readline(), '* 1 FETCH (BODY[] {%d}\r\n' % len(payload))
+		self.assertEqual(inflater.read(len(payload)), payload)
+		self.assertEqual(inflater.readline(), ')\r\n')
+		self.assertEqual(inflater.readline(), '')
+
+
+class Test_Cyruslib_Login(unittest.TestCase):
+	""" Test the pipelined LOGIN/DUMP/LIST exchange and probe cache
+	"""
+	def setUp(self):
+		socket.setdefaulttimeout(5)
+		self.server = ImapServer(mailboxes=MAILBOXES)
+
+	def tearDown(self):
+		socket.setdefaulttimeout(None)
+		self.server.stop()
+
+	def test_loginPipelined(self):
+		# Responses are only released once all three commands arrived
+		self.server.cork = ('LOGIN', 3)
+		imap = cyruslib.CYRUS(self.server.url)
+		imap.login('cyrus', 'secret')
+		self.assertEqual(self.server.commandNames(), ['CAPABILITY', 'LOGIN', 'DUMP', 'LIST'])
+		self.assertEqual(imap.ADMIN, 'cyrus')
+		self.assertEqual(imap.SEP, '.')
+		self.assertEqual(imap.lm('user.joe'), ['user.joe'])
+		imap.logout()
+
+	def test_loginCached(self):
+		imap = cyruslib.CYRUS(self.server.url)
+		imap.login('cyrus', 'secret')
+		imap.logout()
+		del self.server.commands[:]
+
+		imap = cyruslib.CYRUS(self.server.url)
+		imap.login('cyrus', 'secret')
+		self.assertEqual(self.server.commandNames(), ['CAPABILITY', 'LOGIN'])
+		self.assertEqual(imap.ADMIN, 'cyrus')
+		self.assertEqual(imap.SEP, '.')
+		imap.logout()
+
+	def test_loginNotAdmin(self):
+		imap = cyruslib.CYRUS(self.server.url)
+		self.assertRaises(cyruslib.CYRUSError, imap.login, 'bob', 'secret')
+		imap = cyruslib.CYRUS(self.server.url)
+		imap.login('bob', 'secret', forceNoAdmin=True)
+		self.assertEqual(imap.ADMIN, 'bob')
+		imap.logout()
+
+
+class Test_Cyruslib_TLS(unittest.TestCase):
+	""" Test IMAPS connections sharing an SSLContext
+	"""
+	def setUp(self):
+		socket.setdefaulttimeout(5)
+		self.server = ImapsServer(
+			capabilities=('IMAP4rev1', 'COMPRESS=DEFLATE'),
+			mailboxes=MAILBOXES
+		)
+		self.context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+		self.context.verify_mode = ssl.CERT_NONE
+
+	def tearDown(self):
+		socket.setdefaulttimeout(None)
+		self.server.stop()
+
+	def test_sharedContext(self):
+		for _ in range(2):
+			imap = cyruslib.CYRUS(self.server.url, ssl_context=self.context)
+			imap.login('cyrus', 'secret')
+			self.assertEqual(imap.lm('user.joe'), ['user.joe'])
+			stats = imap.stats()
+			self.assertEqual(stats['handshakes'], 1)
+			self.assertTrue(stats['handshake_time'] > 0)
+			# COMPRESS runs on top of TLS
+			self.assertTrue(stats['compressed_in'] > 0)
+			imap.logout()
+
+	def test_handshakeTotals(self):
+		count, seconds = cyruslib.HANDSHAKES.count, cyruslib.HANDSHAKES.seconds
+		context = cyruslib.sslcontext()
+		sessions = [cyruslib.CYRUS(self.server.url, ssl_context=context) for _ in range(3)]
+		self.assertEqual(cyruslib.HANDSHAKES.count, count + 3)
+		self.assertTrue(cyruslib.HANDSHAKES.seconds > seconds)
+		for imap in sessions:
+			imap.login('cyrus', 'secret')
+			imap.logout()
+
+	def test_defaultContext(self):
+		imap = cyruslib.CYRUS(self.server.url)
+		imap.login('cyrus', 'secret')
+		self.assertEqual(imap.stats()['handshakes'], 1)
+		imap.logout()
+
+
+class Test_Cyruslib_Recursive(unittest.TestCase):
+	""" Test pipelined recursive dm and reconstruct
+	"""
+	def setUp(self):
+		socket.setdefaulttimeout(5)
+		self.server = ImapServer(mailboxes=[
+			'shared',
+			'shared.a',
+			'shared.a.b',
+			'shared.c',
+			'user.bob',
+		])
+		self.imap = cyruslib.CYRUS(self.server.url)
+		self.imap.login('cyrus', 'secret')
+		del self.server.commands[:]
+
+	def tearDown(self):
+		self.imap.logout()
+		socket.setdefaulttimeout(None)
+		self.server.stop()
+
+	def test_dmRecursive(self):
+		# Nothing is answered until all four SETACLs were sent
+		self.server.cork = ('SETACL', 4)
+		report = self.imap.dm('shared')
+		self.assertEqual(
+			report,
+			[
+				('shared.c', 'OK', 'Completed'),
+				('shared.a.b', 'OK', 'Completed'),
+				('shared.a', 'OK', 'Completed'),
+				('shared', 'OK', 'Completed'),
+			]
+		)
+		self.assertEqual(sorted(self.server.mailboxes), ['user.bob'])
+
+	def test_dmSetaclFailure(self):
+		self.server.failures.add(('SETACL', 'shared.a.b'))
+		try:
+			self.imap.dm('shared')
+			self.fail('dm did not raise')
+		except cyruslib.CYRUSError as e:
+			self.assertTrue('shared.a.b: Permission denied' in e.args[2])
+			# Each mailbox's own result
+			self.assertEqual(
+				sorted([(mbox, res) for mbox, res, _ in e.report]),
+				[('shared', 'NO'), ('shared.a', 'NO'), ('shared.a.b', 'NO'), ('shared.c', 'OK')]
+			)
+		# Neither the mailbox nor its parents were deleted, its sibling was
+		self.assertEqual(sorted(self.server.mailboxes), ['shared', 'shared.a', 'shared.a.b', 'user.bob'])
+		self.assertEqual(self.server.commandNames().count('DELETE'), 1)
+
+	def test_dmRecursiveFailure(self):
+		self.server.failures.add(('DELETE', 'shared.a.b'))
+		self.assertRaises(cyruslib.CYRUSError, self.imap.dm, 'shared')
+		# Every other command in the pipeline was still answered
+		self.assertEqual(sorted(self.server.mailboxes), ['shared', 'shared.a', 'shared.a.b', 'user.bob'])
+		self.assertEqual(self.imap.lm('user.bob'), ['user.bob'])
+
+	def test_reconstructRecursive(self):
+		self.server.cork = ('RECONSTRUCT', 2)
+		report = self.imap.reconstruct('shared.a')
+		self.assertEqual([mbox for mbox, _, _ in report], ['shared.a.b', 'shared.a'])
+		self.assertTrue(self.server.mailboxes['shared.a.b'].reconstructed)
+		self.assertFalse(self.server.mailboxes['shared.c'].reconstructed)
+
+	def test_reconstructSingle(self):
+		report = self.imap.reconstruct('shared', recursive=False)
+		self.assertEqual(report, [('shared', 'OK', 'Completed')])
+		self.assertEqual(self.server.commandNames(), ['RECONSTRUCT'])
+
+	def test_reconstructall(self):
+		self.server.cork = ('RECONSTRUCT', 2)
+		report = self.imap.reconstructall(['shared.a.b', 'user.bob'])
+		self.assertEqual(report, [('shared.a.b', 'OK', 'Completed'), ('user.bob', 'OK', 'Completed')])
+		self.assertEqual(self.server.commandNames(), ['RECONSTRUCT', 'RECONSTRUCT'])
+		self.assertFalse(self.server.mailboxes['shared.a'].reconstructed)
+
+
+class Test_Cyruslib_Acl(unittest.TestCase):
+	""" Test bulk ACL snapshot and restore
+	"""
+	def setUp(self):
+		socket.setdefaulttimeout(5)
+		self.server = ImapServer(mailboxes=MAILBOXES + ['user.bob.folder 2'])
+		self.server.mailboxes['user.bob'].acl = {'bob': 'lrswipkxtecda', 'anyone': 'p'}
+		self.server.mailboxes['user.bob.folder 2'].acl = {'bob': 'lrswipkxtecda', 'joe': 'lrs'}
+		self.imap = cyruslib.CYRUS(self.server.url)
+		self.imap.login('cyrus', 'secret')
+		del self.server.commands[:]
+
+	def tearDown(self):
+		self.imap.logout()
+		socket.setdefaulttimeout(None)
+		self.server.stop()
+
+	def test_aclsnapshot(self):
+		self.server.cork = ('GETACL', 4)
+		snapshot = self.imap.aclsnapshot('user.bob*')
+		self.assertEqual(
+			snapshot,
+			{
+				'user.bob': {'bob': 'lrswipkxtecda', 'anyone': 'p'},
+				'user.bob.Sent': {},
+				'user.bob.Trash': {},
+				'user.bob.folder 2': {'bob': 'lrswipkxtecda', 'joe': 'lrs'},
+			}
+		)
+
+	def test_aclrestore(self):
+		snapshot = {
+			'user.joe': {'bob': 'lrs', 'anyone': 'p', 'admin': 'lrswipkxtecda'},
+		}
+		def rewrite(userid):
+			if userid == 'admin':
+				return None
+			return userid if userid == 'anyone' else userid + '@example.com'
+
+		self.server.cork = ('SETACL', 2)
+		report = self.imap.aclrestore(snapshot, rewrite=rewrite)
+		self.assertEqual(len(report), 2)
+		self.assertEqual(
+			self.server.mailboxes['user.joe'].acl,
+			{'bob@example.com': 'lrs', 'anyone': 'p'}
+		)
+
+
+class Test_Cyruslib_Quota(unittest.TestCase):
+	""" Test the pipelined quota report
+	"""
+	def setUp(self):
+		socket.setdefaulttimeout(5)
+		self.server = ImapServer(mailboxes=MAILBOXES + ['user.ann', 'user.zed', 'shared'])
+		self.server.mailboxes['user.bob'].quota = (300, 1000)
+		self.server.mailboxes['user.joe'].quota = (700, 1000)
+		self.server.mailboxes['user.ann'].quota = ()
+		self.imap = cyruslib.CYRUS(self.server.url)
+		self.imap.login('cyrus', 'secret')
+
+	def tearDown(self):
+		self.imap.logout()
+		socket.setdefaulttimeout(None)
+		self.server.stop()
+
+	def test_quotareport(self):
+		self.server.cork = ('GETQUOTAROOT', 4)
+		report = self.imap.quotareport()
+		self.assertEqual(
+			list(report),
+			[('user.ann', 0, 0), ('user.bob', 300, 1000), ('user.joe', 700, 1000)]
+		)
+		report.sort()
+		self.assertEqual(report.root, ['user.joe', 'user.bob', 'user.ann'])
+
+		out = StringIO()
+		report.write(out)
+		self.assertEqual(
+			out.getvalue().splitlines(),
+			['root,used,limit', 'user.joe,700,1000', 'user.bob,300,1000', 'user.ann,0,0']
+		)
+
+	def test_quotareportStreamed(self):
+		# Each response is parsed before the next one is read
+		events = []
+		pipeline, untagged = self.imap.m.pipeline, self.imap.m.untagged
+		def recordPipeline(commands):
+			for result in pipeline(commands):
+				events.append('response')
+				yield result
+		def recordUntagged(name):
+			events.append('parse')
+			return untagged(name)
+		self.imap.m.pipeline, self.imap.m.untagged = recordPipeline, recordUntagged
+		self.imap.quotareport()
+		self.assertEqual(events[:4], ['response', 'parse', 'parse', 'response'])
+
+	def test_quotareportSubfolders(self):
+		# Subfolders share their user's root, which is reported once
+		report = self.imap.quotareport('user.bob*')
+		self.assertEqual(list(report), [('user.bob', 300, 1000)])
+
+
+class Test_Cyruslib_Annotation(unittest.TestCase):
+	""" Test pipelined SETANNOTATION
+	"""
+	def setUp(self):
+		socket.setdefaulttimeout(5)
+		self.server = ImapServer(mailboxes=MAILBOXES)
+		self.imap = cyruslib.CYRUS(self.server.url)
+		self.imap.login('cyrus', 'secret')
+
+	def tearDown(self):
+		self.imap.logout()
+		socket.setdefaulttimeout(None)
+		self.server.stop()
+
+	def test_setannotations(self):
+		self.server.cork = ('SETANNOTATION', 3)
+		report = self.imap.setannotations({
+			'user.bob': {'/comment': 'Inbox', '/vendor/cmu/cyrus-imapd/expire': '30'},
+			'user.joe': {'/comment': 'Joe mail'},
+		})
+		self.assertEqual(len(report), 3)
+		self.assertEqual(
+			self.server.mailboxes['user.bob'].annotations,
+			{'/comment': 'Inbox', '/vendor/cmu/cyrus-imapd/expire': '30'}
+		)
+		self.assertEqual(self.server.mailboxes['user.joe'].annotations, {'/comment': 'Joe mail'})
+
+
+class Test_Cyruslib_Xfer(unittest.TestCase):
+	""" Test XFER, single and pipelined
+	"""
+	def setUp(self):
+		socket.setdefaulttimeout(5)
+		self.server = ImapServer(mailboxes=MAILBOXES)
+		self.imap = cyruslib.CYRUS(self.server.url)
+		self.imap.login('cyrus', 'secret')
+		del self.server.commands[:]
+
+	def tearDown(self):
+		self.imap.logout()
+		socket.setdefaulttimeout(None)
+		self.server.stop()
+
+	def test_xfer(self):
+		self.imap.xfer('user.bob', 'backend2', 'spool2')
+		self.assertEqual(self.server.transferred, [('user.bob', 'backend2', 'spool2')])
+		self.assertEqual(sorted(self.server.mailboxes), ['user.joe'])
+
+	def test_xferall(self):
+		progress = []
+		self.server.cork = ('XFER', 2)
+		report = self.imap.xferall(['user.bob', 'user.joe'], 'backend2', progress=lambda *args: progress.append(args))
+		self.assertEqual(report, [('user.bob', 'OK', 'Completed'), ('user.joe', 'OK', 'Completed')])
+		self.assertEqual(
+			progress,
+			[(1, 2, 'user.bob', 'OK', 'Completed'), (2, 2, 'user.joe', 'OK', 'Completed')]
+		)
+		self.assertEqual(self.server.mailboxes, {})
+
+	def test_xferallFailure(self):
+		self.server.failures.add(('XFER', 'user.bob'))
+		self.assertRaises(cyruslib.CYRUSError, self.imap.xferall, ['user.bob', 'user.joe'], 'backend2')
+		self.assertEqual(self.server.transferred, [('user.joe', 'backend2', None)])
+
+
+class Test_Cyruslib_Messages(unittest.TestCase):
+	""" Test UID FETCH and pipelined (MULTI)APPEND
+	"""
+	def setUp(self):
+		socket.setdefaulttimeout(5)
+		self.source = ImapServer(mailboxes=['user.bob'])
+		self.source.mailboxes['user.bob'].add('Subject: one\r\n\r\nfirst\r\n', ['\\Seen'])
+		self.source.mailboxes['user.bob'].add('Subject: two\r\n\r\nsecond\r\n', ['\\Answered', '\\Seen'])
+		self.source.mailboxes['user.bob'].add('Subject: three\r\n\r\nthird\r\n', [], '02-Feb-2011 10:00:00 +0100')
+		self.imap = cyruslib.CYRUS(self.source.url)
+		self.imap.login('cyrus', 'secret')
+
+	def tearDown(self):
+		self.imap.logout()
+		socket.setdefaulttimeout(None)
+		self.source.stop()
+
+	def target(self, capabilities):
+		server = ImapServer(capabilities=capabilities, mailboxes=['user.brian'])
+		imap = cyruslib.CYRUS(server.url)
+		imap.login('cyrus', 'secret')
+		del server.commands[:]
+		self.addCleanup(server.stop)
+		self.addCleanup(imap.logout)
+		return server, imap
+
+	def test_parsefetch(self):
+		data = [
+			('2 (UID 7 BODY[] {3}', 'two'),
+			' FLAGS (\\Seen \\Recent) INTERNALDATE "02-Feb-2011 10:00:00 +0100")',
+			('1 (UID 3 FLAGS () INTERNALDATE "01-Jan-2010 00:00:00 +0000" BODY[] {3}', 'one'),
+			')',
+		]
+		self.assertEqual(
+			cyruslib.parsefetch(data),
+			[
+				(3, '()', '"01-Jan-2010 00:00:00 +0000"', 'one'),
+				(7, '(\\Seen)', '"02-Feb-2011 10:00:00 +0100"', 'two'),
+			]
+		)
+
+	def test_fetchmessages(self):
+		self.assertEqual(self.imap.examine('user.bob'), 1)
+		messages = list(self.imap.fetchmessages(batch=2))
+		self.assertEqual([uid for uid, _, _, _ in messages], [1, 2, 3])
+		self.assertEqual(messages[1][1:3], ('(\\Answered \\Seen)', '"01-Jan-2010 00:00:00 +0000"'))
+		self.assertEqual(messages[2][3], 'Subject: three\r\n\r\nthird\r\n')
+		self.assertEqual(self.source.commandNames()[-3:], ['UID', 'UID', 'UID'])
+
+	def test_fetchmessagesAbove(self):
+		self.imap.examine('user.bob')
+		self.assertEqual([uid for uid, _, _, _ in self.imap.fetchmessages(2)], [3])
+		self.assertEqual(list(self.imap.fetchmessages(3)), [])
+
+	def test_appendMultiappend(self):
+		server, imap = self.target(['IMAP4rev1', 'LITERAL+', 'MULTIAPPEND'])
+		self.imap.examine('user.bob')
+		done = []
+		count = imap.appendmessages('user.brian', self.imap.fetchmessages(), done=done.append)
+		self.assertEqual(count, 3)
+		self.assertEqual(done, [3])
+		self.assertEqual(server.commandNames(), ['APPEND'])
+		self.assertEqual(
+			[message[1:] for message in server.mailboxes['user.brian'].messages],
+			[message[1:] for message in self.source.mailboxes['user.bob'].messages]
+		)
+
+	def test_appendLiteralPlus(self):
+		server, imap = self.target(['IMAP4rev1', 'LITERAL+'])
+		self.imap.examine('user.bob')
+		done = []
+		server.cork = ('APPEND', 3)
+		imap.appendmessages('user.brian', self.imap.fetchmessages(), done=done.append)
+		self.assertEqual(done, [1, 2, 3])
+		self.assertEqual(server.commandNames(), ['APPEND', 'APPEND', 'APPEND'])
+		self.assertEqual(len(server.mailboxes['user.brian'].messages), 3)
+
+	def test_appendWindow(self):
+		server, imap = self.target(['IMAP4rev1', 'LITERAL+'])
+		self.imap.examine('user.bob')
+		# Each message fills the window, so none are pipelined
+		imap.appendmessages('user.brian', self.imap.fetchmessages(), window=1)
+		self.assertEqual(len(server.mailboxes['user.brian'].messages), 3)
+
+	def test_appendSynchronizing(self):
+		server, imap = self.target(['IMAP4rev1'])
+		self.imap.examine('user.bob')
+		self.assertEqual(imap.appendmessages('user.brian', self.imap.fetchmessages()), 3)
+		self.assertEqual(
+			[message[1:] for message in server.mailboxes['user.brian'].messages],
+			[message[1:] for message in self.source.mailboxes['user.bob'].messages]
+		)
+
+	def test_appendFailure(self):
+		server, imap = self.target(['IMAP4rev1', 'LITERAL+'])
+		self.imap.examine('user.bob')
+		done = []
+		self.assertRaises(
+			cyruslib.CYRUSError,
+			imap.appendmessages, 'user.joe', self.imap.fetchmessages(), done=done.append
+		)
+		self.assertEqual(done, [])
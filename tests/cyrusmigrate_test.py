@@ -1,7 +1,36 @@
 """ Unit tests for CyrusMigrate class
 """
+import os
+import shutil
+import socket
+import struct
+import tempfile
 import unittest
+from StringIO import StringIO
+from cyrusutils import cyrusmigrate
 from cyrusutils.cyrusmigrate import CyrusMigrate
+from cyrusutils.cyruslib import CYRUSError
+from tests.imapserver import ImapServer
+
+def skiplistFile(path, records):
+	""" Writes a minimal skiplist file with (key, data) INORDER records
+	"""
+	def pad(text):
+		return text + '\0' * (-len(text) % 4)
+
+	with open(path, 'wb') as fp:
+		fp.write('\xa1\x02\x8b\x0dskiplist file\0\0\0')
+		fp.write(struct.pack('>7I', 1, 2, 20, 1, len(records), 0, 0))
+		fp.write(struct.pack('>4I', 257, 0, 0, 0) + '\xff\xff\xff\xff')
+		for key, data in records:
+			fp.write(struct.pack('>2I', 1, len(key)) + pad(key))
+			fp.write(struct.pack('>I', len(data)) + pad(data))
+			fp.write(struct.pack('>I', 0) + '\xff\xff\xff\xff')
+
+def annotationData(value, size=4):
+	""" annotations.db value, size is sizeof(unsigned long) of the writer
+	"""
+	return struct.pack('>I', len(value)) + '\0' * (size - 4) + value + '\0text/plain\0' + '1234567890\0'
 
 class MockImap(object):
 	def __init__(self):
@@ -58,11 +87,39 @@ class MockImap(object):
 	def lm(self, mailbox):
 		return self._mailboxes.get(mailbox, [])
 
-	def reconstruct(self, mailbox):
-		pass
+	def reconstruct(self, mailbox, recursive=True):
+		self.reconstructed = getattr(self, 'reconstructed', []) + [mailbox]
+
+	def reconstructall(self, mailboxes):
+		self.reconstructed = getattr(self, 'reconstructed', []) + list(mailboxes)
 
 	def cm(self, mailbox):
-		pass
+		if mailbox in getattr(self, 'failCreate', ()):
+			raise CYRUSError(20, 'CREATE', 'Permission denied')
+		self.created = getattr(self, 'created', []) + [mailbox]
+
+	def rename(self, fromMbx, toMbx):
+		self.renamed = getattr(self, 'renamed', []) + [(fromMbx, toMbx)]
+
+	def aclsnapshot(self, mailboxes):
+		return dict((mbox, {'bob': 'lrswipkxtecda', 'alice': 'lrs'}) for mbox in mailboxes)
+
+	def getannotation(self, pattern):
+		self.annotationPattern = pattern
+		return {
+			'user.bob': {'/comment': 'Inbox', '/vendor/cmu/cyrus-imapd/size': '1024'},
+			'user.bob.ufolder1': {'/vendor/cmu/cyrus-imapd/expire': '30'},
+			'user.bobby': {'/comment': 'Not ours'},
+		}
+
+	def setannotations(self, annotations):
+		self.annotations = annotations
+
+	def aclrestore(self, snapshot, rewrite):
+		self.restored = dict(
+			(mbox, dict((rewrite(userid), rights) for userid, rights in acl.items()))
+			for mbox, acl in snapshot.items()
+		)
 
 class Test_CyrusMigrate_Common(unittest.TestCase):
 	""" Test cyrusmigrate common functions (static or class)
@@ -198,6 +255,355 @@ class Test_CyrusMigrate_Common(unittest.TestCase):
 			)
 
 
+	def test_annotationFromRecord(self):
+		self.assertEqual(
+			CyrusMigrate._annotationFromRecord('user.bob\0/comment\0\0', annotationData('hello')),
+			('user.bob', '/comment', '', 'hello')
+		)
+		self.assertEqual(
+			CyrusMigrate._annotationFromRecord('example.com!user.bob\0/comment\0bob\0', annotationData('hello', 8)),
+			('user.bob@example.com', '/comment', 'bob', 'hello')
+		)
+		self.assertEqual(
+			CyrusMigrate._annotationFromRecord('shared\0/comment\0\0', annotationData('')),
+			('shared', '/comment', '', '')
+		)
+
+
+class Test_CyrusMigrate_Offline(unittest.TestCase):
+	""" Test cyrusmigrate reading an offline copy of the old server (rootPath)
+	"""
+	def setUp(self):
+		self.rootPath = tempfile.mkdtemp()
+		for folder in ('', 'Sent', 'Sent/2010'):
+			path = os.path.join(self.rootPath, 'var/spool/imap/user/bob', folder)
+			os.makedirs(path)
+			open(os.path.join(path, 'cyrus.header'), 'w').close()
+		os.makedirs(os.path.join(self.rootPath, 'var/lib/imap'))
+		self.cyrus = CyrusMigrate(MockImap(), 'user.bob', 'user.brian@example.com', rootPath=self.rootPath)
+
+	def tearDown(self):
+		shutil.rmtree(self.rootPath)
+
+	def test_oldMailboxes(self):
+		self.assertEqual(
+			sorted(self.cyrus.oldMailboxes),
+			['user.bob', 'user.bob.Sent', 'user.bob.Sent.2010']
+		)
+
+	def test_canRename(self):
+		self.assertFalse(self.cyrus.canRename)
+
+	def test_extractMailboxId(self):
+		path = os.path.join(self.rootPath, 'var/spool/imap/user/bob')
+		with open(os.path.join(path, 'cyrus.header'), 'w') as f:
+			f.write(CyrusMigrate._headerMagic + 'user.bob\t4a5b6c7d8e9f0a1b\n')
+		self.assertEqual(self.cyrus._extractMailboxId(path), '4a5b6c7d8e9f0a1b')
+		# Later lookups come from the cache, while the file is unchanged
+		st = os.stat(os.path.join(path, 'cyrus.header'))
+		CyrusMigrate._headerCache[os.path.join(path, 'cyrus.header')] = (st.st_mtime, st.st_ino, 'cached')
+		self.assertEqual(self.cyrus._extractMailboxId(path), 'cached')
+		os.utime(os.path.join(path, 'cyrus.header'), (0, 0))
+		self.assertEqual(self.cyrus._extractMailboxId(path), '4a5b6c7d8e9f0a1b')
+
+	def test_headerCacheBounded(self):
+		path = os.path.join(self.rootPath, 'var/spool/imap/user/bob')
+		with open(os.path.join(path, 'cyrus.header'), 'w') as f:
+			f.write(CyrusMigrate._headerMagic + 'user.bob\t4a5b6c7d8e9f0a1b\n')
+		self.cyrus.headerCacheSize = 2
+		CyrusMigrate._headerCache.clear()
+		CyrusMigrate._headerCache.update({'a': None, 'b': None})
+		self.cyrus._extractMailboxId(path)
+		self.assertEqual(list(CyrusMigrate._headerCache), [os.path.join(path, 'cyrus.header')])
+
+	def test_oldAnnotations(self):
+		skiplistFile(os.path.join(self.rootPath, 'var/lib/imap/annotations.db'), [
+			('user.bob\0/comment\0\0', annotationData('Inbox')),
+			('user.bob\0/comment\0bob\0', annotationData('Private')),
+			('user.bob.Sent\0/vendor/cmu/cyrus-imapd/expire\0\0', annotationData('30', 8)),
+			('user.bobby\0/comment\0\0', annotationData('Not ours')),
+		])
+		self.assertEqual(
+			self.cyrus.oldAnnotations(),
+			{
+				'user.bob': {'/comment': 'Inbox'},
+				'user.bob.Sent': {'/vendor/cmu/cyrus-imapd/expire': '30'},
+			}
+		)
+
+
+class TmpCyrusMigrate(CyrusMigrate):
+	""" Writes the new spool under a temporary directory
+	"""
+	newRoot = None
+
+	@property
+	def _oldPartitionRoot(self):
+		return os.path.normpath(self.rootPath + '/var/spool/imap')
+
+	@property
+	def _newPartitionRoot(self):
+		return os.path.join(self.newRoot, 'var/spool/imap')
+
+
+class Test_CyrusMigrate_SyncState(unittest.TestCase):
+	""" Test re-runs skipping mailboxes that did not change
+	"""
+	def setUp(self):
+		self.rootPath = tempfile.mkdtemp()
+		for folder in ('', 'vfolder1'):
+			path = os.path.join(self.rootPath, 'var/spool/imap/user/bob', folder)
+			os.makedirs(path)
+			open(os.path.join(path, 'cyrus.header'), 'w').close()
+			open(os.path.join(path, '1.'), 'w').close()
+			os.utime(path, (1300000000, 1300000000))
+		TmpCyrusMigrate.newRoot = os.path.join(self.rootPath, 'new')
+		self.syncDb = os.path.join(self.rootPath, 'sync.db')
+
+	def tearDown(self):
+		shutil.rmtree(self.rootPath)
+
+	def migration(self):
+		return TmpCyrusMigrate(
+			MockImap(), 'user.bob', 'user.joe@example.com', rootPath=self.rootPath, syncDb=self.syncDb
+		)
+
+	def test_syncFiles(self):
+		self.migration().syncFiles()
+		newFile = os.path.join(TmpCyrusMigrate.newRoot, 'var/spool/imap/domain/example.com/user/joe/1.')
+		self.assertTrue(os.path.exists(newFile))
+
+		# Skipped while the old mailbox is unchanged
+		os.unlink(newFile)
+		self.migration().syncFiles()
+		self.assertFalse(os.path.exists(newFile))
+
+		os.utime(os.path.join(self.rootPath, 'var/spool/imap/user/bob'), (1300000001, 1300000001))
+		self.migration().syncFiles()
+		self.assertTrue(os.path.exists(newFile))
+
+	def test_reconstruct(self):
+		migration = self.migration()
+		migration.reconstruct()
+		self.assertEqual(len(migration.imap.reconstructed), 7)
+
+		# Only new mailboxes without an unchanged old one
+		migration = self.migration()
+		migration.reconstruct()
+		self.assertEqual(
+			migration.imap.reconstructed,
+			[
+				'user.joe.vfolder1.sub1@example.com',
+				'user.joe.vfolder1.sub 2@example.com',
+				'user.joe.vfolder 2@example.com',
+				'user.joe.vfolder 2.sub1@example.com',
+				'user.joe.vfolder 2.sub 2@example.com',
+			]
+		)
+
+	def test_reconstructModified(self):
+		migration = self.migration()
+		migration.syncFiles()
+		migration.reconstruct()
+		self.assertEqual(migration.imap.reconstructed, ['user.joe@example.com', 'user.joe.vfolder1@example.com'])
+
+		# Synced again with a changed mtime but the same files: nothing to do
+		os.utime(os.path.join(self.rootPath, 'var/spool/imap/user/bob'), (1300000001, 1300000001))
+		migration = self.migration()
+		migration.syncFiles()
+		migration.reconstruct()
+		self.assertEqual(getattr(migration.imap, 'reconstructed', []), [])
+
+	def test_reconstructSessions(self):
+		migration = self.migration()
+		other = MockImap()
+		migration.reconstructSessions = [other]
+		migration.syncFiles()
+		migration.reconstruct()
+		self.assertEqual(migration.imap.reconstructed, ['user.joe@example.com'])
+		self.assertEqual(other.reconstructed, ['user.joe.vfolder1@example.com'])
+
+
+class Test_CyrusMigrate_Pipeline(unittest.TestCase):
+	""" Test creating, syncing and reconstructing as a pipeline
+	"""
+	def setUp(self):
+		self.rootPath = tempfile.mkdtemp()
+		for folder in ('', 'Sent', 'Sent/2011', 'Trash'):
+			path = os.path.join(self.rootPath, 'var/spool/imap/user/bob', folder)
+			os.makedirs(path)
+			open(os.path.join(path, 'cyrus.header'), 'w').close()
+			with open(os.path.join(path, '1.'), 'w') as f:
+				f.write(folder)
+		TmpCyrusMigrate.newRoot = os.path.join(self.rootPath, 'new')
+		self.imap = MockImap()
+		self.imap._mailboxes = {}
+		self.migration = TmpCyrusMigrate(self.imap, 'user.bob', 'user.bill@example.com', rootPath=self.rootPath)
+		self.migration.pipelineDepth = 1
+
+	def tearDown(self):
+		shutil.rmtree(self.rootPath)
+
+	def test_migratePipelined(self):
+		self.migration.migratePipelined(reconstruct=True)
+		self.assertEqual(
+			self.imap.created,
+			[
+				'user.bill@example.com',
+				'user.bill.Sent@example.com',
+				'user.bill.Sent.2011@example.com',
+				'user.bill.Trash@example.com',
+			]
+		)
+		self.assertEqual(sorted(self.imap.reconstructed), sorted(self.imap.created))
+		newPath = os.path.join(TmpCyrusMigrate.newRoot, 'var/spool/imap/domain/example.com/user/bill/Sent/2011/1.')
+		with open(newPath) as f:
+			self.assertEqual(f.read(), 'Sent/2011')
+
+	def test_localReconstructBatched(self):
+		batches = []
+		self.migration.localReconstruct = True
+		self.migration.reconstructBatch = 3
+		self.migration.reconstructMailboxes = batches.append
+		self.migration.migratePipelined(reconstruct=True)
+		self.assertEqual([len(batch) for batch in batches], [3, 1])
+		self.assertEqual(sorted(sum(batches, [])), sorted(self.imap.created))
+		self.assertEqual(getattr(self.imap, 'reconstructed', []), [])
+
+	def test_discoveryStreamed(self):
+		found = []
+		createNewMailbox = self.migration.createNewMailbox
+		def create(newmbox):
+			found.append(len(self.migration.spoolInventory))
+			createNewMailbox(newmbox)
+		self.migration.createNewMailbox = create
+		self.migration.migratePipelined()
+		# The first mailbox was created before the tree was read to the end
+		self.assertTrue(found[0] < 4)
+		self.assertEqual(len(self.migration.oldMailboxes), 4)
+
+	def test_syncState(self):
+		syncDb = os.path.join(self.rootPath, 'sync.db')
+		migration = TmpCyrusMigrate(self.imap, 'user.bob', 'user.bill@example.com', rootPath=self.rootPath, syncDb=syncDb)
+		migration.migratePipelined(reconstruct=True)
+		newPath = os.path.join(TmpCyrusMigrate.newRoot, 'var/spool/imap/domain/example.com/user/bill/Trash/1.')
+		os.unlink(newPath)
+		# Unchanged old mailboxes are not synced again
+		migration = TmpCyrusMigrate(self.imap, 'user.bob', 'user.bill@example.com', rootPath=self.rootPath, syncDb=syncDb)
+		migration.migratePipelined(reconstruct=True)
+		self.assertFalse(os.path.exists(newPath))
+
+	def test_largestFirstQueue(self):
+		queue = cyrusmigrate._LargestFirstQueue(4, len)
+		for item in ('bb', None, 'a', 'ccc'):
+			queue.put(item)
+		self.assertEqual([queue.get() for _ in range(4)], ['ccc', 'bb', 'a', None])
+
+	def test_failure(self):
+		self.imap.failCreate = ['user.bill.Sent@example.com']
+		self.assertRaises(CYRUSError, self.migration.migratePipelined, True)
+		self.assertFalse('user.bill.Sent@example.com' in getattr(self.imap, 'reconstructed', []))
+
+
+class Test_CyrusMigrate_Plan(unittest.TestCase):
+	""" Test planning a migration without side effects
+	"""
+	def setUp(self):
+		self.rootPath = tempfile.mkdtemp()
+		for folder, data in (('', 'inbox'), ('Sent', 'sent message'), ('Trash', '')):
+			path = os.path.join(self.rootPath, 'var/spool/imap/user/bob', folder)
+			os.makedirs(path)
+			open(os.path.join(path, 'cyrus.header'), 'w').close()
+			with open(os.path.join(path, '1.'), 'w') as f:
+				f.write(data)
+		TmpCyrusMigrate.newRoot = os.path.join(self.rootPath, 'new')
+		self.imap = MockImap()
+		self.imap._mailboxes = {'user.bill@example.com': ['user.bill@example.com']}
+		self.migration = TmpCyrusMigrate(self.imap, 'user.bob', 'user.bill@example.com', rootPath=self.rootPath)
+
+	def tearDown(self):
+		shutil.rmtree(self.rootPath)
+
+	def test_plan(self):
+		plan = self.migration.plan(reconstruct=True)
+		self.assertFalse(os.path.exists(TmpCyrusMigrate.newRoot))
+		self.assertEqual(getattr(self.imap, 'created', []), [])
+
+		# Largest first
+		self.assertEqual([mailbox.oldmbox for mailbox in plan.mailboxes], ['user.bob.Sent', 'user.bob', 'user.bob.Trash'])
+		self.assertEqual(plan.creates, ['user.bill.Sent@example.com', 'user.bill.Trash@example.com'])
+		self.assertEqual((plan.files, plan.bytes), (3, 17))
+		self.assertEqual(len(plan.reconstructs), 3)
+		# No config files in the root
+		self.assertEqual((plan.subscriptions, plan.seen), (None, None))
+
+		out = StringIO()
+		plan.write(out)
+		self.assertTrue('create,sync,reconstruct' in out.getvalue())
+		self.assertTrue('3 mailboxes, 2 to create, 3 to sync (3 files, 17 bytes), 3 to reconstruct' in out.getvalue())
+
+	def test_noSideEffects(self):
+		syncDb = os.path.join(self.rootPath, 'sync.db')
+		migration = TmpCyrusMigrate(self.imap, 'user.bob', 'user.bill@example.com', rootPath=self.rootPath, syncDb=syncDb)
+		self.assertEqual(len(migration.plan(reconstruct=True).syncs), 3)
+		self.assertFalse(os.path.exists(syncDb))
+
+	def test_unchanged(self):
+		syncDb = os.path.join(self.rootPath, 'sync.db')
+		migration = TmpCyrusMigrate(self.imap, 'user.bob', 'user.bill@example.com', rootPath=self.rootPath, syncDb=syncDb)
+		migration.syncFiles()
+		migration.close()
+		migration = TmpCyrusMigrate(self.imap, 'user.bob', 'user.bill@example.com', rootPath=self.rootPath, syncDb=syncDb)
+		plan = migration.plan()
+		self.assertEqual(plan.syncs, [])
+		out = StringIO()
+		plan.write(out)
+		self.assertFalse('over imap' in out.getvalue())
+		self.assertTrue('unchanged' in out.getvalue())
+		self.assertTrue('(0 files, 0 bytes, 0 deletes)' in out.getvalue())
+		migration.close()
+
+	def test_subscriptions(self):
+		subFile = self.migration.oldImapConfigPath('.sub')
+		os.makedirs(os.path.dirname(subFile))
+		with open(subFile, 'w') as f:
+			f.write('user.bob\t\nuser.bob.Sent\t\nuser.bob.Gone\t\n')
+		# Only those with a mailbox to subscribe to, existing or planned
+		self.assertEqual(self.migration.plan().subscriptions, 2)
+
+	def test_syncFiles(self):
+		plan = self.migration.plan()
+		self.migration.syncFiles(plan)
+		plan = self.migration.plan()
+		self.assertEqual((plan.files, plan.bytes), (0, 0))
+
+		newPath = os.path.join(TmpCyrusMigrate.newRoot, 'var/spool/imap/domain/example.com/user/bill')
+		open(os.path.join(newPath, '2.'), 'w').close()
+		plan = self.migration.plan()
+		self.assertEqual([mailbox.deletes for mailbox in plan.mailboxes if mailbox.oldmbox == 'user.bob'], [1])
+
+
+class Test_CyrusMigrate_Source(unittest.TestCase):
+	""" Old mailboxes on another server, reached over IMAP only
+	"""
+	def setUp(self):
+		self.source = MockImap()
+		imap = MockImap()
+		imap._mailboxes = {}
+		self.cyrus = CyrusMigrate(imap, 'user.bob', 'user.bob', source=self.source)
+
+	def test_oldMailboxes(self):
+		self.assertEqual(self.cyrus.oldMailboxes[:2], ['user.bob', 'user.bob.ufolder1'])
+		self.assertEqual(self.cyrus.newMailboxes, [])
+
+	def test_canRename(self):
+		self.assertFalse(self.cyrus.canRename)
+
+	def test_convertAcls(self):
+		self.cyrus.convertAcls()
+		self.assertEqual(self.cyrus.imap.restored['user.bob'], {'bob': 'lrswipkxtecda', 'alice': 'lrs'})
+
+
 class Test_CyrusMigrate_User_LocalToLocal(unittest.TestCase):
 	""" Test cyrusmigrate for local user to local user
 	"""
@@ -276,6 +682,12 @@ class Test_CyrusMigrate_User_LocalToLocal(unittest.TestCase):
 			'/var/lib/imap/user/j/joe.seen'
 		)
 
+	def test_aclUserIdToNew(self):
+		self.assertEqual(self.cyrus.aclUserIdToNew('bob'), 'joe')
+		self.assertEqual(self.cyrus.aclUserIdToNew('-bob'), '-joe')
+		self.assertEqual(self.cyrus.aclUserIdToNew('alice'), 'alice')
+		self.assertEqual(self.cyrus.aclUserIdToNew('anyone'), 'anyone')
+
 	def test_isUserMigration(self):
 		self.assertEqual(self.cyrus._isUserMigration, True)
 
@@ -354,6 +766,38 @@ class Test_CyrusMigrate_User_LocalToVirtual(unittest.TestCase):
 			self.cyrus.newImapConfigPath('.seen'), 
 			'/var/lib/imap/domain/e/example.com/user/b/brian.seen')
 
+	def test_aclUserIdToNew(self):
+		self.assertEqual(self.cyrus.aclUserIdToNew('bob'), 'brian@example.com')
+		self.assertEqual(self.cyrus.aclUserIdToNew('alice'), 'alice@example.com')
+		self.assertEqual(self.cyrus.aclUserIdToNew('-alice'), '-alice@example.com')
+		self.assertEqual(self.cyrus.aclUserIdToNew('alice@other.com'), 'alice@other.com')
+		self.assertEqual(self.cyrus.aclUserIdToNew('anyone'), 'anyone')
+		self.assertEqual(self.cyrus.aclUserIdToNew('group:staff'), 'group:staff')
+
+	def test_renameMailboxes(self):
+		self.assertTrue(self.cyrus.canRename)
+		self.cyrus.renameMailboxes()
+		self.assertEqual(self.cyrus.imap.renamed, [('user.bob', 'user.brian@example.com')])
+
+	def test_convertAnnotations(self):
+		self.cyrus.convertAnnotations()
+		self.assertEqual(self.cyrus.imap.annotationPattern, 'user.bob*')
+		self.assertEqual(
+			self.cyrus.imap.annotations,
+			{
+				'user.brian@example.com': {'/comment': 'Inbox'},
+				'user.brian.ufolder1@example.com': {'/vendor/cmu/cyrus-imapd/expire': '30'},
+			}
+		)
+
+	def test_convertAcls(self):
+		self.cyrus.convertAcls()
+		self.assertEqual(
+			self.cyrus.imap.restored['user.brian.ufolder 2@example.com'],
+			{'brian@example.com': 'lrswipkxtecda', 'alice@example.com': 'lrs'}
+		)
+		self.assertEqual(len(self.cyrus.imap.restored), 7)
+
 	def test_isUserMigration(self):
 		self.assertEqual(self.cyrus._isUserMigration, True)
 
@@ -433,6 +877,10 @@ class Test_CyrusMigrate_User_VirtualToLocal(unittest.TestCase):
 			self.cyrus.newImapConfigPath('.seen'), 
 			'/var/lib/imap/user/b/brian.seen')
 
+	def test_aclUserIdToNew(self):
+		self.assertEqual(self.cyrus.aclUserIdToNew('joe@example.com'), 'brian')
+		self.assertEqual(self.cyrus.aclUserIdToNew('alice@example.com'), 'alice@example.com')
+
 	def test_isUserMigration(self):
 		self.assertEqual(self.cyrus._isUserMigration, True)
 
@@ -599,6 +1047,19 @@ class Test_CyrusMigrate_Shared_LocalToVirtual(unittest.TestCase):
 		imap = MockImap()
 		self.cyrus = CyrusMigrate(imap, 'shared', 'another@hosting.com')
 
+	def test_renameMailboxes(self):
+		self.cyrus.renameMailboxes()
+		self.assertEqual(
+			self.cyrus.imap.renamed,
+			[
+				('shared.folder1.sub', 'another.folder1.sub@hosting.com'),
+				('shared.folder 2.sub', 'another.folder 2.sub@hosting.com'),
+				('shared.folder1', 'another.folder1@hosting.com'),
+				('shared.folder 2', 'another.folder 2@hosting.com'),
+				('shared', 'another@hosting.com'),
+			]
+		)
+
 	def test_oldMailboxes(self):
 		self.assertEqual(
 			self.cyrus.oldMailboxes,
@@ -745,3 +1206,79 @@ class Test_CyrusMigrate_Shared_VirtualToVirtual(unittest.TestCase):
 		""" No it ain't
 		"""
 		self.assertEqual(self.cyrus._isUserMigration, False)
+
+
+class Test_CyrusMigrate_Batch(unittest.TestCase):
+	""" Test the multi-account driver, copying over IMAP between stand-in servers
+	"""
+	def setUp(self):
+		socket.setdefaulttimeout(5)
+		self.source = ImapServer(mailboxes=['user.bob', 'user.bob.Sent', 'user.joe', 'user.sue'])
+		self.source.mailboxes['user.bob'].add('Subject: hi\r\n\r\nbody\r\n')
+		self.source.mailboxes['user.joe'].add('Subject: hello\r\n\r\nbody\r\n')
+		self.target = ImapServer()
+
+	def tearDown(self):
+		socket.setdefaulttimeout(None)
+		self.source.stop()
+		self.target.stop()
+
+	def test_readAccounts(self):
+		accounts = cyrusmigrate.readAccounts(StringIO(
+			'# old, new\n'
+			'user.bob, user.bob@example.com\n'
+			'\n'
+			'user.joe,user.joseph@example.com\n'
+		))
+		self.assertEqual(
+			accounts,
+			[('user.bob', 'user.bob@example.com'), ('user.joe', 'user.joseph@example.com')]
+		)
+
+	def test_migrateAccounts(self):
+		self.target.failures.add(('CREATE', 'user.susan'))
+		results = cyrusmigrate.migrateAccounts(
+			[('user.bob', 'user.robert'), ('user.sue', 'user.susan'), ('user.joe', 'user.joe')],
+			self.target.url, 'cyrus', 'secret', jobs=2, sourceUrl=self.source.url
+		)
+		self.assertEqual(
+			[(oldmbox, newmbox, error is None) for oldmbox, newmbox, error, _ in results],
+			[('user.bob', 'user.robert', True), ('user.sue', 'user.susan', False), ('user.joe', 'user.joe', True)]
+		)
+		self.assertEqual(sorted(self.target.mailboxes), ['user.joe', 'user.robert', 'user.robert.Sent'])
+		self.assertEqual(len(self.target.mailboxes['user.robert'].messages), 1)
+
+	def test_reconstructSessions(self):
+		results = cyrusmigrate.migrateAccounts(
+			[('user.bob', 'user.robert')], self.target.url, 'cyrus', 'secret', jobs=1,
+			sourceUrl=self.source.url, reconstructSessions=2, reconstruct=True
+		)
+		self.assertEqual(results[0][2], None)
+		# The worker's session and one more for the reconstructs
+		self.assertEqual(self.target.commandNames().count('LOGIN'), 2)
+
+	def test_loginFailure(self):
+		# Every account fails, the batch still finishes
+		self.target.failures.add(('LOGIN', 'cyrus'))
+		results = cyrusmigrate.migrateAccounts(
+			[('user.bob', 'user.robert'), ('user.joe', 'user.joe')],
+			self.target.url, 'cyrus', 'wrong', jobs=2, sourceUrl=self.source.url
+		)
+		self.assertEqual([error is None for _, _, error, _ in results], [False, False])
+		self.assertEqual(self.target.mailboxes, {})
+
+	def test_writeSummary(self):
+		out = StringIO()
+		failed = cyrusmigrate.writeSummary([
+			('user.bob', 'user.robert', None, 1.5),
+			('user.sue', 'user.susan', 'Mailbox exists', 0.5),
+		], out)
+		self.assertEqual(failed, 1)
+		self.assertEqual(
+			out.getvalue().splitlines(),
+			[
+				'OK          1.5s  user.bob -> user.robert',
+				'FAILED      0.5s  user.sue -> user.susan: Mailbox exists',
+				'2 accounts, 1 migrated, 1 failed, 2.0s account time',
+			]
+		)
@@ -0,0 +1,77 @@
+""" Unit tests for imapcopy, between two local stand-in IMAP servers
+"""
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+from cyrusutils import cyruslib
+from cyrusutils.imapcopy import ImapCopy, UidValidityChanged
+from tests.imapserver import ImapServer
+
+
+class Test_ImapCopy(unittest.TestCase):
+	def setUp(self):
+		socket.setdefaulttimeout(5)
+		self.tmpDir = tempfile.mkdtemp()
+		self.stateFile = os.path.join(self.tmpDir, 'state.json')
+		self.source = ImapServer(mailboxes=['user.bob', 'user.bob.Sent'])
+		self.target = ImapServer(
+			capabilities=['IMAP4rev1', 'LITERAL+', 'MULTIAPPEND'],
+			mailboxes=['user.brian', 'user.brian.Sent']
+		)
+		for i in range(5):
+			self.source.mailboxes['user.bob'].add('Subject: %d\r\n\r\nbody\r\n' % i, ['\\Seen'])
+		self.source.mailboxes['user.bob.Sent'].add('Subject: sent\r\n\r\nbody\r\n')
+		self.oldImap = cyruslib.CYRUS(self.source.url)
+		self.oldImap.login('cyrus', 'secret')
+		self.newImap = cyruslib.CYRUS(self.target.url)
+		self.newImap.login('cyrus', 'secret')
+
+	def tearDown(self):
+		self.oldImap.logout()
+		self.newImap.logout()
+		socket.setdefaulttimeout(None)
+		self.source.stop()
+		self.target.stop()
+		shutil.rmtree(self.tmpDir)
+
+	def copier(self):
+		return ImapCopy(self.oldImap, self.newImap, stateFile=self.stateFile)
+
+	def test_copy(self):
+		count = self.copier()([('user.bob', 'user.brian'), ('user.bob.Sent', 'user.brian.Sent')])
+		self.assertEqual(count, 6)
+		self.assertEqual(len(self.target.mailboxes['user.brian'].messages), 5)
+		self.assertEqual(self.target.mailboxes['user.brian.Sent'].messages[0][3], 'Subject: sent\r\n\r\nbody\r\n')
+		self.assertEqual(
+			self.copier().state,
+			{
+				'user.bob': {'uidvalidity': 1, 'lastuid': 5},
+				'user.bob.Sent': {'uidvalidity': 1, 'lastuid': 1},
+			}
+		)
+
+	def test_resume(self):
+		self.copier().copyMailbox('user.bob', 'user.brian')
+		self.source.mailboxes['user.bob'].add('Subject: late\r\n\r\nbody\r\n')
+		self.assertEqual(self.copier().copyMailbox('user.bob', 'user.brian'), 1)
+		self.assertEqual(len(self.target.mailboxes['user.brian'].messages), 6)
+		self.assertEqual(self.copier().copyMailbox('user.bob', 'user.brian'), 0)
+
+	def test_uidvalidityChanged(self):
+		self.copier().copyMailbox('user.bob', 'user.brian')
+		self.source.mailboxes['user.bob'].uidvalidity = 2
+		# Copying again would duplicate the messages in the target
+		self.assertRaises(UidValidityChanged, self.copier().copyMailbox, 'user.bob', 'user.brian')
+		self.assertEqual(len(self.target.mailboxes['user.brian'].messages), 5)
+		del self.target.mailboxes['user.brian'].messages[:]
+		copier = ImapCopy(self.oldImap, self.newImap, stateFile=self.stateFile, restart=True)
+		self.assertEqual(copier.copyMailbox('user.bob', 'user.brian'), 5)
+		self.assertEqual(self.copier().state['user.bob'], {'uidvalidity': 2, 'lastuid': 5})
+
+	def test_noStateFile(self):
+		copier = ImapCopy(self.oldImap, self.newImap)
+		self.assertEqual(copier.copyMailbox('user.bob', 'user.brian'), 5)
+		self.assertEqual(copier.state['user.bob']['lastuid'], 5)
+		self.assertFalse(os.path.exists(self.stateFile))
@@ -0,0 +1,433 @@
+""" Minimal threaded IMAP stand-in server for cyruslib tests.
+	Understands just enough of the protocol (and of the Cyrus
+	admin extensions) to exercise the client side end to end.
+"""
+import os
+import re
+import socket
+import ssl
+import threading
+import zlib
+
+CERTFILE = os.path.join(os.path.dirname(__file__), 'imapserver.pem')
+
+re_literal = re.compile(r'\{(\d+)(\+?)\}\r\n$')
+re_token = re.compile(r'\s*(?:"((?:[^"\\]|\\.)*)"|(\()|(\))|([^\s()"]+))')
+re_date = re.compile(r'^\s?\d{1,2}-\w{3}-\d{4} \d\d:\d\d:\d\d [+-]\d{4}$')
+
+DEFAULT_DATE = '01-Jan-2010 00:00:00 +0000'
+
+
+def tokenize(text):
+	""" Splits a command line into atoms, quoted strings and parenthesis
+	"""
+	tokens = []
+	pos = 0
+	text = text.rstrip()
+	while pos < len(text):
+		match = re_token.match(text, pos)
+		if not match:
+			break
+		quoted, lparen, rparen, atom = match.groups()
+		if quoted is not None:
+			tokens.append(re.sub(r'\\(.)', r'\1', quoted))
+		else:
+			tokens.append(lparen or rparen or atom)
+		pos = match.end()
+	return tokens
+
+
+def patternToRegex(pattern):
+	""" Converts an IMAP LIST pattern to a compiled regex
+	"""
+	regex = re.escape(pattern).replace(r'\*', '.*').replace(r'\%', r'[^.]*')
+	return re.compile('^%s$' % regex)
+
+
+class Mailbox(object):
+	def __init__(self, name):
+		self.name = name
+		self.acl = {}
+		self.reconstructed = False
+		self.quota = None
+		self.annotations = {}
+		self.uidvalidity = 1
+		self.uidnext = 1
+		# [uid, flags, internaldate, message]
+		self.messages = []
+
+	def add(self, message, flags=(), date=DEFAULT_DATE):
+		self.messages.append([self.uidnext, list(flags), date, message])
+		self.uidnext += 1
+
+	def uidset(self, text):
+		""" Messages matching a UID set such as 1,3:5,7:*
+		"""
+		highest = self.messages[-1][0] if self.messages else 0
+		uids = set()
+		for part in text.split(','):
+			bounds = [highest if bound == '*' else int(bound) for bound in part.split(':')]
+			low, high = min(bounds), max(bounds)
+			uids.update(range(low, high + 1))
+		return [message for message in self.messages if message[0] in uids]
+
+
+class ImapServer(object):
+	""" Listens on a random local port, one thread per connection
+	"""
+	def __init__(self, capabilities=('IMAP4rev1',), mailboxes=(), admin='cyrus'):
+		self.capabilities = list(capabilities)
+		self.admin = admin
+		self.mailboxes = {}
+		# (mailbox, server, partition) moved away with XFER
+		self.transferred = []
+		for name in mailboxes:
+			self.mailboxes[name] = Mailbox(name)
+		self.commands = []
+		self.sessions = []
+		# (command, count): once command arrives, hold back responses until
+		# count commands have been received, which only works if the
+		# client pipelines them. Fires once.
+		self.cork = None
+		# (command, mailbox) pairs answered with NO
+		self.failures = set()
+		self.lock = threading.Lock()
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.sock.bind(('127.0.0.1', 0))
+		self.sock.listen(16)
+		self.port = self.sock.getsockname()[1]
+		self.thread = threading.Thread(target=self.serve)
+		self.thread.daemon = True
+		self.thread.start()
+
+	@property
+	def url(self):
+		return 'imap://127.0.0.1:%d' % self.port
+
+	def wrap(self, conn):
+		return conn
+
+	def serve(self):
+		while True:
+			try:
+				conn, _ = self.sock.accept()
+			except socket.error:
+				return
+			session = ImapSession(self, self.wrap(conn))
+			self.sessions.append(session)
+			thread = threading.Thread(target=session.run)
+			thread.daemon = True
+			thread.start()
+
+	def stop(self):
+		# close() alone does not wake a thread blocked in accept()
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+		self.sock.close()
+		self.thread.join()
+
+	def record(self, session, tag, name, args):
+		with self.lock:
+			self.commands.append((name, args, session.deflate))
+
+	def commandNames(self):
+		return [name for name, _, _ in self.commands]
+
+
+class ImapsServer(ImapServer):
+	""" Same again, behind TLS with a self-signed certificate
+	"""
+	def __init__(self, *args, **kwargs):
+		self.context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+		self.context.load_cert_chain(CERTFILE)
+		super(ImapsServer, self).__init__(*args, **kwargs)
+
+	@property
+	def url(self):
+		return 'imaps://127.0.0.1:%d' % self.port
+
+	def wrap(self, conn):
+		return self.context.wrap_socket(conn, server_side=True)
+
+
+class ImapSession(object):
+	def __init__(self, server, conn):
+		self.server = server
+		self.conn = conn
+		self.buffer = ''
+		self.user = None
+		self.deflate = False
+		self.inflater = None
+		self.deflater = None
+		self.selected = None
+		self.hold = 0
+		self.pending = []
+
+	def recv(self):
+		data = self.conn.recv(65536)
+		if data and self.inflater:
+			data = self.inflater.decompress(data)
+		return data
+
+	def readline(self):
+		while '\n' not in self.buffer:
+			data = self.recv()
+			if not data:
+				return ''
+			self.buffer += data
+		line, self.buffer = self.buffer.split('\n', 1)
+		return line + '\n'
+
+	def read(self, size):
+		while len(self.buffer) < size:
+			data = self.recv()
+			if not data:
+				break
+			self.buffer += data
+		data, self.buffer = self.buffer[:size], self.buffer[size:]
+		return data
+
+	def write(self, line):
+		data = line + '\r\n'
+		if self.deflater:
+			data = self.deflater.compress(data) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+		self.pending.append(data)
+		if self.hold <= 0:
+			self.flush()
+
+	def flush(self):
+		self.conn.sendall(''.join(self.pending))
+		self.pending = []
+
+	def readCommand(self):
+		""" Returns list of tokens, with literals inlined as plain strings
+		"""
+		tokens = []
+		line = self.readline()
+		if not line:
+			return None
+		while True:
+			match = re_literal.search(line)
+			if not match:
+				tokens.extend(tokenize(line))
+				return tokens
+			tokens.extend(tokenize(line[:match.start()]))
+			if not match.group(2):
+				self.write('+ go ahead')
+			tokens.append(self.read(int(match.group(1))))
+			line = self.readline()
+
+	def run(self):
+		self.write('* OK stand-in IMAP server ready')
+		try:
+			while True:
+				tokens = self.readCommand()
+				if not tokens:
+					break
+				tag, name, args = tokens[0], tokens[1].upper(), tokens[2:]
+				self.server.record(self, tag, name, args)
+				if self.server.cork and self.server.cork[0] == name:
+					self.hold = self.server.cork[1]
+					self.server.cork = None
+				handler = getattr(self, 'do_' + name, None)
+				if handler is None:
+					self.write('%s BAD Unrecognized command' % tag)
+				elif args and (name, args[0]) in self.server.failures:
+					self.write('%s NO Permission denied' % tag)
+				elif handler(tag, *args) is False:
+					break
+				if self.hold > 0:
+					self.hold -= 1
+					if self.hold == 0:
+						self.flush()
+		except socket.error:
+			pass
+		finally:
+			self.conn.close()
+
+	def do_CAPABILITY(self, tag):
+		self.write('* CAPABILITY %s' % ' '.join(self.server.capabilities))
+		self.write('%s OK Completed' % tag)
+
+	def do_NOOP(self, tag):
+		self.write('%s OK Completed' % tag)
+
+	def do_LOGIN(self, tag, user, password):
+		self.user = user
+		self.write('%s OK [CAPABILITY %s] User logged in' % (tag, ' '.join(self.server.capabilities)))
+
+	def do_LOGOUT(self, tag):
+		self.write('* BYE LOGOUT received')
+		self.write('%s OK Completed' % tag)
+		return False
+
+	def do_COMPRESS(self, tag, mechanism):
+		if 'COMPRESS=DEFLATE' not in self.server.capabilities or mechanism.upper() != 'DEFLATE':
+			self.write('%s NO Unsupported compression mechanism' % tag)
+			return
+		self.write('%s OK DEFLATE active' % tag)
+		self.deflate = True
+		self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+		self.deflater = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+		# Anything already buffered arrived compressed
+		self.buffer = self.inflater.decompress(self.buffer)
+
+	def do_DUMP(self, tag, mailbox):
+		if self.user == self.server.admin:
+			self.write('%s NO Mailbox does not exist' % tag)
+		else:
+			self.write('%s NO Permission denied' % tag)
+
+	def do_LIST(self, tag, reference, pattern):
+		if pattern == '':
+			self.write('* LIST (\\Noselect) "." ""')
+		else:
+			regex = patternToRegex(pattern)
+			for name in sorted(self.server.mailboxes):
+				if regex.match(name):
+					self.write('* LIST (\\HasNoChildren) "." "%s"' % name)
+		self.write('%s OK Completed' % tag)
+
+	def do_CREATE(self, tag, mailbox, partition=None):
+		if mailbox in self.server.mailboxes:
+			self.write('%s NO Mailbox already exists' % tag)
+			return
+		self.server.mailboxes[mailbox] = Mailbox(mailbox)
+		self.write('%s OK Completed' % tag)
+
+	def do_DELETE(self, tag, mailbox):
+		children = [name for name in self.server.mailboxes if name.startswith(mailbox + '.')]
+		if mailbox not in self.server.mailboxes:
+			self.write('%s NO Mailbox does not exist' % tag)
+		elif children and not mailbox.startswith('user.'):
+			self.write('%s NO Mailbox has children' % tag)
+		else:
+			del self.server.mailboxes[mailbox]
+			self.write('%s OK Completed' % tag)
+
+	def do_SETACL(self, tag, mailbox, userid, rights):
+		if mailbox not in self.server.mailboxes:
+			self.write('%s NO Mailbox does not exist' % tag)
+			return
+		if rights:
+			self.server.mailboxes[mailbox].acl[userid] = rights
+		else:
+			self.server.mailboxes[mailbox].acl.pop(userid, None)
+		self.write('%s OK Completed' % tag)
+
+	def do_RECONSTRUCT(self, tag, mailbox):
+		if mailbox not in self.server.mailboxes:
+			self.write('%s NO Mailbox does not exist' % tag)
+			return
+		self.server.mailboxes[mailbox].reconstructed = True
+		self.write('%s OK Completed' % tag)
+
+	def do_GETACL(self, tag, mailbox):
+		if mailbox not in self.server.mailboxes:
+			self.write('%s NO Mailbox does not exist' % tag)
+			return
+		acl = self.server.mailboxes[mailbox].acl
+		entries = ''.join(' %s %s' % (userid, acl[userid]) for userid in sorted(acl))
+		self.write('* ACL "%s"%s' % (mailbox, entries))
+		self.write('%s OK Completed' % tag)
+
+	def do_GETQUOTAROOT(self, tag, mailbox):
+		if mailbox not in self.server.mailboxes:
+			self.write('%s NO Mailbox does not exist' % tag)
+			return
+		parts = mailbox.split('.')
+		root = '.'.join(parts[:2]) if parts[0] == 'user' else parts[0]
+		quota = self.server.mailboxes.get(root) and self.server.mailboxes[root].quota
+		if quota is None:
+			self.write('* QUOTAROOT "%s"' % mailbox)
+		else:
+			self.write('* QUOTAROOT "%s" "%s"' % (mailbox, root))
+			if quota:
+				self.write('* QUOTA "%s" (STORAGE %d %d)' % (root, quota[0], quota[1]))
+			else:
+				self.write('* QUOTA "%s" ()' % root)
+		self.write('%s OK Completed' % tag)
+
+	def do_SETANNOTATION(self, tag, mailbox, entry, *args):
+		# args is the attribute list: ( "value.shared" value )
+		if mailbox not in self.server.mailboxes:
+			self.write('%s NO Mailbox does not exist' % tag)
+			return
+		self.server.mailboxes[mailbox].annotations[entry] = args[2]
+		self.write('%s OK Completed' % tag)
+
+	def do_XFER(self, tag, mailbox, server, partition=None):
+		if mailbox not in self.server.mailboxes:
+			self.write('%s NO Mailbox does not exist' % tag)
+			return
+		for name in list(self.server.mailboxes):
+			if name == mailbox or (mailbox.startswith('user.') and name.startswith(mailbox + '.')):
+				del self.server.mailboxes[name]
+		self.server.transferred.append((mailbox, server, partition))
+		self.write('%s OK Completed' % tag)
+
+	def do_SELECT(self, tag, mailbox):
+		if mailbox not in self.server.mailboxes:
+			self.write('%s NO Mailbox does not exist' % tag)
+			return
+		self.selected = self.server.mailboxes[mailbox]
+		self.write('* %d EXISTS' % len(self.selected.messages))
+		self.write('* OK [UIDVALIDITY %d] Ok' % self.selected.uidvalidity)
+		self.write('* OK [UIDNEXT %d] Ok' % self.selected.uidnext)
+		self.write('%s OK [READ-WRITE] Completed' % tag)
+
+	def do_EXAMINE(self, tag, mailbox):
+		if mailbox not in self.server.mailboxes:
+			self.write('%s NO Mailbox does not exist' % tag)
+			return
+		self.selected = self.server.mailboxes[mailbox]
+		self.write('* %d EXISTS' % len(self.selected.messages))
+		self.write('* OK [UIDVALIDITY %d] Ok' % self.selected.uidvalidity)
+		self.write('* OK [UIDNEXT %d] Ok' % self.selected.uidnext)
+		self.write('%s OK [READ-ONLY] Completed' % tag)
+
+	def do_UID(self, tag, command, *args):
+		if self.selected is None:
+			self.write('%s BAD Please select a mailbox first' % tag)
+			return
+		command = command.upper()
+		if command == 'SEARCH' and args[0].upper() == 'UID':
+			uids = [str(message[0]) for message in self.selected.uidset(args[1])]
+			self.write(' '.join(['* SEARCH'] + uids))
+		elif command == 'FETCH':
+			# Always answers (UID FLAGS INTERNALDATE BODY[]), whatever was asked
+			for message in self.selected.uidset(args[0]):
+				uid, flags, date, body = message
+				seq = self.selected.messages.index(message) + 1
+				self.write('* %d FETCH (UID %d FLAGS (%s) INTERNALDATE "%s" BODY[] {%d}\r\n%s)' % (
+					seq, uid, ' '.join(flags), date, len(body), body))
+		else:
+			self.write('%s BAD Unsupported UID command' % tag)
+			return
+		self.write('%s OK Completed' % tag)
+
+	def do_APPEND(self, tag, mailbox, *args):
+		# args are ( flags ) date message, repeated for MULTIAPPEND
+		if mailbox not in self.server.mailboxes:
+			self.write('%s NO [TRYCREATE] Mailbox does not exist' % tag)
+			return
+		messages = []
+		i = 0
+		while i < len(args):
+			flags = []
+			if args[i] == '(':
+				end = args.index(')', i)
+				flags = list(args[i + 1:end])
+				i = end + 1
+			date = DEFAULT_DATE
+			if i + 1 < len(args) and re_date.match(args[i]):
+				date = args[i].strip()
+				i += 1
+			messages.append((args[i], flags, date))
+			i += 1
+		for message, flags, date in messages:
+			self.server.mailboxes[mailbox].add(message, flags, date)
+		self.write('%s OK Completed' % tag)
@@ -0,0 +1,50 @@
+""" Unit tests for tagging log records by job across threads
+"""
+import logging
+import threading
+import unittest
+from multiprocessing.pool import ThreadPool
+from cyrusutils import logcontext
+
+
+class Test_LogContext(unittest.TestCase):
+	def run_thread(self, target):
+		thread = threading.Thread(target=target)
+		thread.start()
+		thread.join()
+
+	def test_job(self):
+		self.assertEqual(logcontext.current(), None)
+		with logcontext.job('bob'):
+			self.assertEqual(logcontext.current(), 'bob')
+			with logcontext.job('joe'):
+				self.assertEqual(logcontext.current(), 'joe')
+			self.assertEqual(logcontext.current(), 'bob')
+		self.assertEqual(logcontext.current(), None)
+
+	def test_inherit(self):
+		seen = []
+		with logcontext.job('bob'):
+			self.run_thread(logcontext.inherit(lambda: seen.append(logcontext.current())))
+			# A plain thread does not inherit
+			self.run_thread(lambda: seen.append(logcontext.current()))
+		self.assertEqual(seen, ['bob', None])
+
+	def test_pool(self):
+		pool = ThreadPool(2)
+		try:
+			with logcontext.job('bob'):
+				jobs = pool.map(logcontext.inherit(lambda _: logcontext.current()), range(4))
+			self.assertEqual(jobs, ['bob'] * 4)
+			# Pool threads go back to no job afterwards
+			self.assertEqual(pool.map(lambda _: logcontext.current(), range(4)), [None] * 4)
+		finally:
+			pool.close()
+			pool.join()
+
+	def test_filter(self):
+		record = logging.LogRecord('test', logging.INFO, __file__, 1, 'message', (), None)
+		jobFilter = logcontext.JobFilter('bob')
+		self.assertFalse(jobFilter.filter(record))
+		with logcontext.job('bob'):
+			self.assertTrue(jobFilter.filter(record))
@@ -0,0 +1,138 @@
+""" Unit tests for the migration daemon, against local stand-in IMAP servers
+"""
+import os
+import json
+import logging
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from cyrusutils import migrationd
+from cyrusutils import logcontext
+from tests.imapserver import ImapServer
+
+
+class Test_Migrationd(unittest.TestCase):
+	def setUp(self):
+		socket.setdefaulttimeout(5)
+		# As main() does for --daemon
+		self.level = logging.getLogger().level
+		logging.getLogger().setLevel(logging.INFO)
+		self.tmpDir = tempfile.mkdtemp()
+		self.path = os.path.join(self.tmpDir, 'migrationd.sock')
+		self.source = ImapServer(mailboxes=['user.bob', 'user.bob.Sent', 'user.joe'])
+		self.source.mailboxes['user.bob'].add('Subject: hi\r\n\r\nbody\r\n')
+		self.target = ImapServer()
+		pool = migrationd.SessionPool(self.target.url, 'cyrus', 'secret', self.source.url, size=1)
+		self.server = migrationd.MigrationServer(self.path, pool)
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		socket.setdefaulttimeout(None)
+		logging.getLogger().setLevel(self.level)
+		self.source.stop()
+		self.target.stop()
+		shutil.rmtree(self.tmpDir)
+
+	def test_socketMode(self):
+		self.assertEqual(os.stat(self.path).st_mode & 0777, 0600)
+		# The process umask is left as it was
+		umask = os.umask(0)
+		os.umask(umask)
+		self.assertNotEqual(umask, 0177)
+
+	def test_submit(self):
+		events = list(migrationd.submit(self.path, 'user.bob', 'user.robert', acls=False))
+		self.assertEqual(events[-1]['event'], 'done')
+		self.assertTrue(events[-1]['ok'])
+		messages = [event['message'] for event in events if event['event'] == 'log']
+		self.assertTrue("creating mailbox 'user.robert.Sent'" in messages)
+		self.assertEqual(len(self.target.mailboxes['user.robert'].messages), 1)
+
+	def test_settings(self):
+		kwargs = []
+		CyrusMigrate = migrationd.CyrusMigrate
+		def migration(*args, **settings):
+			kwargs.append(settings)
+			return CyrusMigrate(*args, **settings)
+		migrationd.CyrusMigrate = migration
+		try:
+			events = list(migrationd.submit(
+				self.path, 'user.bob', 'user.robert', syncThreads=8, shardSize=500, mailboxThreads=2,
+				deviceJobs=1, deviceLimits={self.tmpDir: 2}, readOrder='uid', localReconstruct=True,
+				restart=True
+			))
+			self.assertTrue(events[-1]['ok'])
+			events = list(migrationd.submit(self.path, 'user.joe', 'user.joseph'))
+			self.assertTrue(events[-1]['ok'])
+		finally:
+			migrationd.CyrusMigrate = CyrusMigrate
+		self.assertEqual(kwargs[0]['syncThreads'], 8)
+		self.assertEqual((kwargs[0]['shardSize'], kwargs[0]['mailboxThreads']), (500, 2))
+		self.assertEqual((kwargs[0]['deviceJobs'], kwargs[0]['deviceLimits']), (1, {self.tmpDir: 2}))
+		self.assertTrue(isinstance(kwargs[0]['deviceLimits'].keys()[0], str))
+		self.assertEqual(kwargs[0]['readOrder'], 'uid')
+		self.assertTrue(kwargs[0]['localReconstruct'])
+		self.assertTrue(kwargs[0]['restart'])
+		# Unset ones are left to CyrusMigrate's defaults
+		self.assertFalse('syncThreads' in kwargs[1])
+
+	def test_progressThreads(self):
+		class Request(object):
+			def __init__(self):
+				self.events = []
+			def send(self, **event):
+				self.events.append(event)
+		request = Request()
+		handler = migrationd._ProgressHandler(request)
+		logger = logging.getLogger('migrationd_test')
+		logger.addHandler(handler)
+		try:
+			with logcontext.job(handler):
+				# As the pipeline stages and sync workers are started
+				thread = threading.Thread(target=logcontext.inherit(logger.info), args=('stage',))
+				thread.start()
+				thread.join()
+			thread = threading.Thread(target=logger.info, args=('other job',))
+			thread.start()
+			thread.join()
+		finally:
+			logger.removeHandler(handler)
+		self.assertEqual([event['message'] for event in request.events], ['stage'])
+
+	def test_sessionsKept(self):
+		for oldmbox, newmbox in (('user.bob', 'user.robert'), ('user.joe', 'user.joseph')):
+			events = list(migrationd.submit(self.path, oldmbox, newmbox))
+			self.assertTrue(events[-1]['ok'])
+		# Both jobs ran on the same logged in sessions
+		self.assertEqual(self.target.commandNames().count('LOGIN'), 1)
+		self.assertEqual(self.source.commandNames().count('LOGIN'), 1)
+
+	def test_failedJob(self):
+		self.target.failures.add(('CREATE', 'user.robert'))
+		events = list(migrationd.submit(self.path, 'user.bob', 'user.robert'))
+		self.assertFalse(events[-1]['ok'])
+		self.assertTrue('Permission denied' in events[-1]['error'])
+		# The failed session was replaced by a new one
+		events = list(migrationd.submit(self.path, 'user.joe', 'user.joseph'))
+		self.assertTrue(events[-1]['ok'])
+		self.assertEqual(self.target.commandNames().count('LOGIN'), 2)
+
+	def test_invalidJob(self):
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.connect(self.path)
+		sock.sendall('not json\n{"oldmbox": "user.bob"}\n')
+		f = sock.makefile('r')
+		done = []
+		while len(done) < 2:
+			event = json.loads(f.readline())
+			if event['event'] == 'done':
+				done.append(event)
+		sock.close()
+		self.assertTrue('Invalid job' in done[0]['error'])
+		self.assertEqual(done[1]['error'], 'Job needs oldmbox and newmbox')
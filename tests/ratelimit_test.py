@@ -0,0 +1,154 @@
+""" Unit tests for the rate limiting token buckets
+"""
+import os
+import socket
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+from cyrusutils import cyruslib
+from cyrusutils import ratelimit
+from cyrusutils.ratelimit import TokenBucket, RateLimits
+from tests.imapserver import ImapServer
+
+
+class FakeTime(object):
+	""" Stands in for the time module, sleeping only advances the clock
+	"""
+	def __init__(self):
+		self.now = 1000.0
+		self.slept = 0.0
+
+	def time(self):
+		return self.now
+
+	def sleep(self, seconds):
+		self.now += seconds
+		self.slept += seconds
+
+
+class Test_TokenBucket(unittest.TestCase):
+	def setUp(self):
+		self.clock = FakeTime()
+		self.time = ratelimit.time
+		ratelimit.time = self.clock
+
+	def tearDown(self):
+		ratelimit.time = self.time
+
+	def test_parseRate(self):
+		self.assertEqual(ratelimit.parseRate('100'), 100.0)
+		self.assertEqual(ratelimit.parseRate(' 1.5k'), 1536.0)
+		self.assertEqual(ratelimit.parseRate('20M'), 20 * 1024 ** 2)
+		self.assertRaises(ValueError, ratelimit.parseRate, 'fast')
+		self.assertRaises(ValueError, ratelimit.parseRate, '-1')
+
+	def test_unlimited(self):
+		bucket = TokenBucket()
+		for _ in range(1000):
+			bucket.take(1000)
+		self.assertEqual(self.clock.slept, 0)
+
+	def test_rate(self):
+		bucket = TokenBucket(10)
+		# One second's burst, then 10 per second
+		for _ in range(30):
+			bucket.take()
+		self.assertAlmostEqual(self.clock.slept, 2.0, delta=0.1)
+
+	def test_debt(self):
+		bucket = TokenBucket(100)
+		bucket.take(500)
+		self.assertEqual(self.clock.slept, 0)
+		bucket.take()
+		self.assertAlmostEqual(self.clock.slept, 4.0, delta=0.1)
+
+	def test_setRate(self):
+		bucket = TokenBucket(1)
+		bucket.take(10)
+		bucket.setRate(0)
+		self.assertEqual(bucket.take(), 0)
+		self.assertEqual(self.clock.slept, 0)
+
+	def test_shared(self):
+		bucket = TokenBucket(100)
+		process = multiprocessing.Process(target=bucket.take, args=(300,))
+		process.start()
+		process.join()
+		# The other process's debt is ours too
+		bucket.take()
+		self.assertAlmostEqual(self.clock.slept, 2.0, delta=0.1)
+
+
+class Test_RateLimits(unittest.TestCase):
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+		self.path = os.path.join(self.tmpDir, 'limits')
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpDir)
+
+	def writeLimits(self, text):
+		with open(self.path, 'w') as f:
+			f.write(text)
+
+	def test_load(self):
+		limits = RateLimits(files=10)
+		self.writeLimits('# throttle while users are about\nbytes = 20M\n\ncommands=50  # per second\n')
+		limits.load(self.path)
+		self.assertEqual(
+			(limits.bytes.rate, limits.files.rate, limits.commands.rate),
+			(20 * 1024 ** 2, 0, 50)
+		)
+		# A bad file leaves the limits alone
+		self.writeLimits('bytes = 1M\nspeed = 11\n')
+		limits.load(self.path)
+		self.assertEqual(limits.bytes.rate, 20 * 1024 ** 2)
+
+
+class CountingBucket(object):
+	def __init__(self):
+		self.taken = 0
+
+	def take(self, count=1):
+		self.taken += count
+
+
+class Test_Cyruslib_RateLimit(unittest.TestCase):
+	""" Test imap commands drawing from a bucket
+	"""
+	def setUp(self):
+		socket.setdefaulttimeout(5)
+		self.server = ImapServer(mailboxes=['user.bob', 'user.joe'])
+		self.bucket = CountingBucket()
+		self.imap = cyruslib.CYRUS(self.server.url, ratelimit=self.bucket)
+
+	def tearDown(self):
+		socket.setdefaulttimeout(None)
+		self.server.stop()
+
+	def test_commands(self):
+		self.imap.login('cyrus', 'secret')
+		del self.server.commands[:]
+		taken = self.bucket.taken
+		self.imap.lm('user.*')
+		self.imap.reconstruct('user.bob')
+		self.assertEqual(self.bucket.taken - taken, len(self.server.commands))
+		taken = self.bucket.taken
+		self.imap.logout()
+		self.assertEqual(self.bucket.taken, taken)
+
+	def test_append(self):
+		server = ImapServer(capabilities=['IMAP4rev1', 'LITERAL+'], mailboxes=['user.bob'])
+		try:
+			imap = cyruslib.CYRUS(server.url, ratelimit=self.bucket)
+			imap.login('cyrus', 'secret')
+			del server.commands[:]
+			taken = self.bucket.taken
+			messages = [(uid, '()', None, 'Subject: %d\r\n\r\nbody\r\n' % uid) for uid in (1, 2, 3)]
+			self.assertEqual(imap.appendmessages('user.bob', messages), 3)
+			self.assertEqual(server.commandNames().count('APPEND'), 3)
+			self.assertEqual(self.bucket.taken - taken, len(server.commands))
+			imap.logout()
+		finally:
+			server.stop()
@@ -0,0 +1,87 @@
+""" Unit tests for reading and writing skiplist databases
+"""
+import os
+import shutil
+import random
+import time
+import struct
+import tempfile
+import unittest
+from StringIO import StringIO
+from cyrusutils import skiplist
+
+
+def forwardChain(data, offset, level):
+	""" Keys reached by following the level pointers from the record at offset
+	"""
+	keys = []
+	while True:
+		rtype, ksize = struct.unpack_from('>2I', data, offset)
+		pos = offset + 8 + ksize + (-ksize % 4)
+		dsize = struct.unpack_from('>I', data, pos)[0]
+		pos += 4 + dsize + (-dsize % 4)
+		if rtype != skiplist.DUMMY:
+			keys.append(data[offset + 8:offset + 8 + ksize])
+		offset = struct.unpack_from('>I', data, pos + 4 * level)[0]
+		if not offset:
+			return keys
+
+
+class Test_Skiplist(unittest.TestCase):
+	def setUp(self):
+		self.records = [('%08x' % i, 'seen data %d' % i * (i % 3)) for i in range(200)]
+
+	def test_roundTrip(self):
+		fp = StringIO()
+		skiplist.write(fp, self.records, rnd=random.Random(1))
+		fp.seek(0)
+		header = skiplist.get_header(fp)
+		self.assertEqual(header['version'], [1, 2])
+		self.assertEqual(header['listsize'], 200)
+		self.assertEqual(header['logstart'], len(fp.getvalue()))
+		lastrecovery = struct.unpack_from('>I', fp.getvalue(), 44)[0]
+		self.assertTrue(abs(lastrecovery - time.time()) < 60)
+		self.assertEqual(list(skiplist.iterkeys(fp)), self.records)
+
+	def test_pointers(self):
+		fp = StringIO()
+		skiplist.write(fp, self.records, rnd=random.Random(1))
+		data = fp.getvalue()
+		curlevel = struct.unpack_from('>I', data, 32)[0]
+		self.assertTrue(curlevel > 1)
+		keys = [key for key, _ in self.records]
+		self.assertEqual(forwardChain(data, 48, 0), keys)
+		for level in range(1, curlevel):
+			chain = forwardChain(data, 48, level)
+			self.assertTrue(chain)
+			self.assertEqual(chain, sorted(chain))
+			self.assertTrue(set(chain) < set(keys))
+
+	def test_empty(self):
+		fp = StringIO()
+		skiplist.write(fp, [])
+		fp.seek(0)
+		self.assertEqual(skiplist.get_header(fp)['listsize'], 0)
+		self.assertEqual(list(skiplist.iterkeys(fp)), [])
+
+	def test_writefile(self):
+		tmpDir = tempfile.mkdtemp()
+		try:
+			path = os.path.join(tmpDir, 'bob.seen')
+			with open(path, 'w') as f:
+				f.write('old')
+			synced = []
+			fsync = os.fsync
+			os.fsync = lambda fd: synced.append(fd) or fsync(fd)
+			try:
+				skiplist.writefile(path, self.records[:3])
+			finally:
+				os.fsync = fsync
+			# The file, then its directory
+			self.assertEqual(len(synced), 2)
+			self.assertEqual(os.listdir(tmpDir), ['bob.seen'])
+			with open(path, 'rb') as fp:
+				skiplist.get_header(fp)
+				self.assertEqual(list(skiplist.iterkeys(fp)), self.records[:3])
+		finally:
+			shutil.rmtree(tmpDir)
@@ -0,0 +1,70 @@
+""" Unit tests for the spool inventory
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from cyrusutils import spool
+from cyrusutils.spool import SpoolInventory
+
+
+def makeMailbox(path, files, header=True):
+	os.makedirs(path)
+	if header:
+		open(os.path.join(path, 'cyrus.header'), 'w').close()
+		with open(os.path.join(path, 'cyrus.index'), 'w') as f:
+			f.write('index')
+	for name, data in files.items():
+		with open(os.path.join(path, name), 'w') as f:
+			f.write(data)
+
+
+class Test_SpoolInventory(unittest.TestCase):
+	def setUp(self):
+		# Root path with regex characters, which used to be matched unescaped
+		self.root = tempfile.mkdtemp(suffix='.spool+(1)')
+		self.user = os.path.join(self.root, 'domain/example.com/user/bob')
+		makeMailbox(self.user, {'1.': 'first', '2.': 'second'})
+		makeMailbox(os.path.join(self.user, 'Sent'), {'1.': 'sent'})
+		makeMailbox(os.path.join(self.user, 'Sent/2011'), {})
+		makeMailbox(os.path.join(self.user, 'Archive'), {}, header=False)
+		makeMailbox(os.path.join(self.user, 'Archive/Old'), {'1.': 'old'})
+
+	def tearDown(self):
+		shutil.rmtree(self.root)
+
+	def assertInventory(self, inventory):
+		self.assertEqual(list(inventory.mailboxes)[0], 'user.bob@example.com')
+		self.assertEqual(
+			sorted(inventory.mailboxes),
+			[
+				'user.bob.Archive.Old@example.com',
+				'user.bob.Sent.2011@example.com',
+				'user.bob.Sent@example.com',
+				'user.bob@example.com',
+			]
+		)
+		mailbox = inventory.get('user.bob@example.com')
+		self.assertEqual(mailbox.name, 'user.bob')
+		self.assertEqual(mailbox.domain, 'example.com')
+		self.assertEqual(mailbox.path, self.user)
+		self.assertTrue(mailbox.header)
+		self.assertEqual(sorted(mailbox.files), ['1.', '2.'])
+		self.assertEqual(sorted(mailbox.subdirs), ['Archive', 'Sent'])
+		self.assertEqual((mailbox.count, mailbox.bytes), (2, 11))
+		self.assertEqual((inventory.files, inventory.bytes), (4, 18))
+		self.assertTrue(inventory.get('user.bob.Archive@example.com') is None)
+
+	def test_inventory(self):
+		self.assertInventory(SpoolInventory('user.bob@example.com', self.user))
+
+	def test_listdirFallback(self):
+		scandir = spool._scandir
+		spool._scandir = None
+		try:
+			self.assertInventory(SpoolInventory('user.bob@example.com', self.user))
+		finally:
+			spool._scandir = scandir
+
+	def test_missing(self):
+		self.assertEqual(len(SpoolInventory('user.joe', os.path.join(self.root, 'user/joe'))), 0)
@@ -0,0 +1,297 @@
+""" Unit tests for the native sync engine
+"""
+import os
+import errno
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from cyrusutils import syncengine
+from cyrusutils.syncengine import SyncEngine
+
+
+def writeFile(path, data, mtime=1300000000):
+	with open(path, 'wb') as f:
+		f.write(data)
+	os.utime(path, (mtime, mtime))
+
+
+class Test_SyncEngine(unittest.TestCase):
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+		self.source = os.path.join(self.tmpDir, 'old/user/bob')
+		self.target = os.path.join(self.tmpDir, 'new/user/bob')
+		os.makedirs(os.path.join(self.source, 'Sent'))
+		writeFile(os.path.join(self.source, '1.'), 'first message')
+		writeFile(os.path.join(self.source, '2.'), 'second message')
+		writeFile(os.path.join(self.source, 'cyrus.index'), 'index')
+		writeFile(os.path.join(self.source, 'Sent', '1.'), 'sent message')
+		os.chmod(os.path.join(self.source, '2.'), 0640)
+		self.engine = SyncEngine(threads=2)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpDir)
+
+	def test_syncDirectory(self):
+		stats = self.engine.syncDirectory(self.source, self.target)
+		self.assertEqual(dict(stats), {'copied': 2, 'bytes': 27})
+		self.assertEqual(sorted(os.listdir(self.target)), ['1.', '2.', 'Sent'])
+		# Subfolders are created but not synced
+		self.assertEqual(os.listdir(os.path.join(self.target, 'Sent')), [])
+		st = os.stat(os.path.join(self.target, '2.'))
+		self.assertEqual(st.st_mode & 0777, 0640)
+		self.assertEqual(st.st_mtime, 1300000000)
+		with open(os.path.join(self.target, '1.')) as f:
+			self.assertEqual(f.read(), 'first message')
+
+	def test_incremental(self):
+		self.engine.syncDirectory(self.source, self.target)
+		writeFile(os.path.join(self.source, '2.'), 'second message, edited')
+		writeFile(os.path.join(self.source, '3.'), 'third message')
+		os.unlink(os.path.join(self.source, '1.'))
+		writeFile(os.path.join(self.target, 'cyrus.header'), 'header')
+		os.mkdir(os.path.join(self.target, 'Drafts'))
+		stats = self.engine.syncDirectory(self.source, self.target)
+		self.assertEqual(dict(stats), {'copied': 2, 'bytes': 35, 'deleted': 1})
+		# Excluded files and other mailboxes are left alone
+		self.assertEqual(sorted(os.listdir(self.target)), ['2.', '3.', 'Drafts', 'Sent', 'cyrus.header'])
+		stats = self.engine.syncDirectory(self.source, self.target)
+		self.assertEqual(dict(stats), {'unchanged': 2})
+
+	def test_unchangedPermissions(self):
+		self.engine.syncDirectory(self.source, self.target)
+		os.chmod(os.path.join(self.source, '2.'), 0600)
+		stats = self.engine.syncDirectory(self.source, self.target)
+		self.assertEqual(dict(stats), {'unchanged': 2})
+		self.assertEqual(os.stat(os.path.join(self.target, '2.')).st_mode & 0777, 0600)
+
+	def test_call(self):
+		stats = self.engine([
+			(self.source, self.target),
+			(os.path.join(self.source, 'Sent'), os.path.join(self.target, 'Sent')),
+		])
+		self.assertEqual(stats['copied'], 3)
+		self.assertEqual(os.listdir(os.path.join(self.target, 'Sent')), ['1.'])
+
+	def test_shards(self):
+		for uid in range(3, 26):
+			writeFile(os.path.join(self.source, '%d.' % uid), 'message %d' % uid)
+		os.makedirs(self.target)
+		writeFile(os.path.join(self.target, '99.'), 'expunged')
+		engine = SyncEngine(threads=2, shardSize=4, shardThreads=3, readOrder='uid')
+		shards = []
+		shardMap = engine._shardMap
+		engine._shardMap = lambda function, items: shards.extend(items) or shardMap(function, items)
+		stats = engine([(self.source, self.target)])
+		self.assertEqual((stats['copied'], stats['deleted']), (25, 1))
+		# Consecutive UIDs per shard
+		self.assertEqual(shards[0], ['1.', '2.', '3.', '4.'])
+		self.assertEqual(len(shards), 7)
+		self.assertTrue(engine.shardPool is None)
+		self.assertEqual(len(os.listdir(self.target)), 26)
+
+	def test_shardDeviceLimit(self):
+		for uid in range(3, 26):
+			writeFile(os.path.join(self.source, '%d.' % uid), 'message %d' % uid)
+		engine = SyncEngine(threads=2, shardSize=4, shardThreads=4, readOrder='uid',
+			deviceLimits={syncengine.device(self.source): 1, syncengine.device(self.target): 1})
+		running = [0]
+		peak = [0]
+		lock = threading.Lock()
+		transferShared = engine.transferShared
+		def transferOne(*args):
+			with lock:
+				running[0] += 1
+				peak[0] = max(peak[0], running[0])
+			time.sleep(0.005)
+			try:
+				return transferShared(*args)
+			finally:
+				with lock:
+					running[0] -= 1
+		engine.transferShared = transferOne
+		stats = engine([(self.source, self.target)])
+		self.assertEqual(stats['copied'], 25)
+		self.assertEqual(peak[0], 1)
+		self.assertEqual(sum(engine.limiter.busy.values()), 0)
+
+	def test_deviceJobs(self):
+		engine = SyncEngine(threads=4, deviceJobs=1)
+		running = []
+		syncDirectory = engine.syncDirectory
+		def syncOne(source, target, sourceManifest=None, held=None):
+			running.append(source)
+			self.assertEqual(len(engine.limiter.busy), 1)
+			self.assertEqual(engine.limiter.busy.values(), [1])
+			return syncDirectory(source, target, sourceManifest, held)
+		engine.syncDirectory = syncOne
+		stats = engine([
+			(self.source, self.target),
+			(os.path.join(self.source, 'Sent'), os.path.join(self.target, 'Sent')),
+		])
+		self.assertEqual(stats['copied'], 3)
+		self.assertEqual(len(running), 2)
+
+	def test_callFailure(self):
+		self.assertRaises(OSError, self.engine, [
+			(os.path.join(self.source, 'Missing'), self.target),
+			(os.path.join(self.source, 'Sent'), os.path.join(self.target, 'Sent')),
+		])
+
+	def test_readOrder(self):
+		for uid in range(3, 12):
+			writeFile(os.path.join(self.source, '%d.' % uid), 'message %d' % uid)
+		sourceFiles, _ = self.engine.manifest(self.source)
+		names = sorted(sourceFiles)
+		self.engine.readOrder = 'inode'
+		self.engine.sortTransfers(self.source, names, sourceFiles, None)
+		inodes = [sourceFiles[name].st_ino for name in names]
+		self.assertEqual(inodes, sorted(inodes))
+
+		self.engine.readOrder = 'uid'
+		self.engine.sortTransfers(self.source, names, sourceFiles, None)
+		self.assertEqual(names[:3], ['1.', '2.', '3.'])
+		self.assertEqual(names[-1], '11.')
+
+		offsets = {}
+		physicalOffset = syncengine.physicalOffset
+		syncengine.physicalOffset = lambda path: offsets.setdefault(path, 100 - len(offsets))
+		try:
+			self.engine.readOrder = 'extent'
+			self.engine.sortTransfers(self.source, names, sourceFiles, None)
+		finally:
+			syncengine.physicalOffset = physicalOffset
+		self.assertEqual(names, sorted(names, key=lambda name: offsets[os.path.join(self.source, name)]))
+
+	def test_physicalOffset(self):
+		# tmpfs has no extents, other filesystems report an offset
+		offset = syncengine.physicalOffset(os.path.join(self.source, '1.'))
+		self.assertTrue(offset is None or offset >= 0)
+
+	def test_rateLimits(self):
+		class Bucket(object):
+			taken = 0
+			def take(self, count=1):
+				self.taken += count
+		class Limits(object):
+			bytes = Bucket()
+			files = Bucket()
+		self.engine.rateLimits = Limits()
+		self.engine.syncDirectory(self.source, self.target)
+		self.assertEqual((Limits.files.taken, Limits.bytes.taken), (2, 27))
+
+	def test_device(self):
+		self.assertEqual(syncengine.device(os.path.join(self.tmpDir, 'new/user/bob')), os.stat(self.tmpDir).st_dev)
+
+	def test_copyDataFallback(self):
+		calls = []
+		def unsupported(fsrc, fdst, offset, count):
+			calls.append(offset)
+			raise OSError(errno.EXDEV, 'Invalid cross-device link')
+		kernelCopies = syncengine._kernelCopies
+		syncengine._kernelCopies = [unsupported]
+		try:
+			self.engine.syncDirectory(self.source, self.target)
+		finally:
+			syncengine._kernelCopies = kernelCopies
+		self.assertEqual(calls, [0, 0])
+		with open(os.path.join(self.target, '2.')) as f:
+			self.assertEqual(f.read(), 'second message')
+
+	def test_hardlink(self):
+		stats = SyncEngine(mode='hardlink').syncDirectory(self.source, self.target)
+		self.assertEqual(dict(stats), {'linked': 2})
+		self.assertEqual(
+			os.stat(os.path.join(self.target, '1.')).st_ino,
+			os.stat(os.path.join(self.source, '1.')).st_ino
+		)
+		stats = SyncEngine(mode='hardlink').syncDirectory(self.source, self.target)
+		self.assertEqual(dict(stats), {'unchanged': 2})
+
+	def test_hardlinkCrossDevice(self):
+		calls = []
+		def link(source, target):
+			calls.append(source)
+			raise OSError(errno.EXDEV, 'Invalid cross-device link')
+		osLink = os.link
+		os.link = link
+		try:
+			stats = SyncEngine(mode='hardlink').syncDirectory(self.source, self.target)
+		finally:
+			os.link = osLink
+		self.assertEqual(dict(stats), {'copied': 2, 'bytes': 27})
+		# Not retried once the devices refused
+		self.assertEqual(len(calls), 1)
+
+	def test_hardlinkRefusedFile(self):
+		# Protected hardlinks refuse a file, the other ones are still linked
+		osLink = os.link
+		def link(source, target):
+			if source.endswith('1.'):
+				raise OSError(errno.EPERM, 'Operation not permitted')
+			osLink(source, target)
+		os.link = link
+		try:
+			stats = SyncEngine(mode='hardlink').syncDirectory(self.source, self.target)
+		finally:
+			os.link = osLink
+		self.assertEqual(dict(stats), {'copied': 1, 'bytes': 13, 'linked': 1})
+
+	def test_reflink(self):
+		# Cloned on btrfs or xfs, copied anywhere else
+		stats = SyncEngine(mode='reflink').syncDirectory(self.source, self.target)
+		self.assertEqual(stats['cloned'] + stats['copied'], 2)
+		with open(os.path.join(self.target, '2.')) as f:
+			self.assertEqual(f.read(), 'second message')
+		self.assertEqual(os.stat(os.path.join(self.target, '2.')).st_mode & 0777, 0640)
+
+	def test_singleInstanceStore(self):
+		# The same delivery in both mailboxes, as singleinstancestore leaves it
+		os.link(os.path.join(self.source, '1.'), os.path.join(self.source, 'Sent', '2.'))
+		pairs = [
+			(self.source, self.target),
+			(os.path.join(self.source, 'Sent'), os.path.join(self.target, 'Sent')),
+		]
+		stats = self.engine(pairs)
+		self.assertEqual(stats['copied'], 3)
+		self.assertEqual(stats['relinked'], 1)
+		self.assertEqual(
+			os.stat(os.path.join(self.target, '1.')).st_ino,
+			os.stat(os.path.join(self.target, 'Sent', '2.')).st_ino
+		)
+		self.assertNotEqual(
+			os.stat(os.path.join(self.target, '1.')).st_ino,
+			os.stat(os.path.join(self.source, '1.')).st_ino
+		)
+
+	def test_singleInstanceStoreIncremental(self):
+		os.link(os.path.join(self.source, '1.'), os.path.join(self.source, 'Sent', '2.'))
+		self.engine.syncDirectory(self.source, self.target)
+		# A later run links the new mailbox file to the existing copy
+		stats = SyncEngine().syncDirectory(os.path.join(self.source, 'Sent'), os.path.join(self.target, 'Sent'))
+		self.assertEqual(dict(stats), {'copied': 2, 'bytes': 25})
+		engine = SyncEngine()
+		engine.syncDirectory(self.source, self.target)
+		os.unlink(os.path.join(self.target, 'Sent', '2.'))
+		stats = engine.syncDirectory(os.path.join(self.source, 'Sent'), os.path.join(self.target, 'Sent'))
+		self.assertEqual(dict(stats), {'relinked': 1, 'unchanged': 1})
+
+
+class Test_DeviceLimiter(unittest.TestCase):
+	def test_next(self):
+		limiter = syncengine.DeviceLimiter(limit=1, limits={2: 2})
+		queue = [('a', frozenset([1])), ('b', frozenset([1, 2])), ('c', frozenset([2])), ('d', frozenset([3]))]
+		self.assertEqual(limiter.next(queue), ('a', frozenset([1])))
+		# b waits for device 1
+		self.assertEqual(limiter.next(queue), ('c', frozenset([2])))
+		self.assertEqual(limiter.next(queue), ('d', frozenset([3])))
+		limiter.release(frozenset([1]))
+		self.assertEqual(limiter.next(queue), ('b', frozenset([1, 2])))
+		self.assertEqual(limiter.next(queue), None)
+		self.assertEqual(limiter.busy[2], 2)
+
+	def test_unlimited(self):
+		limiter = syncengine.DeviceLimiter()
+		queue = [('a', frozenset([1])), ('b', frozenset([1]))]
+		self.assertEqual([limiter.next(queue)[0], limiter.next(queue)[0]], ['a', 'b'])
@@ -0,0 +1,54 @@
+""" Unit tests for the sync state database
+"""
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from cyrusutils import syncstate
+from cyrusutils.syncstate import SyncState
+
+
+def indexHeader(exists, lastUid, uidvalidity, modseq):
+	header = bytearray(96)
+	struct.pack_into('>I', header, 20, exists)
+	struct.pack_into('>I', header, 28, lastUid)
+	struct.pack_into('>I', header, 44, uidvalidity)
+	struct.pack_into('>Q', header, 72, modseq)
+	return str(header)
+
+
+class Test_SyncState(unittest.TestCase):
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+		self.mailbox = os.path.join(self.tmpDir, 'user/bob')
+		os.makedirs(self.mailbox)
+		os.utime(self.mailbox, (1300000000, 1300000000))
+		self.dbFile = os.path.join(self.tmpDir, 'sync.db')
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpDir)
+
+	def test_fingerprint(self):
+		self.assertEqual(syncstate.fingerprint(self.mailbox), [None, None, None, None, 1300000000])
+		with open(os.path.join(self.mailbox, 'cyrus.index'), 'wb') as f:
+			f.write(indexHeader(12, 40, 1234567890, 2 ** 40))
+		os.utime(self.mailbox, (1300000000, 1300000000))
+		self.assertEqual(syncstate.fingerprint(self.mailbox), [12, 40, 1234567890, 2 ** 40, 1300000000])
+
+	def test_unchanged(self):
+		state = SyncState(self.dbFile)
+		fingerprint = syncstate.fingerprint(self.mailbox)
+		self.assertFalse(state.unchanged('sync', 'user.bob', 'user.bob@example.com', fingerprint))
+		self.assertEqual(state.synced('sync', 'user.bob', 'user.bob@example.com'), None)
+		state.done('sync', [('user.bob', 'user.bob@example.com', fingerprint)])
+		state.close()
+
+		# Persisted, per phase and target
+		state = SyncState(self.dbFile)
+		self.assertTrue(state.unchanged('sync', 'user.bob', 'user.bob@example.com', fingerprint))
+		self.assertTrue(state.synced('sync', 'user.bob', 'user.bob@example.com') > 0)
+		self.assertFalse(state.unchanged('reconstruct', 'user.bob', 'user.bob@example.com', fingerprint))
+		self.assertFalse(state.unchanged('sync', 'user.bob', 'user.robert@example.com', fingerprint))
+		os.utime(self.mailbox, (1300000001, 1300000001))
+		self.assertFalse(state.unchanged('sync', 'user.bob', 'user.bob@example.com', syncstate.fingerprint(self.mailbox)))